@@ -1,7 +1,22 @@
 import json
+import time
+from collections import OrderedDict, deque
+from game import NUM_PIECES, PLAYER_INDEX, UNENTERED, SAVED, piece_slot
+from topology import iter_bits
 
 GAME_OVER_SCORE = 10000
-LOG_TO_FILE = False
+PLAYERS = ['white', 'black']
+PASS = (0, 0, 0)
+SEARCH_MODES = ['exhaustive', 'batch', 'expectimax', 'parallel', 'pruned']  # batch scores all leaves at once with numpy
+BOUND_MARGIN = 1e-6  # slack for rounding when comparing a follow-up's bound with the best score
+# Whole turns the expectimax search looks ahead, counting the agent's own. A full depth 2 search takes
+# 20-70 s in mid-game positions, so within the default budget it would only ever run out the clock
+# and fall back to depth 1; deeper searches are opt-in, with a budget to match.
+SEARCH_DEPTH = 1
+SEARCH_TIME_BUDGET = 2.0  # seconds per move for expectimax; it keeps the deepest answer finished by then
+LOG_TO_FILE = False  # append every decision to log_file as a line of JSON
+LOG_SIZE = 1000  # decisions kept in Agent.log
+TRANSPOSITION_TABLE_SIZE = 200000  # cached leaf evaluations, least recently used evicted first
 
 INITIAL_WEIGHTS = {
     'saved_bonuses': {0:0, 1:18, 2:20, 3:22, 4:24, 5:26, 6:28},
@@ -23,118 +38,401 @@ INITIAL_WEIGHTS = {
     'high_goal_penalty': -.3,
     'dice_roll_utilization': -2
 }
-class Agent():
-    def __init__(self, board=None, weights=INITIAL_WEIGHTS, log_file='game_log.json'):
-        self.board = board
+# per-piece score terms, summed into running per-player totals by IncrementalEvaluator
+(SAVED_COUNT, SAVED_BONUS, GOAL_COUNT, GOAL_BONUS, HIGH_GOAL, NEAR_COUNT, NEARER_COUNT, NEAR_BONUS,
+ OFF_GOAL, FAR_FROM_GOAL, FAR_DISTANCE, UNREACHABLE, FAR_BONUS, BLOCKED_COUNT, BLOCKED_BONUS,
+ LOOSE_COUNT, LOOSE_BONUS, UNENTERED_COUNT, IN_PLAY_COUNT, HOME_COUNT, CAPTURED_BONUS) = range(21)
+NO_TERMS = (0,) * 21
+COMPONENTS = ['saved_pieces', 'saved_bonus', 'goal_pieces', 'goal_bonus', 'captured_pieces', 'captured_bonus',
+              'pieces_near_goal', 'pieces_nearer_goal', 'near_goal_bonus', 'blocked_pieces', 'blocked_piece_bonus',
+              'loose_pieces', 'loose_piece_bonus', 'total_distance', 'unentered_pieces', 'off_goal_penalty',
+              'far_from_goal_penalty', 'high_goal_penalty', 'game_stage_bonus']  # score_values order
+
+
+class IncrementalEvaluator:
+    """Running totals of the evaluation terms for both players.
+
+    sync() diffs the position against the last one it saw (any backend exposing get_locations() and
+    get_blocked_mask()) and rescores only the pieces that moved, share a tile with a moved piece, or
+    whose route to goal could be changed by a blockade that formed or broke. Every other piece keeps
+    its cached distance and terms.
+    """
+
+    def __init__(self, weights):
         self.weights = weights
-        self.log = []
-        self.log_file = log_file
-
+        self.topology = None
+
+    def reset(self, topology):
+        self.topology = topology
+        self.locations = [None] * (2 * NUM_PIECES)
+        self.distances = [0] * (2 * NUM_PIECES)
+        self.terms = [NO_TERMS] * (2 * NUM_PIECES)
+        self.tile_counts = [0] * topology.size
+        self.blocked = [0, 0]
+        self.totals = [[0] * len(NO_TERMS), [0] * len(NO_TERMS)]
+
+    def sync(self, board):
+        if board.topology is not self.topology:
+            self.reset(board.topology)
+        locations = board.get_locations()
+
+        moved = set()
+        changed_tiles = set()
+        for slot, location in enumerate(locations):
+            previous = self.locations[slot]
+            if location != previous:
+                moved.add(slot)
+                if previous is not None and previous >= 0:
+                    self.tile_counts[previous] -= 1
+                    changed_tiles.add(previous)
+                if location is not None and location >= 0:
+                    self.tile_counts[location] += 1
+                    changed_tiles.add(location)
+                self.locations[slot] = location
+
+        for player in PLAYERS:
+            p = PLAYER_INDEX[player]
+            blocked = board.get_blocked_mask(player)
+            flipped = blocked ^ self.blocked[p]
+            self.blocked[p] = blocked
+            if not moved and not flipped:
+                continue
 
-    def evaluate_player(self, board, player):
+            totals = self.totals[p]
+            for slot in range(p * NUM_PIECES, (p + 1) * NUM_PIECES):
+                location = locations[slot]
+                dirty = slot in moved or location in changed_tiles
+                if dirty or (flipped and self.route_affected(slot, flipped, blocked)):
+                    distance = self.route_length(slot, blocked)
+                    if not dirty and distance == self.distances[slot]:
+                        continue
+                    self.distances[slot] = distance
+                    terms = self.piece_terms(slot)
+                    for i, (new, old) in enumerate(zip(terms, self.terms[slot])):
+                        if new != old:
+                            totals[i] += new - old
+                    self.terms[slot] = terms
+
+    def can_be_saved(self, slot, location=None):
+        if location is None:
+            location = self.locations[slot]
+        if location == SAVED:
+            return True
+        number = slot % NUM_PIECES + 1
+        return (location is not None and location >= 0 and self.topology.is_save[location]
+                and (number > 6 or number == self.topology.numbers[location]))
+
+    def route_length(self, slot, blocked, location=None):
+        if location is None:
+            location = self.locations[slot]
+        if location is None or self.can_be_saved(slot, location):
+            return 0
+        number = slot % NUM_PIECES + 1
+        start = location if location >= 0 else self.topology.home
+        return self.topology.goal_distance(start, number if number <= 6 else 0, blocked)
+
+    def route_affected(self, slot, flipped, blocked):
+        # Could toggling the flipped tiles change this piece's route? A new blocker only matters if it is
+        # closer than the current distance; a lifted one only if going through it could be shorter.
+        location = self.locations[slot]
+        distance = self.distances[slot]
+        if location is None or distance == 0:
+            return False
+        topology = self.topology
+        start = location if location >= 0 else topology.home
+        from_start = topology.distances[start]
+        number = slot % NUM_PIECES + 1
+        to_goal = topology.goal_distances[number if number <= 6 else 0]
+        for tile in iter_bits(flipped):
+            if (blocked >> tile) & 1:
+                if from_start[tile] < distance:
+                    return True
+            elif from_start[tile] + to_goal[tile] < distance:
+                return True
+        return False
+
+    def piece_terms(self, slot):
+        location = self.locations[slot]
+        if location is None:
+            return NO_TERMS
+        return self.terms_at(slot, location, self.distances[slot], self.tile_counts[location] if location >= 0 else 0)
+
+    def terms_at(self, slot, location, distance, tile_count):
+        # the terms of a piece at location, given its route length and how many pieces share its tile
+        weights = self.weights
+        topology = self.topology
+        number = slot % NUM_PIECES + 1
+        numbered = number <= 6
+        on_board = location >= 0
+        saveable = self.can_be_saved(slot, location)
+        terms = [0] * len(NO_TERMS)
+
+        if location == SAVED:
+            terms[SAVED_COUNT] = 1
+            terms[SAVED_BONUS] = weights['saved_bonuses'].get(number, 0)
+        if saveable:
+            terms[GOAL_COUNT] = 1
+            if numbered:
+                terms[GOAL_BONUS] = weights['goal_bonuses'].get(number, 0)
+            elif on_board:
+                terms[HIGH_GOAL] = weights['goal_bonuses'].get(topology.numbers[location], 0)
+        elif numbered:
+            terms[OFF_GOAL] = weights['goal_bonuses'].get(number, 0)
+            if distance > 6 and on_board and topology.passable[location]:
+                terms[FAR_FROM_GOAL] = weights['goal_bonuses'].get(number, 0)
+
+        if on_board and 1 <= distance <= 6:
+            terms[NEAR_COUNT] = 1
+            if numbered:
+                terms[NEAR_BONUS] = weights['near_goal_bonuses'].get(number, 0)
+            elif distance <= 4:
+                terms[NEARER_COUNT] = 1
+
+        if distance > 6:
+            if distance == float('inf'):
+                terms[UNREACHABLE] = 1
+            else:
+                terms[FAR_DISTANCE] = distance
+            if numbered:
+                terms[FAR_BONUS] = weights['goal_bonuses'].get(number, 0)
+        if distance > 1000:
+            terms[BLOCKED_COUNT] = 1
+            if numbered:
+                terms[BLOCKED_BONUS] = weights['blocked_piece_penalties'].get(number, 0)
+
+        if on_board and topology.is_field[location] and tile_count == 1:
+            terms[LOOSE_COUNT] = 1
+            if numbered:
+                terms[LOOSE_BONUS] = weights['loose_piece_penalties'].get(number, 0)
+
+        if location == UNENTERED:
+            terms[UNENTERED_COUNT] = 1
+        if on_board and not topology.is_save[location]:
+            terms[IN_PLAY_COUNT] = 1
+        if location == topology.home:
+            terms[HOME_COUNT] = 1
+            if numbered:
+                terms[CAPTURED_BONUS] = weights['captured_bonuses'].get(number, 0)
+        return tuple(terms)
+
+    def score_player(self, board, player):
         opponent = 'white' if player == 'black' else 'black'
-        save_rack = board.get_save_rack(player)
-        unentered_rack = board.get_unentered_rack(player)
-        opponent_unentered = board.get_unentered_rack(opponent)
+        values, penalty = self.score_values(self.totals[PLAYER_INDEX[player]], self.totals[PLAYER_INDEX[opponent]],
+                                            player, board.game_stages, board.current_player)
+        score_components = dict(zip(COMPONENTS, values))
+        total_score = sum(values) - penalty
+        score_components['_total_score'] = total_score
+        score_components['_player'] = player
+        own = PLAYER_INDEX[player] * NUM_PIECES
+        score_components['_goal_pieces'] = [(slot - own + 1, player, self.distances[slot]) for slot in range(own, own + NUM_PIECES)
+                                            if self.terms[slot][NEAR_COUNT]]
 
-        # Precompute shortest routes for all pieces
-        distances = {}
-        for piece in board.pieces:
-            distances[piece] = board.shortest_route_to_goal(piece)
+        return total_score, score_components
 
+    def score_value(self, board, player):
+        # score_player's total alone, for the search
+        opponent = 'white' if player == 'black' else 'black'
+        values, penalty = self.score_values(self.totals[PLAYER_INDEX[player]], self.totals[PLAYER_INDEX[opponent]],
+                                            player, board.game_stages, board.current_player)
+        return sum(values) - penalty
 
-        # Saved pieces and bonus
-        saved_pieces = len(save_rack)
-        saved_bonus = sum(self.weights['saved_bonuses'].get(piece.number, 0) for piece in save_rack)
+    def score_values(self, totals, opponent_totals, player, game_stages, current_player):
+        # the score components in COMPONENTS order, and the penalty taken off their sum
+        weights = self.weights
+        opponent = 'white' if player == 'black' else 'black'
 
-        # Goal pieces and bonus
-        goal_pieces = [piece for piece in board.pieces if piece.player == player and piece.can_be_saved()]
-        goal_bonus = sum(self.weights['goal_bonuses'].get(piece.number, 0) for piece in goal_pieces if piece.number <= 6)
+        # Total distance component
+        total_distance = min(float('inf') if totals[UNREACHABLE] else totals[FAR_DISTANCE], 100)
+        total_distance += totals[FAR_BONUS] / 10
 
-        # High goal penalty
-        occupied_goals = [piece.tile for piece in goal_pieces if piece.tile and piece.number > 6]
-        high_goal_penalty = sum(self.weights['goal_bonuses'].get(goal.number, 0) * self.weights['high_goal_penalty']
-                                for goal in occupied_goals)
+        # Loose pieces matter less the fewer opponent pieces are around to hit them
+        opponent_board_pieces = opponent_totals[IN_PLAY_COUNT] + min(1, opponent_totals[UNENTERED_COUNT])
+        loose_piece_bonus = totals[LOOSE_BONUS] * (opponent_board_pieces / 14)
+        if game_stages[opponent] == 'endgame':
+            loose_piece_bonus *= -1
 
-        # Pieces near goal and nearer goal with bonus
-        board_pieces = [piece for piece in board.pieces if piece.player == player and piece.tile]
-        pieces_near_goal = [piece for piece in board_pieces if 1 <= distances[piece] <= 6]
-        pieces_nearer_goal = [piece for piece in board_pieces if piece.number > 6 and 1 <= distances[piece] <= 4]
-        near_goal_bonus = sum(self.weights['near_goal_bonuses'].get(piece.number, 0) for piece in pieces_near_goal if piece.number <= 6)
+        # Game stage bonus
+        game_stage_bonus = weights['game_stage_bonuses'].get(game_stages[player], 0)
 
-        # Off-goal and far-from-goal penalties
-        numbered_off_goal = [piece for piece in board.pieces if piece.player == player and piece.number <= 6 and not piece.can_be_saved()]
-        off_goal_penalty = -sum(self.weights['goal_bonuses'].get(piece.number, 0) for piece in numbered_off_goal)
-        numbered_far_from_goal = [piece for piece in numbered_off_goal if distances[piece] > 6 and piece.tile and piece.tile.type in ['field', 'save']]
-        far_from_goal_penalty = -sum(self.weights['goal_bonuses'].get(piece.number, 0) for piece in numbered_far_from_goal)
+        # Massive penalty for leaving a captured piece home
+        penalty = 10000 if current_player == player and totals[HOME_COUNT] > 0 else 0
+
+        values = [
+            totals[SAVED_COUNT] * weights['saved_piece'],
+            totals[SAVED_BONUS],
+            totals[GOAL_COUNT] * weights['goal_piece'],
+            totals[GOAL_BONUS],
+            opponent_totals[HOME_COUNT] * weights['captured_opponent_piece'],
+            opponent_totals[CAPTURED_BONUS],
+            totals[NEAR_COUNT] * weights['near_goal_piece'],
+            totals[NEARER_COUNT] * weights['nearer_goal_piece'],
+            totals[NEAR_BONUS],
+            totals[BLOCKED_COUNT] * weights['blocked_piece'],
+            totals[BLOCKED_BONUS],
+            totals[LOOSE_COUNT] * weights['loose_piece'],
+            loose_piece_bonus,
+            total_distance * weights['distance_penalty'],
+            totals[UNENTERED_COUNT] * weights['unentered_piece'],
+            -totals[OFF_GOAL],
+            -totals[FAR_FROM_GOAL],
+            totals[HIGH_GOAL] * weights['high_goal_penalty'],
+            game_stage_bonus
+        ]
+        return values, penalty
+
+    def bound_after(self, board, move, player):
+        # Upper bound on Agent.evaluate(board, player) once player makes move, worked out from the synced
+        # totals without making it. A move never changes the mover's blocked tiles, so the mover's side
+        # is exact; the opponent's side is exact too unless the move forms a blockade across an opponent
+        # route, and such pieces are scored as if cut off, which is the least they can be worth.
+        topology = self.topology
+        locations = self.locations
+        p = PLAYER_INDEX[player]
+        o = 1 - p
+        opponent = PLAYERS[o]
+        slot = piece_slot(*move[0])
+        origin = locations[slot]
+        destination = SAVED if move[1] == 'save' else topology.index_of[move[1]]
+
+        moved = {slot: destination}
+        tile_counts = {}
+        if origin >= 0:
+            tile_counts[origin] = self.tile_counts[origin] - 1
+        if destination >= 0:
+            tile_counts[destination] = self.tile_counts[destination] + 1
+            if topology.is_field[destination]:
+                captured = next((s for s in range(o * NUM_PIECES, (o + 1) * NUM_PIECES) if locations[s] == destination), None)
+                if captured is not None:
+                    moved[captured] = topology.home
+                    tile_counts[destination] -= 1
+                    tile_counts[topology.home] = self.tile_counts[topology.home] + 1
+        elif self.totals[p][SAVED_COUNT] == NUM_PIECES - 1:
+            return float('inf')  # wins the game
+
+        # the opponent is blocked where the mover keeps two or more pieces on a field tile
+        blocked = self.blocked[o]
+        added = 0
+        for tile, count in tile_counts.items():
+            if topology.is_field[tile]:
+                if count >= 2 and not (blocked >> tile) & 1:
+                    added |= 1 << tile
+                elif count < 2:
+                    blocked &= ~(1 << tile)
+        blocked |= added
+
+        # rescore the moved pieces, their tile mates, and opponent pieces a new blockade could cut off
+        touched = {s for s, location in enumerate(locations) if location in tile_counts}
+        touched.update(moved)
+        if added:
+            touched.update(range(o * NUM_PIECES, (o + 1) * NUM_PIECES))
+
+        totals = [list(self.totals[p]), list(self.totals[o])]
+        for s in touched:
+            location = moved.get(s, locations[s])
+            opponent_piece = s // NUM_PIECES == o
+            if s in moved:
+                distance = self.route_length(s, blocked if opponent_piece else self.blocked[p], location)
+            elif opponent_piece and added and self.route_affected(s, added, blocked):
+                distance = float('inf')
+            elif location in tile_counts:
+                distance = self.distances[s]
+            else:
+                continue
+            count = tile_counts.get(location, self.tile_counts[location]) if location >= 0 else 0
+            side_totals = totals[opponent_piece]
+            for i, (new, old) in enumerate(zip(self.terms_at(s, location, distance, count), self.terms[s])):
+                if new != old:
+                    side_totals[i] += new - old
 
-        # Total distance component
-        pieces_not_near_goal = [piece for piece in board.pieces if piece.player == player and distances[piece] > 6]
-        total_distance = min(sum(distances[piece] for piece in pieces_not_near_goal), 100)
-        total_distance += sum(self.weights['goal_bonuses'].get(piece.number, 0)
-                            for piece in pieces_not_near_goal if piece.number <= 6) / 10
-
-        # Blocked pieces bonus
-        blocked_pieces = [piece for piece in board.pieces if piece.player == player and distances[piece] > 1000]
-        blocked_piece_bonus = sum(self.weights['blocked_piece_penalties'].get(piece.number, 0)
-                                for piece in blocked_pieces if piece.number <= 6)
-
-        # Loose pieces bonus
-        loose_pieces = [piece for piece in board_pieces if piece.tile.type == 'field' and len(piece.tile.pieces) == 1]
-        loose_piece_bonus = sum(self.weights['loose_piece_penalties'].get(piece.number, 0)
-                                for piece in loose_pieces if piece.number <= 6)
-        opponent_board_pieces = (len([piece for piece in board.pieces if piece.player == opponent and piece.tile and piece.tile.type in ['field', 'home']])
-                                + min(1, len(opponent_unentered)))
-        loose_piece_bonus *= (opponent_board_pieces / 14)
-        if board.game_stages[opponent] == 'endgame':
-            loose_piece_bonus *= -1
+        game_stages = dict(board.game_stages)
+        if totals[0][UNENTERED_COUNT]:
+            game_stages[player] = 'opening'
+        elif totals[0][GOAL_COUNT] == NUM_PIECES:
+            game_stages[player] = 'endgame'
+        else:
+            game_stages[player] = 'midgame'
 
-        # Captured opponent pieces bonus
-        captured_pieces = [piece for piece in board.pieces if piece.player == opponent and piece.tile and piece.tile.type == 'home']
-        captured_bonus = sum(self.weights['captured_bonuses'].get(piece.number, 0)
-                            for piece in captured_pieces if piece.number <= 6)
+        own, penalty = self.score_values(totals[0], totals[1], player, game_stages, board.current_player)
+        other, other_penalty = self.score_values(totals[1], totals[0], opponent, game_stages, board.current_player)
+        return (sum(own) - penalty) - (sum(other) - other_penalty)
 
-        # Game stage bonus
-        game_stage = board.game_stages[player]
-        game_stage_bonus = self.weights['game_stage_bonuses'].get(game_stage, 0)
 
-        # Massive penalty for leaving a captured piece home
-        penalty = 10000 if len([piece for piece in board.pieces if board.current_player == player and piece.player == player and piece.tile and piece.tile.type == 'home']) > 0 else 0
+class Agent():
+    def __init__(self, board=None, weights=INITIAL_WEIGHTS, log_file='game_log.json', search='exhaustive',
+                 search_depth=SEARCH_DEPTH, time_budget=SEARCH_TIME_BUDGET, workers=None, book=None,
+                 tracer=None, model=None):
+        if search not in SEARCH_MODES:
+            raise ValueError(f'Unknown search mode: {search}')
+        if model is not None and search == 'pruned':
+            raise ValueError('The pruned search bounds the built-in evaluation and cannot use a model')
+        self.board = board
+        self.weights = weights
+        self.search = search
+        self.search_depth = search_depth
+        self.time_budget = time_budget
+        self.workers = workers  # parallel search processes, one per core by default
+        self.parallel = None
+        self.book = book  # book.Book consulted before searching; its files are generated for INITIAL_WEIGHTS
+        self.tracer = tracer  # tracing.Tracer for the searches, if any
+        self.trace = None  # the SearchTrace of the search running now
+        self.model = model  # features.LinearModel or MLPModel scoring positions in place of the evaluation below
+        self.log = deque(maxlen=LOG_SIZE)
+        self.log_file = log_file
+        self.evaluator = IncrementalEvaluator(weights)
+        self.transpositions = OrderedDict()
+        self.transposition_hits = 0
+        self.transposition_misses = 0
+        self.nodes = 0  # positions the searches have reached, the root included
 
-        score_components = {
-            'saved_pieces': saved_pieces * self.weights['saved_piece'],
-            'saved_bonus': saved_bonus,
-            'goal_pieces': len(goal_pieces) * self.weights['goal_piece'],
-            'goal_bonus': goal_bonus,
-            'captured_pieces': len(captured_pieces) * self.weights['captured_opponent_piece'],
-            'captured_bonus': captured_bonus,
-            'pieces_near_goal': len(pieces_near_goal) * self.weights['near_goal_piece'],
-            'pieces_nearer_goal': len(pieces_nearer_goal) * self.weights['nearer_goal_piece'],
-            'near_goal_bonus': near_goal_bonus,
-            'blocked_pieces': len(blocked_pieces) * self.weights['blocked_piece'],
-            'blocked_piece_bonus': blocked_piece_bonus,
-            'loose_pieces': len(loose_pieces) * self.weights['loose_piece'],
-            'loose_piece_bonus': loose_piece_bonus,
-            'total_distance': total_distance * self.weights['distance_penalty'],
-            'unentered_pieces': len(unentered_rack) * self.weights['unentered_piece'],
-            'off_goal_penalty': off_goal_penalty,
-            'far_from_goal_penalty': far_from_goal_penalty,
-            'high_goal_penalty': high_goal_penalty,
-            'game_stage_bonus': game_stage_bonus
-        }
-        total_score = sum(score_components.values()) - penalty
-        score_components['_total_score'] = total_score
-        score_components['_player'] = player
-        score_components['_goal_pieces'] = [(piece.number, piece.player, board.shortest_route_to_goal(piece)) for piece in pieces_near_goal]
 
-        return total_score, score_components
+    def evaluate_player(self, board, player):
+        self.evaluator.sync(board)
+        return self.evaluator.score_player(board, player)
+
+    def score(self, board, player):
+        # Agent.evaluate's score alone, which is all the search compares; the breakdown is only built for
+        # the pair that gets chosen. Transposition table: positions reached through different move orders
+        # are scored once. The key also carries the stored game stages, which the score depends on.
+        key = (board.get_hash(), player, board.game_stages['white'], board.game_stages['black'])
+        cached = self.transpositions.get(key)
+        if cached is not None:
+            self.transposition_hits += 1
+            self.transpositions.move_to_end(key)
+            return cached
+
+        self.transposition_misses += 1
+        score = self.traced('evaluate', self.score_position, board, player)
+        self.transpositions[key] = score
+        if len(self.transpositions) > TRANSPOSITION_TABLE_SIZE:
+            self.transpositions.popitem(last=False)
+        return score
+
+    def score_position(self, board, player):
+        winner, score = board.check_game_over()
+        if winner:
+            factor = 1 if winner == player else -1
+            return factor * score * GAME_OVER_SCORE
+        if self.model is not None:
+            from features import board_features
+            return float(self.model.score(board_features(board, player))[0])
 
+        self.evaluator.sync(board)
+        opponent = 'white' if player == 'black' else 'black'
+        return self.evaluator.score_value(board, player) - self.evaluator.score_value(board, opponent)
 
     def evaluate(self, board, player):
+        # the score with its full breakdown, for the log and /evaluate_board
+        return self.evaluate_position(board, player)
+
+    def evaluate_position(self, board, player):
         winner, score = board.check_game_over()
         if winner:
             factor = 1 if winner == player else -1
             return factor * score * GAME_OVER_SCORE, {}
+        if self.model is not None:
+            from features import board_features
+            total_score = float(self.model.score(board_features(board, player))[0])
+            return total_score, {'model': type(self.model).__name__, 'total_score': total_score}
 
         player_eval, player_components = self.evaluate_player(board, player)
         opponent = 'white' if player == 'black' else 'black'
@@ -150,62 +448,178 @@ class Agent():
         return total_score, score_components
 
     def select_move_pair(self, moves, board, player):
-        move_scores = dict()
-
         # Ensure moves is a set and does not contain integers
         if not isinstance(moves, (list, set)) or not all(isinstance(m, tuple) for m in moves):
             raise ValueError('Invalid moves format: expected a list or set of tuples.')
 
-        # Evaluate the pass move
-        move_scores[((0, 0, 0), (0, 0, 0))] = self.evaluate(board, player)
+        self.trace = self.tracer.start(self, board, player, moves) if self.tracer is not None else None
+        booked = self.traced('book', self.book.lookup, moves, board, player) if self.book is not None else None
+        source = None
+        if booked is not None:
+            best_move_pair, source = booked
+            best_move_score, best_move_components = self.evaluate_move_pair(board, best_move_pair, player)
+            best_move_components = dict(best_move_components, book=source)  # a copy, the original is cached
+        else:
+            best_move_pair, (best_move_score, best_move_components) = self.traced('search', self.search_moves, moves, board, player)
+
+        entry = {
+            'move': best_move_pair,
+            'score': best_move_score,
+            'components': best_move_components
+        }
+        self.log.append(entry)
+
+        if LOG_TO_FILE:
+            with open(self.log_file, 'a') as file:
+                file.write(json.dumps(entry) + '\n')
+
+        if self.trace is not None:
+            self.trace.finish(best_move_pair, best_move_score, source, best_move_components.get('search'))
+            self.trace = None
+
+        return best_move_pair
+
+    def search_moves(self, moves, board, player):
+        # the best pair under the configured search mode, with its (score, components)
+        if self.search == 'batch':
+            from batch_eval import search_batch  # needs numpy, which the default search doesn't
+            return search_batch(self, moves, board, player)
+        if self.search == 'expectimax':
+            from expectimax import ExpectimaxSearch
+            return ExpectimaxSearch(self, board, player, self.search_depth, self.time_budget).run(moves)
+        if self.search == 'parallel':
+            if self.parallel is None:
+                from parallel import ParallelSearch
+                self.parallel = ParallelSearch(self, self.workers)
+            return self.parallel.run(moves, board, player)
+        if self.search == 'pruned':
+            return self.search_pruned(moves, board, player)
+        return self.search_exhaustive(moves, board, player)
+
+    def traced(self, phase, function, *args):
+        # function(*args), timed under phase when the running search traces its phases
+        if self.trace is None or self.trace.phases is None:
+            return function(*args)
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.trace.add(phase, time.perf_counter() - start)
+
+    def generate_moves(self, board, mask_offgoals=False):
+        # board.get_valid_moves() for a search, timed as the 'generate' phase
+        return self.traced('generate', board.get_valid_moves, mask_offgoals)
+
+    def iter_move_pairs(self, moves, board, follow_ups=True):
+        # Yields the pass pair, every single move followed by a pass, and every (move, next_move) pair
+        # unless follow_ups is off, with the board sitting in the resulting position while the caller looks at it
+        self.nodes += 1
+        yield (PASS, PASS)
 
         # Create a set of moves without the pass move
         moves = set(moves)
-        moves.discard((0, 0, 0))
+        moves.discard(PASS)
 
         for move in moves:
+            yield from self.iter_follow_ups(move, board, follow_ups)
+
+    def iter_follow_ups(self, move, board, follow_ups=True):
+        # the pairs starting with move, in iter_move_pairs order
+        if not isinstance(move, tuple) or len(move) != 3:
+            raise ValueError('Invalid move format: each move should be a tuple of length 3.')
+
+        board.apply_move(move, switch_turn = False)
+        self.nodes += 1
+        yield (move, PASS)  # make one move then pass
+        next_moves = set(self.generate_moves(board)) if follow_ups else set()
+        next_moves.discard(PASS)
+
+        for next_move in next_moves:
+            if not isinstance(next_move, tuple) or len(next_move) != 3:
+                raise ValueError('Invalid next move format: each move should be a tuple of length 3.')
+
+            board.apply_move(next_move, switch_turn = False)
+            self.nodes += 1
+            yield (move, next_move)
+            board.undo_last_move()
+
+        board.undo_last_move()
+
+    def search_exhaustive(self, moves, board, player):
+        move_scores = {move_pair: self.score(board, player) for move_pair in self.iter_move_pairs(moves, board)}
+        best_move_pair = max(move_scores, key=move_scores.get)
+        return best_move_pair, self.evaluate_move_pair(board, best_move_pair, player)
+
+    def search_pruned(self, moves, board, player):
+        # search_exhaustive's answer, ties included, from far fewer leaves: first moves that save, capture or
+        # reach a goal go first, and follow-ups whose bound can't reach the best score so far are skipped
+        first_moves = set(moves)
+        first_moves.discard(PASS)
+        first_moves = list(first_moves)  # iter_move_pairs order, which decides ties
+
+        topology = board.topology
+        opponent = PLAYER_INDEX[player] ^ 1
+        locations = board.get_locations()
+        targets = {locations[slot] for slot in range(opponent * NUM_PIECES, (opponent + 1) * NUM_PIECES)}
+
+        def priority(move):
+            destination = move[1]
+            if destination == 'save':
+                return 3
+            tile = topology.index_of[destination]
+            if tile in targets and topology.is_field[tile]:
+                return 2
+            return 1 if topology.is_save[tile] else 0
+
+        self.nodes += 1  # the root, scored as the pass pair
+        best_move_pair, best_score, best_rank = (PASS, PASS), self.score(board, player), (-1, 0)
+        for i in sorted(range(len(first_moves)), key=lambda i: -priority(first_moves[i])):
+            move = first_moves[i]
             if not isinstance(move, tuple) or len(move) != 3:
                 raise ValueError('Invalid move format: each move should be a tuple of length 3.')
 
             board.apply_move(move, switch_turn = False)
-            move_scores[(move, (0, 0, 0))] = self.evaluate(board, player)  # make one move then pass
-            next_moves = set(board.get_valid_moves())
-            if not next_moves:
-                continue
-            next_moves.discard((0, 0, 0))
-
-            for next_move in next_moves:
-                if not isinstance(next_move, tuple) or len(next_move) != 3:
-                    raise ValueError('Invalid next move format: each move should be a tuple of length 3.')
-
+            self.nodes += 1
+            candidates = [(self.score(board, player), (i, 0), (move, PASS))]
+            self.evaluator.sync(board)
+            next_moves = set(self.generate_moves(board))
+            next_moves.discard(PASS)
+            bounds = sorted(((self.evaluator.bound_after(board, next_move, player), j, next_move)
+                             for j, next_move in enumerate(next_moves, 1)), key=lambda bound: -bound[0])
+
+            for bound, j, next_move in bounds:
+                if bound < max(best_score, candidates[0][0]) - BOUND_MARGIN:
+                    break
                 board.apply_move(next_move, switch_turn = False)
-                move_scores[(move, next_move)] = self.evaluate(board, player)
+                self.nodes += 1
+                candidates.append((self.score(board, player), (i, j), (move, next_move)))
                 board.undo_last_move()
-
             board.undo_last_move()
 
-        best_move_pair = max(move_scores, key=lambda k: move_scores[k][0])
-        best_move_score, best_move_components = move_scores[best_move_pair]
+            for score, rank, move_pair in candidates:
+                if score > best_score or (score == best_score and rank < best_rank):
+                    best_move_pair, best_score, best_rank = move_pair, score, rank
 
-        self.log.append({
-            'move': best_move_pair,
-            'score': best_move_score,
-            'components': best_move_components
-        })
-
-        if LOG_TO_FILE:
-            with open(self.log_file, 'w') as file:
-                file.write(json.dumps(self.log, indent=4))
-            print(f"Log updated with move: {best_move_pair}")
+        return best_move_pair, self.evaluate_move_pair(board, best_move_pair, player)
 
-        print(best_move_components)
-
-        return best_move_pair
+    def evaluate_move_pair(self, board, move_pair, player):
+        return self.after_move_pair(board, move_pair, self.evaluate, player)
 
+    def score_move_pair(self, board, move_pair, player):
+        return self.after_move_pair(board, move_pair, self.score, player)
 
+    def after_move_pair(self, board, move_pair, evaluate, player):
+        # evaluate(board, player) in the position move_pair leads to
+        played = [move for move in move_pair if move != PASS]
+        for move in played:
+            board.apply_move(move, switch_turn = False)
+        result = evaluate(board, player)
+        for _ in played:
+            board.undo_last_move()
+        return result
 
     def save_log_to_file(self):
-        return json.dumps(self.log, indent=4)
+        return json.dumps(list(self.log), indent=4)
 
 
 # agent tried to save a numbered piece when it wasn't in the midgame (but was one piece away from midgame)
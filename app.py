@@ -1,13 +1,14 @@
 import os
-import copy
 import logging
-from flask import Flask, request, jsonify, send_from_directory
+import time
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
-from game import Board
-from agent import Agent
+from metrics import get_metrics, profiled
+from sessions import DEFAULT_GAME, StaleVersion, make_pool
+from tracing import get_tracer
 
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
     format='%(asctime)s %(levelname)s %(message)s'
 )
 logger = logging.getLogger(__name__)
@@ -17,34 +18,59 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 app = Flask(__name__, static_folder=None)
 CORS(app)
 
-board = Board()
-agent = Agent()
+sessions = make_pool()  # one board and agent per X-Game-Id
+metrics = get_metrics()
+
+def game_id():
+    return request.headers.get('X-Game-Id', DEFAULT_GAME)
 
 @app.route('/select_moves', methods=['POST'])
 def select_moves():
+    # ?profile=1 adds a cProfile breakdown of the search to the response
+    start, stage = time.perf_counter(), None
     try:
         state = request.json
-        board.update_state(state)
-        moves = board.get_valid_moves(mask_offgoals=True)
-        if moves:
-            chosen = agent.select_move_pair(moves, board, board.current_player)
-            return jsonify({"move": chosen}), 200
-        return jsonify({"message": "No valid moves"}), 200
+        with sessions.session(game_id()) as session:
+            if request.args.get('profile') == '1':
+                body, breakdown = profiled(session.select_moves, state)
+                body['profile'] = breakdown
+            else:
+                body = session.select_moves(state)
+            stage = session.stage
+        return jsonify(body), 200
+    except StaleVersion as e:
+        return jsonify({"error": str(e), "resync": True}), 409
     except Exception as e:
         logger.error(e)
         return jsonify({"error": str(e)}), 500
+    finally:
+        metrics.observe('select_moves', stage, time.perf_counter() - start)
 
 @app.route('/evaluate_board', methods=['POST'])
 def evaluate_board():
+    start, stage = time.perf_counter(), None
     try:
         state = request.json
-        newb = copy.deepcopy(board)
-        newb.update_state(state)
-        _, val = agent.evaluate(newb, newb.current_player)
-        return jsonify({"eval": val}), 200
+        with sessions.session(game_id()) as session:
+            body = session.evaluate_board(state)
+            stage = session.stage
+        return jsonify(body), 200
+    except StaleVersion as e:
+        return jsonify({"error": str(e), "resync": True}), 409
     except Exception as e:
         logger.error(e)
         return jsonify({"error": str(e)}), 500
+    finally:
+        metrics.observe('evaluate_board', stage, time.perf_counter() - start)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/traces', methods=['GET'])
+def traces():
+    # the most recent traced searches, oldest first; empty unless AGENT_TRACE is set
+    return jsonify(list(get_tracer().recent)), 200
 
 @app.route('/', defaults={'path': 'index.html'})
 @app.route('/<path:path>')
@@ -0,0 +1,296 @@
+import asyncio
+import json
+import logging
+import mimetypes
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs
+from metrics import get_metrics, merge_hot_paths, profiled
+from sessions import DEFAULT_GAME, StaleVersion, make_pool
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SEARCH_WORKERS = int(os.environ.get('SEARCH_WORKERS', 0)) or os.cpu_count()
+MAX_PENDING_PER_WORKER = 16  # admitted requests per worker before new ones are turned away with a 503
+REQUEST_DEADLINE = 30.0  # seconds, unless the request sends X-Deadline-Ms
+ROUND_TRIP_WINDOW = 0.002  # seconds an /evaluate_board request waits for others to share its round trip
+ROUND_TRIP_SIZE = 32  # evaluations that are sent at once without waiting out the window
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'*'),
+    (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+]
+
+_shard = {}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def start_shard():
+    # runs once in each worker process; its games keep their boards and agents between requests
+    logging.disable(logging.CRITICAL)
+    _shard['sessions'] = make_pool()
+    get_metrics()
+
+
+def shard_select_moves(game_id, state, deadline, profile=False):
+    # The response body and the mover's game stage, for the latency histograms. A search that starts
+    # in time runs to the end even if the client has been sent a 504 meanwhile, and its position still
+    # becomes the session's version; the client never saw that version, so its next delta gets a 409
+    # and it resyncs with the full state.
+    if time.time() > deadline:
+        raise DeadlineExceeded()
+    with _shard['sessions'].session(game_id) as session:
+        if profile:
+            body, breakdown = profiled(session.select_moves, state)
+            body['profile'] = breakdown
+        else:
+            body = session.select_moves(state)
+        return body, session.stage
+
+
+def shard_evaluate_boards(requests):
+    # several evaluations coalesced into one round trip to the worker; each is still scored on its own
+    # (the response is the component breakdown, not just a total), and fails or expires on its own
+    results = []
+    for game_id, state, deadline in requests:
+        if time.time() > deadline:
+            results.append((504, {"error": "deadline exceeded"}, None))
+            continue
+        try:
+            with _shard['sessions'].session(game_id) as session:
+                results.append((200, session.evaluate_board(state), session.stage))
+        except StaleVersion as e:
+            results.append((409, {"error": str(e), "resync": True}, None))
+        except Exception as e:
+            results.append((500, {"error": str(e)}, None))
+    return results
+
+
+def call_on_loop(loop, callback, *args):
+    # worker futures finish on the executor's thread; one that outlives the server has no loop left to tell
+    if not loop.is_closed():
+        loop.call_soon_threadsafe(callback, *args)
+
+
+def shard_hot_paths():
+    return get_metrics().hot_paths()
+
+
+class SearchServer:
+    """Hands searches to a fixed set of single-process workers, one shard of the games each.
+
+    A game always goes to the same worker (by a hash of its id), so its session stays warm and its
+    requests run in the order they arrived, while games on different workers search in parallel.
+    /evaluate_board requests arriving within ROUND_TRIP_WINDOW of each other are coalesced into one round
+    trip per worker, which saves the per-call IPC but still scores each position separately: the response
+    is Agent.evaluate's component breakdown, which batch_eval's NumPy scorer doesn't produce. Requests past
+    MAX_PENDING_PER_WORKER per worker are refused rather than queued, and a request that is still
+    waiting when its deadline passes is answered with a 504 and never started.
+    A request keeps its admission slot until its worker is done with it, so a search that outlives
+    its 504 still counts against the limit.
+    """
+
+    def __init__(self, workers=SEARCH_WORKERS):
+        self.shards = [ProcessPoolExecutor(1, initializer=start_shard) for _ in range(workers)]
+        self.pending = [0] * workers
+        self.capacity = MAX_PENDING_PER_WORKER * workers
+        self.outbound = []  # /evaluate_board requests waiting for their round trip
+        self.round_trip_handle = None
+
+    def shard_of(self, game_id):
+        return zlib.crc32(game_id.encode()) % len(self.shards)
+
+    def queue_depth(self):
+        return {"pending": sum(self.pending), "per_worker": self.pending, "capacity": self.capacity,
+                "outbound": len(self.outbound)}
+
+    def admit(self, shard):
+        if self.pending[shard] >= MAX_PENDING_PER_WORKER:
+            return False
+        self.pending[shard] += 1
+        return True
+
+    def release(self, shard, requests=1):
+        self.pending[shard] -= requests
+
+    def submit(self, shard, requests, function, *args):
+        # the worker's future; the admission slots of its requests are given back on the event loop once
+        # the worker is done with them, not when their callers stop waiting
+        loop = asyncio.get_running_loop()
+        try:
+            job = self.shards[shard].submit(function, *args)
+        except Exception:
+            self.release(shard, requests)
+            raise
+        job.add_done_callback(lambda job: call_on_loop(loop, self.release, shard, requests))
+        return job
+
+    async def select_moves(self, shard, game_id, state, deadline, profile=False):
+        # takes over the slot admit() gave shard; shielded, so a timeout leaves the search to finish and release it
+        job = asyncio.wrap_future(self.submit(shard, 1, shard_select_moves, game_id, state, deadline, profile))
+        return (200, *await asyncio.wait_for(asyncio.shield(job), deadline - time.time()))
+
+    async def evaluate_board(self, shard, game_id, state, deadline):
+        # takes over the slot admit() gave shard, which is released once the round trip it joins is back
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+        self.outbound.append((shard, (game_id, state, deadline), result))
+        if len(self.outbound) >= ROUND_TRIP_SIZE:
+            self.send_round_trips()
+        elif self.round_trip_handle is None:
+            self.round_trip_handle = loop.call_later(ROUND_TRIP_WINDOW, self.send_round_trips)
+        try:
+            return await asyncio.wait_for(asyncio.shield(result), deadline - time.time())
+        except asyncio.TimeoutError:
+            result.cancel()  # still sent with its round trip, but the answer is dropped
+            raise
+
+    def send_round_trips(self):
+        if self.round_trip_handle is not None:
+            self.round_trip_handle.cancel()
+            self.round_trip_handle = None
+        outbound, self.outbound = self.outbound, []
+        loop = asyncio.get_running_loop()
+        for shard in sorted({shard for shard, _, _ in outbound}):
+            entries = [(request, result) for s, request, result in outbound if s == shard]
+            try:
+                job = self.submit(shard, len(entries), shard_evaluate_boards, [request for request, _ in entries])
+            except Exception as e:
+                for _, result in entries:
+                    if not result.done():
+                        result.set_exception(e)
+                continue
+            job.add_done_callback(lambda job, entries=entries: call_on_loop(loop, self.deliver, job, entries))
+
+    def deliver(self, job, entries):
+        # cancelled when close() shuts the workers down with the round trip still queued
+        error = RuntimeError('search worker shut down') if job.cancelled() else job.exception()
+        for i, (_, result) in enumerate(entries):
+            if result.done():
+                continue
+            if error is not None:
+                result.set_exception(error)
+            else:
+                result.set_result(job.result()[i])
+
+    async def hot_paths(self):
+        # every worker's engine counters, added up; each waits behind the searches already queued on its worker
+        loop = asyncio.get_running_loop()
+        return merge_hot_paths(await asyncio.gather(*(loop.run_in_executor(shard, shard_hot_paths)
+                                                      for shard in self.shards)))
+
+    def close(self):
+        for shard in self.shards:
+            shard.shutdown(wait=False, cancel_futures=True)
+
+
+_server = []
+
+
+def get_server():
+    # started on first use, so the worker processes aren't forked at import
+    if not _server:
+        _server.append(SearchServer())
+    return _server[0]
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def respond(send, status, body, content_type=b'application/json', headers=()):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+                + CORS_HEADERS + list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            get_server()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _server:
+                _server.pop().close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI front end with the same routes and JSON as app.py (run with e.g. `uvicorn asgi_app:app`)."""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    method, path = scope['method'], scope['path']
+    headers = dict(scope['headers'])
+    if method == 'OPTIONS':
+        return await respond(send, 200, b'', b'text/plain')
+
+    server = get_server()
+    if path == '/queue_depth':
+        return await respond(send, 200, server.queue_depth())
+    if path == '/metrics':
+        text = get_metrics().render(await server.hot_paths())
+        return await respond(send, 200, text.encode(), b'text/plain; version=0.0.4')
+
+    if method == 'POST' and path in ('/select_moves', '/evaluate_board'):
+        game_id = headers.get(b'x-game-id', DEFAULT_GAME.encode()).decode()
+        timeout = float(headers[b'x-deadline-ms']) / 1000 if b'x-deadline-ms' in headers else REQUEST_DEADLINE
+        deadline = time.time() + timeout
+        shard = server.shard_of(game_id)
+        try:
+            state = json.loads(await read_body(receive))
+        except ValueError as e:
+            return await respond(send, 400, {"error": str(e)})
+        if not server.admit(shard):
+            return await respond(send, 503, {"error": "server busy"}, headers=[(b'retry-after', b'1')])
+        depth = [(b'x-queue-depth', str(sum(server.pending)).encode())]
+        start, stage = time.perf_counter(), None
+        try:
+            # the server releases the admission slot when the worker is done, which can be after the response
+            if path == '/select_moves':
+                profile = parse_qs(scope.get('query_string', b'').decode()).get('profile') == ['1']
+                status, body, stage = await server.select_moves(shard, game_id, state, deadline, profile)
+            else:
+                status, body, stage = await server.evaluate_board(shard, game_id, state, deadline)
+        except (asyncio.TimeoutError, DeadlineExceeded):
+            status, body = 504, {"error": "deadline exceeded"}
+        except StaleVersion as e:
+            status, body = 409, {"error": str(e), "resync": True}
+        except Exception as e:
+            logger.error(e)
+            status, body = 500, {"error": str(e)}
+        finally:
+            get_metrics().observe(path.lstrip('/'), stage, time.perf_counter() - start)
+        return await respond(send, status, body, headers=depth)
+
+    # everything else is a file from the repository, as app.py serves it
+    filename = os.path.normpath(os.path.join(BASE_DIR, path.lstrip('/') or 'index.html'))
+    if method != 'GET' or not filename.startswith(BASE_DIR + os.sep) or not os.path.isfile(filename):
+        return await respond(send, 404, {"error": "not found"})
+    with open(filename, 'rb') as file:
+        content_type = (mimetypes.guess_type(filename)[0] or 'application/octet-stream').encode()
+        return await respond(send, 200, file.read(), content_type)
+
+
+if __name__ == '__main__':
+    import uvicorn  # optional; any ASGI server can run app
+    uvicorn.run(app, host='0.0.0.0', port=8000)
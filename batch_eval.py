@@ -0,0 +1,268 @@
+import numpy as np
+from agent import GAME_OVER_SCORE, PLAYERS
+from game import NUM_PIECES, PLAYER_INDEX, UNENTERED, SAVED
+
+ABSENT = -3  # pieces get_locations() reports as None
+STAGES = ['opening', 'midgame', 'endgame']
+RESCORE_TOLERANCE = 1e-6  # leaves this close to the best batch score are rescored exactly before choosing
+LEAF_TABLES_CACHED = 64  # weight sets with tables kept; tuning creates a new one every game
+
+_tables = {}
+
+
+class LeafTables:
+    """Per-location lookup arrays for one topology and one set of weights.
+
+    Locations are shifted into column indices: tiles keep their index, and the two racks and absent
+    pieces take the three columns after the last tile.
+    """
+
+    def __init__(self, topology, weights):
+        size = topology.size
+        self.size = size
+        self.home = topology.home
+        types = topology.types + ['unentered', 'saved', 'absent']
+        numbers = topology.numbers + [None] * 3
+        self.is_field = np.array([t == 'field' for t in types])
+        self.is_save = np.array([t == 'save' for t in types])
+        self.is_home = np.array([t == 'home' for t in types])
+        self.tile_number = np.array([n or 0 for n in numbers])
+        self.high_goal = np.array([weights['goal_bonuses'].get(n, 0) if n else 0 for n in numbers])
+
+        # bonus tables indexed by piece number
+        def by_number(table):
+            return np.array([0] + [table.get(number, 0) for number in range(1, NUM_PIECES + 1)])
+        self.number = np.arange(1, NUM_PIECES + 1)
+        self.goal_bonus = by_number(weights['goal_bonuses'])[self.number]
+        self.saved_bonus = by_number(weights['saved_bonuses'])[self.number]
+        self.near_bonus = by_number(weights['near_goal_bonuses'])[self.number]
+        self.blocked_bonus = by_number(weights['blocked_piece_penalties'])[self.number]
+        self.loose_bonus = by_number(weights['loose_piece_penalties'])[self.number]
+        self.captured_bonus = by_number(weights['captured_bonuses'])[self.number]
+        self.goal_class = np.where(self.number <= 6, self.number, 0)
+
+        # neighbour lists padded with a column past the last tile, which always reads as unreachable
+        degree = max(len(neighbors) for neighbors in topology.neighbors)
+        self.neighbor_index = np.array([neighbors + [size] * (degree - len(neighbors)) for neighbors in topology.neighbors])
+        self.goal_masks = np.array([[(topology.goal_masks[c] >> i) & 1 for i in range(size)] for c in range(7)], dtype=bool)
+
+
+def leaf_tables(topology, weights):
+    # the weights are kept alongside, so a new dict that reuses a freed one's id doesn't get its tables
+    key = (id(topology), id(weights))
+    cached = _tables.get(key)
+    if cached is None or cached[0] is not weights:
+        if len(_tables) >= LEAF_TABLES_CACHED:
+            _tables.clear()
+        cached = _tables[key] = (weights, LeafTables(topology, weights))
+    return cached[1]
+
+
+def column_of(locations, size):
+    columns = locations.copy()
+    columns[locations == UNENTERED] = size
+    columns[locations == SAVED] = size + 1
+    columns[locations == ABSENT] = size + 2
+    return columns
+
+
+def route_lengths(tables, locations, saveable, blocked):
+    # Goal distances for one player's pieces in every leaf. Leaves share a handful of blockade
+    # patterns, so relax distance-to-goal over the whole graph once per pattern and goal class,
+    # then look every piece up in that.
+    packed = np.ascontiguousarray(np.packbits(blocked, axis=1))
+    _, first, which = np.unique(packed.view(np.dtype((np.void, packed.shape[1]))).ravel(), return_index=True, return_inverse=True)
+    patterns = blocked[first]
+    allowed = (tables.is_field[:tables.size] | tables.is_save[:tables.size]) & ~patterns
+    to_goal = np.where(tables.goal_masks, 0, np.inf)[None].repeat(len(patterns), axis=0)
+    for _ in range(tables.size):
+        step = 1 + np.pad(to_goal, ((0, 0), (0, 0), (0, 1)), constant_values=np.inf)[..., tables.neighbor_index].min(axis=-1)
+        relaxed = np.where(tables.goal_masks, 0, np.where(allowed[:, None, :], np.minimum(to_goal, step), np.inf))
+        if np.array_equal(relaxed, to_goal):
+            break
+        to_goal = relaxed
+    from_start = 1 + np.pad(to_goal, ((0, 0), (0, 0), (0, 1)), constant_values=np.inf)[..., tables.neighbor_index].min(axis=-1)
+
+    start = np.where(locations >= 0, locations, tables.home)
+    distances = from_start[which.reshape(-1, 1), tables.goal_class, start]
+    distances[(locations == ABSENT) | saveable] = 0
+    return distances
+
+
+def piece_states(tables, locations, tile_counts, blocked):
+    # per-piece masks and route lengths for one player's pieces in every leaf
+    columns = column_of(locations, tables.size)
+    numbered = tables.number <= 6
+    present = locations != ABSENT
+    on_board = locations >= 0
+    saved = locations == SAVED
+    is_field = tables.is_field[columns]
+    is_save = tables.is_save[columns]
+    saveable = saved | (is_save & ((tables.number > 6) | (tables.number == tables.tile_number[columns])))
+    distances = route_lengths(tables, locations, saveable, blocked)
+    off_goal = present & ~saveable & numbered
+    far = distances > 6
+    return {
+        'columns': columns,
+        'numbered': numbered,
+        'distances': distances,
+        'saved': saved,
+        'saveable': saveable,
+        'high_goal': saveable & ~numbered & on_board,
+        'near': on_board & (distances >= 1) & (distances <= 6),
+        'far': far,
+        'unreachable': np.isinf(distances),
+        'off_goal': off_goal,
+        'far_from_goal': off_goal & far & on_board & (is_field | is_save),
+        'blocked': distances > 1000,
+        'loose': on_board & is_field & (np.take_along_axis(tile_counts, columns, axis=1) == 1),
+        'unentered': locations == UNENTERED,
+        'in_play': on_board & (is_field | tables.is_home[columns]),
+        'home': locations == tables.home,
+    }
+
+
+def player_terms(tables, locations, tile_counts, blocked):
+    # the IncrementalEvaluator terms, summed over one player's pieces, for every leaf at once
+    pieces = piece_states(tables, locations, tile_counts, blocked)
+    numbered = pieces['numbered']
+    distances = pieces['distances']
+    near = pieces['near']
+    far = pieces['far']
+    home = pieces['home']
+    high_goal = np.where(pieces['high_goal'], tables.high_goal[pieces['columns']], 0)
+
+    def total(mask, values=1):
+        return (mask * values).sum(axis=1)
+
+    return {
+        'saved_count': total(pieces['saved']),
+        'saved_bonus': total(pieces['saved'], tables.saved_bonus),
+        'goal_count': total(pieces['saveable']),
+        'goal_bonus': total(pieces['saveable'] & numbered, tables.goal_bonus),
+        'high_goal': high_goal.sum(axis=1),
+        'near_count': total(near),
+        'nearer_count': total(near & ~numbered & (distances <= 4)),
+        'near_bonus': total(near & numbered, tables.near_bonus),
+        'off_goal': total(pieces['off_goal'], tables.goal_bonus),
+        'far_from_goal': total(pieces['far_from_goal'], tables.goal_bonus),
+        'far_distance': np.where(far & ~pieces['unreachable'], distances, 0).sum(axis=1),
+        'unreachable': total(far & pieces['unreachable']),
+        'far_bonus': total(far & numbered, tables.goal_bonus),
+        'blocked_count': total(pieces['blocked']),
+        'blocked_bonus': total(pieces['blocked'] & numbered, tables.blocked_bonus),
+        'loose_count': total(pieces['loose']),
+        'loose_bonus': total(pieces['loose'] & numbered, tables.loose_bonus),
+        'unentered_count': total(pieces['unentered']),
+        'in_play_count': total(pieces['in_play']),
+        'home_count': total(home),
+        'captured_bonus': total(home & numbered, tables.captured_bonus),
+    }
+
+
+def player_scores(weights, terms, opponent_terms, stages, opponent_stages, to_move):
+    # IncrementalEvaluator.score_player over a column of leaves
+    total_distance = np.where(terms['unreachable'] > 0, 100, np.minimum(terms['far_distance'], 100))
+    total_distance = total_distance + terms['far_bonus'] / 10
+
+    opponent_board_pieces = opponent_terms['in_play_count'] + np.minimum(1, opponent_terms['unentered_count'])
+    loose_piece_bonus = terms['loose_bonus'] * (opponent_board_pieces / 14)
+    loose_piece_bonus = np.where(opponent_stages == STAGES.index('endgame'), -loose_piece_bonus, loose_piece_bonus)
+
+    stage_bonuses = np.array([weights['game_stage_bonuses'].get(stage, 0) for stage in STAGES])
+    penalty = np.where(terms['home_count'] > 0, 10000, 0) if to_move else 0
+
+    components = [
+        terms['saved_count'] * weights['saved_piece'],
+        terms['saved_bonus'],
+        terms['goal_count'] * weights['goal_piece'],
+        terms['goal_bonus'],
+        opponent_terms['home_count'] * weights['captured_opponent_piece'],
+        opponent_terms['captured_bonus'],
+        terms['near_count'] * weights['near_goal_piece'],
+        terms['nearer_count'] * weights['nearer_goal_piece'],
+        terms['near_bonus'],
+        terms['blocked_count'] * weights['blocked_piece'],
+        terms['blocked_bonus'],
+        terms['loose_count'] * weights['loose_piece'],
+        loose_piece_bonus,
+        total_distance * weights['distance_penalty'],
+        terms['unentered_count'] * weights['unentered_piece'],
+        -terms['off_goal'],
+        -terms['far_from_goal'],
+        terms['high_goal'] * weights['high_goal_penalty'],
+        stage_bonuses[stages],
+    ]
+    # add in the same order as score_player so the floats agree
+    total = 0
+    for component in components:
+        total = total + component
+    return total - penalty
+
+
+def split_players(tables, locations):
+    # each player's columns of an (n, 24) location matrix with the tiles the other player blocks for it,
+    # and the piece count on every column from both players
+    size = tables.size
+    rows = np.arange(len(locations))[:, None]
+    sides = []
+    all_counts = np.zeros((len(locations), size + 3), dtype=int)
+    for p in range(len(PLAYERS)):
+        own = locations[:, p * NUM_PIECES:(p + 1) * NUM_PIECES]
+        counts = np.zeros((len(locations), size + 3), dtype=int)
+        np.add.at(counts, (rows, column_of(own, size)), 1)
+        all_counts += counts
+        sides.append((own, tables.is_field[:size] & (counts[:, :size] > 1)))
+    return [(own, sides[1 - p][1]) for p, (own, _) in enumerate(sides)], all_counts
+
+
+def finished_scores(scores, locations, player):
+    # finished games score like check_game_over: white is checked first
+    p = PLAYER_INDEX[player]
+    saved = [(locations[:, q * NUM_PIECES:(q + 1) * NUM_PIECES] == SAVED).sum(axis=1) for q in range(len(PLAYERS))]
+    for winner in range(len(PLAYERS)):
+        won = (saved[winner] == NUM_PIECES) & ~((winner == 1) & (saved[0] == NUM_PIECES))
+        factor = 1 if winner == p else -1
+        scores = np.where(won, factor * (NUM_PIECES - saved[1 - winner]) * GAME_OVER_SCORE, scores)
+    return scores
+
+
+def score_leaves(agent, topology, locations, stages, current_player, player):
+    # Agent.evaluate for every row of an (n, 24) location matrix with (n, 2) stage codes
+    if agent.model is not None:
+        from features import extract_features
+        scores = agent.model.score(extract_features(topology, locations, stages, current_player, player))
+        return finished_scores(scores, locations, player)
+
+    tables = leaf_tables(topology, agent.weights)
+    sides, all_counts = split_players(tables, locations)
+    terms = [player_terms(tables, own, all_counts, blocked) for own, blocked in sides]
+
+    p = PLAYER_INDEX[player]
+    o = 1 - p
+    weights = agent.weights
+    player_eval = player_scores(weights, terms[p], terms[o], stages[:, p], stages[:, o], current_player == PLAYERS[p])
+    opponent_eval = player_scores(weights, terms[o], terms[p], stages[:, o], stages[:, p], current_player == PLAYERS[o])
+    return finished_scores(player_eval - opponent_eval, locations, player)
+
+
+def search_batch(agent, moves, board, player):
+    # Same leaves and tie-break as Agent.search_exhaustive, scored in one pass instead of one by one
+    move_pairs = []
+    locations = []
+    stages = []
+    for move_pair in agent.iter_move_pairs(moves, board):
+        move_pairs.append(move_pair)
+        locations.append([ABSENT if location is None else location for location in board.get_locations()])
+        stages.append([STAGES.index(board.game_stages[p]) for p in PLAYERS])
+
+    scores = score_leaves(agent, board.topology, np.array(locations, dtype=np.int16),
+                          np.array(stages), board.current_player, player)
+
+    # pick among the near-best leaves with the scalar evaluator; only the choice gets the log components
+    best_move_pair, best = None, None
+    for i in np.flatnonzero(scores >= scores.max() - RESCORE_TOLERANCE):
+        score = agent.score_move_pair(board, move_pairs[i], player)
+        if best is None or score > best:
+            best_move_pair, best = move_pairs[i], score
+    return best_move_pair, agent.evaluate_move_pair(board, best_move_pair, player)
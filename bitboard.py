@@ -0,0 +1,452 @@
+import random
+from array import array
+
+from game import (Die, NUM_PIECES, PLAYER_INDEX, UNENTERED, SAVED, GAME_STAGES, SNAPSHOT_RACKS, SNAPSHOT_DICE,
+                  SNAPSHOT_TURN, SNAPSHOT_FIRST_MOVE, SNAPSHOT_STAGES, SNAPSHOT_SIZE, piece_slot)
+from topology import load_topology, iter_bits
+
+PLAYERS = ['white', 'black']
+
+
+class BitBoard:
+    """Compact engine backend with the same move API as game.Board.
+
+    Pieces are addressed by slot (see game.piece_slot) and their locations live in a flat list:
+    a tile index, UNENTERED or SAVED. Occupancy is kept as per-player tile counts plus 70-bit
+    masks, so move generation and apply/undo are a handful of list writes and bit operations.
+    The disabled "save an opponent's piece" move (destination 0) isn't modelled.
+    """
+
+    __slots__ = ('topology', 'players', 'dice', 'home', 'locations', 'counts', 'occupied', 'stacked', 'entry_order',
+                 'entered', 'current_player', 'game_stages', 'first_move', 'moves', 'piece_hash')
+
+    def __init__(self, filename='tile_neighbors.json'):
+        self.topology = load_topology(filename)
+        self.players = PLAYERS
+        self.dice = [Die(self), Die(self)]
+        self.home = self.topology.home
+        self.locations = [UNENTERED] * (2 * NUM_PIECES)
+        self.counts = [[0] * self.topology.size for _ in PLAYERS]
+        self.occupied = [0, 0]  # tiles holding at least one of the player's pieces
+        self.stacked = [0, 0]   # field tiles holding two or more of the player's pieces
+        self.entry_order = [[], []]  # unentered slots in rack order, entered[p] of them already gone
+        self.entered = [0, 0]
+        self.current_player = 'white'
+        self.game_stages = {'white': 'opening', 'black': 'opening'}
+        self.first_move = None  # (slot, origin tile index or None)
+        self.moves = []
+        self.piece_hash = self.topology.position_hash(self.locations, False)
+
+        for player in range(2):
+            slots = [player * NUM_PIECES + i for i in range(NUM_PIECES)]
+            random.shuffle(slots)
+            self.entry_order[player] = slots
+
+    @classmethod
+    def from_board(cls, board):
+        bitboard = cls()
+        bitboard.load_board(board)
+        return bitboard
+
+    def load_board(self, board):
+        # copy the position of a game.Board, including the rack order and the pending first move
+        self.from_array(board.to_array())
+
+    def to_board(self, board):
+        # write this position back into a game.Board
+        board.from_array(self.to_array())
+
+    def to_array(self):
+        # same layout as game.Board.to_array, with pieces in slot order
+        data = array('b', [-1]) * SNAPSHOT_SIZE
+        for slot, location in enumerate(self.locations):
+            data[2 * slot] = slot
+            data[2 * slot + 1] = location
+        for p in range(2):
+            for i, slot in enumerate(self.entry_order[p][self.entered[p]:]):
+                data[SNAPSHOT_RACKS + p * NUM_PIECES + i] = slot
+        for i, die in enumerate(self.dice):
+            data[SNAPSHOT_DICE + i] = die.number
+            data[SNAPSHOT_DICE + 2 + i] = die.used
+        data[SNAPSHOT_TURN] = PLAYER_INDEX[self.current_player]
+        if self.first_move:
+            slot, origin = self.first_move
+            data[SNAPSHOT_FIRST_MOVE] = slot
+            data[SNAPSHOT_FIRST_MOVE + 1] = -1 if origin is None else origin
+        for i, player in enumerate(PLAYERS):
+            data[SNAPSHOT_STAGES + i] = GAME_STAGES.index(self.game_stages[player])
+        return data
+
+    def from_array(self, data):
+        self._reset()
+        for i in range(0, SNAPSHOT_RACKS, 2):
+            slot, location = data[i], data[i + 1]
+            if location >= 0:
+                self._place(slot, location)
+            elif location == SAVED:
+                self.locations[slot] = SAVED
+        for p in range(2):
+            self.entry_order[p] = [slot for slot in data[SNAPSHOT_RACKS + p * NUM_PIECES:SNAPSHOT_RACKS + (p + 1) * NUM_PIECES]
+                                   if slot >= 0]
+
+        for i, die in enumerate(self.dice):
+            die.number = data[SNAPSHOT_DICE + i]
+            die.used = bool(data[SNAPSHOT_DICE + 2 + i])
+        self.current_player = PLAYERS[data[SNAPSHOT_TURN]]
+        slot, origin = data[SNAPSHOT_FIRST_MOVE], data[SNAPSHOT_FIRST_MOVE + 1]
+        if slot >= 0:
+            self.first_move = (slot, origin if origin >= 0 else None)
+        self.game_stages = {player: GAME_STAGES[data[SNAPSHOT_STAGES + i]] for i, player in enumerate(PLAYERS)}
+        self.piece_hash = self.topology.position_hash(self.locations, False)
+
+    def update_state(self, game_state_details):
+        # same JSON contract as game.Board.update_state
+        self._reset()
+        self.current_player = game_state_details['currentTurn']
+        for die, die_details in zip(self.dice, game_state_details['dice']):
+            die.number = die_details['value']
+            die.used = die_details['used']
+
+        racks = game_state_details['racks']
+        for player, key in enumerate(['whiteUnentered', 'blackUnentered']):
+            self.entry_order[player] = [piece_slot(PLAYERS[player], p['number']) for p in racks[key]]
+        for player, key in enumerate(['whiteSaved', 'blackSaved']):
+            for p in racks[key]:
+                self.locations[piece_slot(PLAYERS[player], p['number'])] = SAVED
+
+        for piece_details in game_state_details['boardPieces']:
+            slot = piece_slot(piece_details['color'], piece_details['number'])
+            tile = self.topology.index_of[(piece_details['tile']['ring'], piece_details['tile']['sector'])]
+            self._place(slot, tile)
+            if 'reachableBySum' in piece_details:
+                self.first_move = (slot, tile)
+
+        self.piece_hash = self.topology.position_hash(self.locations, False)
+        self.game_stages[self.current_player] = self.get_game_stage(self.current_player)
+
+    def apply_delta(self, delta):
+        # same delta contract as game.Board.apply_delta
+        self.moves = []
+        self.current_player = delta['currentTurn']
+        for die, die_details in zip(self.dice, delta['dice']):
+            die.number = die_details['value']
+            die.used = die_details['used']
+
+        for piece_details in delta['pieces']:
+            slot = piece_slot(piece_details['color'], piece_details['number'])
+            player = slot // NUM_PIECES
+            origin = self.locations[slot]
+            if origin >= 0:
+                self._lift(slot)
+            elif origin == UNENTERED:
+                self.entry_order[player] = [s for s in self.entry_order[player][self.entered[player]:] if s != slot]
+                self.entered[player] = 0
+            if 'tile' in piece_details:
+                self._place(slot, self.topology.index_of[(piece_details['tile']['ring'], piece_details['tile']['sector'])])
+            elif piece_details['rack'] == 'saved':
+                self.locations[slot] = SAVED
+            else:
+                self.locations[slot] = UNENTERED
+                self.entry_order[player].append(slot)
+            piece_keys = self.topology.piece_keys[slot]
+            self.piece_hash ^= piece_keys[origin] ^ piece_keys[self.locations[slot]]
+
+        self.first_move = None
+        if delta.get('firstMove'):
+            slot = piece_slot(delta['firstMove']['color'], delta['firstMove']['number'])
+            self.first_move = (slot, self.locations[slot] if self.locations[slot] >= 0 else None)
+        self.game_stages[self.current_player] = self.get_game_stage(self.current_player)
+
+    def _reset(self):
+        self.locations = [UNENTERED] * (2 * NUM_PIECES)
+        self.counts = [[0] * self.topology.size for _ in PLAYERS]
+        self.occupied = [0, 0]
+        self.stacked = [0, 0]
+        self.entry_order = [[], []]
+        self.entered = [0, 0]
+        self.first_move = None
+        self.moves = []
+
+    def _place(self, slot, tile):
+        player = slot // NUM_PIECES
+        self.locations[slot] = tile
+        counts = self.counts[player]
+        counts[tile] += 1
+        self.occupied[player] |= 1 << tile
+        if counts[tile] == 2 and self.topology.is_field[tile]:
+            self.stacked[player] |= 1 << tile
+
+    def _lift(self, slot):
+        player = slot // NUM_PIECES
+        tile = self.locations[slot]
+        counts = self.counts[player]
+        counts[tile] -= 1
+        if counts[tile] == 0:
+            self.occupied[player] &= ~(1 << tile)
+        elif counts[tile] == 1:
+            self.stacked[player] &= ~(1 << tile)
+
+    def get_locations(self):
+        return self.locations
+
+    def get_hash(self):
+        return self.piece_hash ^ (self.topology.side_key if self.current_player == 'black' else 0)
+
+    def get_blocked_mask(self, player=None):
+        if not player:
+            player = self.current_player
+        return self.stacked[1 - PLAYER_INDEX[player]]
+
+    def count_unentered(self, player):
+        p = PLAYER_INDEX[player]
+        return len(self.entry_order[p]) - self.entered[p]
+
+    def get_unentered_slots(self, player):
+        p = PLAYER_INDEX[player]
+        return self.entry_order[p][self.entered[p]:]
+
+    def can_be_saved(self, slot):
+        location = self.locations[slot]
+        if location == SAVED:
+            return True
+        if location >= 0 and self.topology.is_save[location]:
+            number = slot % NUM_PIECES + 1
+            return number > 6 or number == self.topology.numbers[location]
+        return False
+
+    def get_game_stage(self, player):
+        p = PLAYER_INDEX[player]
+        if len(self.entry_order[p]) > self.entered[p]:
+            return 'opening'
+        if all(self.can_be_saved(slot) for slot in range(p * NUM_PIECES, (p + 1) * NUM_PIECES)):
+            return 'endgame'
+        return 'midgame'
+
+    def switch_turn(self):
+        self.first_move = None
+        for die in self.dice:
+            die.roll()
+        self.current_player = 'white' if self.current_player == 'black' else 'black'
+
+    def start_turn(self, player, rolls):
+        # see game.Board.start_turn
+        self.first_move = None
+        for die, number in zip(self.dice, rolls):
+            die.number = number
+            die.used = False
+        self.current_player = player
+        self.game_stages[player] = self.get_game_stage(player)
+
+    def save_turn(self):
+        return (self.current_player, [(die.number, die.used) for die in self.dice], self.first_move, dict(self.game_stages))
+
+    def restore_turn(self, turn):
+        self.current_player, dice, self.first_move, game_stages = turn
+        for die, (number, used) in zip(self.dice, dice):
+            die.number = number
+            die.used = used
+        self.game_stages.update(game_stages)
+
+    def check_game_over(self):
+        saved = [0, 0]
+        for slot, location in enumerate(self.locations):
+            if location == SAVED:
+                saved[slot // NUM_PIECES] += 1
+        if saved[0] == NUM_PIECES:
+            return 'white', NUM_PIECES - saved[1]
+        if saved[1] == NUM_PIECES:
+            return 'black', NUM_PIECES - saved[0]
+        return None, None
+
+    def must_move_unentered(self):
+        p = PLAYER_INDEX[self.current_player]
+        if len(self.entry_order[p]) == self.entered[p]:
+            return False
+        if self.counts[p][self.home]:
+            return False
+        if self.first_move:
+            return False
+        return True
+
+    def get_saving_die(self, slot):
+        player = PLAYERS[slot // NUM_PIECES]
+        if self.game_stages[player] == 'opening':
+            return False
+
+        number = slot % NUM_PIECES + 1
+        location = self.locations[slot]
+        if location < 0 or not self.topology.is_save[location]:
+            return None
+        goal_number = self.topology.numbers[location]
+        if not (number > 6 or number == goal_number):
+            return None
+
+        if self.game_stages[player] == 'endgame' and number > 6:
+            occupied_goals = self.occupied[slot // NUM_PIECES] & self.topology.save_mask
+            highest_occupied_goal_number = max((self.topology.numbers[i] for i in iter_bits(occupied_goals)), default=0)
+            valid_dice = [die for die in self.dice if (not die.used) and die.number == goal_number or (die.number > goal_number and goal_number >= highest_occupied_goal_number)]
+        else:
+            valid_dice = [die for die in self.dice if (not die.used) and die.number == goal_number]
+
+        if valid_dice:
+            matching_die = next((die for die in valid_dice if die.number == goal_number), None)
+            die = matching_die if matching_die else max(valid_dice, key=lambda die: die.number)
+            return die.number
+        return False
+
+    def iter_piece_moves(self, slot, mask_offgoals=False):
+        # see game.Board.iter_piece_moves
+        location = self.locations[slot]
+        start = self.home if location == UNENTERED else location
+
+        blocked = self.get_blocked_mask()
+        reachable_by_sum = None
+        if self.first_move and self.first_move[0] == slot:
+            origin = self.first_move[1]
+            reachable_by_sum = self.topology.reachable_mask(self.home if origin is None else origin,
+                                                            self.dice[0].number + self.dice[1].number, blocked)
+
+        player = PLAYERS[slot // NUM_PIECES]
+        save_roll = None
+        if location >= 0 and self.topology.is_save[location] and self.game_stages[player] != 'opening':
+            save_roll = self.get_saving_die(slot)
+
+        keys = self.topology.keys
+        is_save = self.topology.is_save
+        piece_id = (player, slot % NUM_PIECES + 1)
+        offgoal_masked = mask_offgoals and self.can_be_saved(slot)
+        rolls = [self.dice[0].number] if self.dice[0].number == self.dice[1].number else [die.number for die in self.dice]
+        for roll in rolls:
+            if any(not die.used and die.number == roll for die in self.dice):
+                reachable = self.topology.reachable_mask(start, roll, blocked)
+                if reachable_by_sum is not None:
+                    reachable &= reachable_by_sum
+                for destination in iter_bits(reachable):
+                    if offgoal_masked and (piece_id[1] <= 6 or roll != 4 or not is_save[destination]):
+                        continue
+                    yield (piece_id, keys[destination], roll)
+            if save_roll == roll:
+                yield (piece_id, 'save', roll)
+
+    def get_movable_slots(self):
+        p = PLAYER_INDEX[self.current_player]
+        own = range(p * NUM_PIECES, (p + 1) * NUM_PIECES)
+        if self.counts[p][self.home]:
+            return [slot for slot in own if self.locations[slot] == self.home]
+        if self.must_move_unentered():
+            return [self.entry_order[p][self.entered[p]]]
+        passable = self.topology.passable_mask
+        slots = [slot for slot in own if self.locations[slot] >= 0 and (passable >> self.locations[slot]) & 1]
+        if self.entered[p] < len(self.entry_order[p]):
+            slots.append(self.entry_order[p][self.entered[p]])
+        return slots
+
+    def iter_valid_moves(self, mask_offgoals=False):
+        # see game.Board.iter_valid_moves
+        if self.dice[0].used and self.dice[1].used:
+            return
+        for slot in self.get_movable_slots():
+            yield from self.iter_piece_moves(slot, mask_offgoals)
+
+    def get_valid_moves(self, mask_offgoals=False):
+        if self.dice[0].used and self.dice[1].used:
+            return []
+        tuples_list = list(self.iter_valid_moves(mask_offgoals))
+        tuples_list.append((0, 0, 0))
+        return tuples_list
+
+    def has_valid_move(self, mask_offgoals=False):
+        return next(self.iter_valid_moves(mask_offgoals), None) is not None
+
+    def can_save(self):
+        if self.dice[0].used and self.dice[1].used:
+            return False
+        return any(self.get_saving_die(slot) for slot in self.get_movable_slots() if self.locations[slot] >= 0)
+
+    def apply_move(self, move, switch_turn=True):
+        piece_id, destination, roll = move
+
+        if move == (0, 0, 0):
+            self.first_move = None
+            self.current_player = 'white' if self.current_player == 'black' else 'black'
+            return
+
+        slot = piece_slot(*piece_id)
+        player = slot // NUM_PIECES
+        origin = self.locations[slot]
+        captured = None
+
+        if destination == 'save':
+            self._lift(slot)
+            self.locations[slot] = SAVED
+        else:
+            tile = self.topology.index_of[destination]
+            if origin == UNENTERED:
+                self.entered[player] += 1
+            else:
+                self._lift(slot)
+
+            if not self.first_move:
+                self.first_move = (slot, origin if origin >= 0 else None)
+
+            opponent = 1 - player
+            if self.topology.is_field[tile] and (self.occupied[opponent] >> tile) & 1:
+                captured = next(s for s in range(opponent * NUM_PIECES, (opponent + 1) * NUM_PIECES) if self.locations[s] == tile)
+                self._lift(captured)
+                self._place(captured, self.home)
+
+            self._place(slot, tile)
+
+        piece_keys = self.topology.piece_keys[slot]
+        self.piece_hash ^= piece_keys[origin] ^ piece_keys[self.locations[slot]]
+        if captured is not None:
+            captured_keys = self.topology.piece_keys[captured]
+            self.piece_hash ^= captured_keys[tile] ^ captured_keys[self.home]
+
+        if roll == self.dice[0].number and not self.dice[0].used:
+            self.dice[0].used = True
+        elif roll == self.dice[1].number and not self.dice[1].used:
+            self.dice[1].used = True
+
+        self.game_stages[self.current_player] = self.get_game_stage(self.current_player)
+        self.moves.append((slot, origin, destination, captured, roll))
+
+        if switch_turn and all(die.used for die in self.dice):
+            self.switch_turn()
+
+    def undo_last_move(self):
+        if not self.moves:
+            return
+
+        slot, origin, destination, captured, roll = self.moves.pop()
+        player = slot // NUM_PIECES
+        piece_keys = self.topology.piece_keys[slot]
+        self.piece_hash ^= piece_keys[origin] ^ piece_keys[self.locations[slot]]
+
+        if destination == 'save':
+            self._place(slot, origin)
+        else:
+            tile = self.locations[slot]
+            self._lift(slot)
+            if origin == UNENTERED:
+                self.entered[player] -= 1
+                self.locations[slot] = UNENTERED
+            else:
+                self._place(slot, origin)
+
+            if captured is not None:
+                self._lift(captured)
+                self._place(captured, tile)
+                captured_keys = self.topology.piece_keys[captured]
+                self.piece_hash ^= captured_keys[tile] ^ captured_keys[self.home]
+
+        if roll == self.dice[0].number and self.dice[0].used:
+            self.dice[0].used = False
+        elif roll == self.dice[1].number and self.dice[1].used:
+            self.dice[1].used = False
+
+        if sum(not die.used for die in self.dice) == 2:
+            self.first_move = None
+
+        self.current_player = PLAYERS[player]
+        self.game_stages[self.current_player] = self.get_game_stage(self.current_player)
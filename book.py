@@ -0,0 +1,313 @@
+import argparse
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+import time
+from array import array
+from agent import Agent, PASS
+from bitboard import BitBoard
+from game import NUM_PIECES, PLAYER_INDEX, UNENTERED, SAVED, SNAPSHOT_RACKS, SNAPSHOT_DICE, SNAPSHOT_TURN, SNAPSHOT_SIZE
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+OPENING_BOOK_FILE = 'opening_book.bin'
+TABLEBASE_FILE = 'tablebase.bin'
+BOOK_MAGIC = b'BKV1'
+HEADER = struct.Struct('<4sI')  # magic, record count
+RECORD = struct.Struct('<Q8bf')  # position key, both moves as (source, number, destination, roll), score or expected turns
+ROLLS = [(a, b) for a in range(1, 7) for b in range(a, 7)]  # dice are keyed sorted, so 21 rolls cover all 36
+TABLEBASE_PIECES = 4  # bear-offs are solved for up to this many unsaved pieces
+BOOK_SEARCHES = ['exhaustive', 'batch', 'parallel', 'pruned']  # the searches whose pairs the files were built from
+
+_books = []
+
+
+def stable_key(*parts):
+    # 64-bit key that is the same in every process, unlike hash() on strings
+    return int.from_bytes(hashlib.blake2b(repr(parts).encode(), digest_size=8).digest(), 'little')
+
+
+def opening_key(board, player, rolls):
+    # Positions are found by their Zobrist hash, but the turn also depends on the dice, which of the
+    # mover's pieces enter next and the stored game stages the evaluation reads
+    return stable_key('opening', board.get_hash(), rolls, tuple(board.get_unentered_slots(player)[:2]),
+                      board.game_stages['white'], board.game_stages['black'])
+
+
+def bear_off_state(board, player):
+    # The mover's unsaved pieces as sorted (goal number, numbered above 6) pairs, or None if the position isn't
+    # a bear-off the tablebase covers. Pieces above 6 all save by the same rules, so which one is where
+    # doesn't matter; blockers would cut routes between goals, so positions with any are left to the search.
+    if board.game_stages[player] != 'endgame' or board.get_blocked_mask(player):
+        return None
+    p = PLAYER_INDEX[player]
+    locations = board.get_locations()
+    state = tuple(sorted((board.topology.numbers[locations[slot]], slot % NUM_PIECES >= 6)
+                         for slot in range(p * NUM_PIECES, (p + 1) * NUM_PIECES) if locations[slot] != SAVED))
+    return state if len(state) <= TABLEBASE_PIECES else None
+
+
+def tablebase_key(state, rolls):
+    return stable_key('tablebase', state, rolls)
+
+
+def encode_move(board, move, any_high=False):
+    # (source location, piece number, destination, roll); 0 numbers any piece above 6 and a 0 roll is the pass
+    if move == PASS:
+        return (0, 0, 0, 0)
+    (player, number), destination, roll = move
+    source = board.get_locations()[PLAYER_INDEX[player] * NUM_PIECES + number - 1]
+    destination = SAVED if destination == 'save' else board.topology.index_of[destination]
+    return (source, 0 if any_high and number > 6 else number, destination, roll)
+
+
+def encode_pair(board, move_pair, any_high=False):
+    first, second = move_pair
+    codes = encode_move(board, first, any_high)
+    if first == PASS:
+        return codes + encode_move(board, second, any_high)
+    board.apply_move(first, switch_turn = False)
+    codes += encode_move(board, second, any_high)
+    board.undo_last_move()
+    return codes
+
+
+def decode_move(board, player, codes):
+    source, number, destination, roll = codes
+    if roll == 0:
+        return PASS
+    p = PLAYER_INDEX[player]
+    locations = board.get_locations()
+    for slot in range(p * NUM_PIECES, (p + 1) * NUM_PIECES):
+        piece_number = slot % NUM_PIECES + 1
+        if locations[slot] == source and (piece_number == number if number else piece_number > 6):
+            return ((player, piece_number), 'save' if destination == SAVED else board.topology.keys[destination], roll)
+    return None
+
+
+def decode_pair(board, player, moves, codes):
+    # the booked pair as moves on this board, or None unless both are legal here
+    first = decode_move(board, player, codes[:4])
+    if first is None or first not in moves:
+        return None
+    if first == PASS:
+        return PASS, PASS
+    board.apply_move(first, switch_turn = False)
+    second = decode_move(board, player, codes[4:])
+    legal = second is not None and (second == PASS or any(move == second for move in board.iter_valid_moves()))
+    board.undo_last_move()
+    return (first, second) if legal else None
+
+
+class BookFile:
+    """Read-only table of position key -> (move codes, value), memory-mapped from a file of sorted fixed-size records.
+
+    Lookups are a binary search over the mapping, so opening the file costs nothing up front and
+    processes serving from the same file share its pages.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.data)
+        if magic != BOOK_MAGIC or len(self.data) != HEADER.size + self.count * RECORD.size:
+            raise ValueError(f'{filename} is not a book file')
+
+    def get(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = RECORD.unpack_from(self.data, HEADER.size + mid * RECORD.size)
+            if record[0] == key:
+                return record[1:9], record[9]
+            if record[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.data.close()
+
+
+def write_book(filename, entries):
+    # entries maps key -> (eight move codes, value)
+    with open(filename, 'wb') as file:
+        file.write(HEADER.pack(BOOK_MAGIC, len(entries)))
+        for key in sorted(entries):
+            codes, value = entries[key]
+            file.write(RECORD.pack(key, *codes, value))
+
+
+class Book:
+    """Opening book and bear-off tablebase lookups for Agent.select_move_pair.
+
+    Only turns that haven't started are looked up. A booked pair is checked against the moves
+    the board offers and dropped if either move isn't legal, so a stale or foreign file can cost a
+    search but never an illegal move.
+    """
+
+    def __init__(self, openings=None, tablebase=None):
+        self.openings = openings
+        self.tablebase = tablebase
+        self.hits = {'opening': 0, 'tablebase': 0}
+
+    def lookup(self, moves, board, player):
+        # (move pair, 'opening' or 'tablebase'), or None to search
+        if any(die.used for die in board.dice):
+            return None
+        rolls = tuple(sorted(die.number for die in board.dice))
+        state = bear_off_state(board, player) if self.tablebase is not None else None
+        if state is not None:
+            source, found = 'tablebase', self.tablebase.get(tablebase_key(state, rolls))
+        elif self.openings is not None and board.game_stages[player] == 'opening':
+            source, found = 'opening', self.openings.get(opening_key(board, player, rolls))
+        else:
+            return None
+        move_pair = decode_pair(board, player, moves, found[0]) if found else None
+        if move_pair is None:
+            return None
+        self.hits[source] += 1
+        return move_pair, source
+
+
+def load_book():
+    # the shipped files, opened once per process; None when neither has been generated
+    if not _books:
+        files = [os.path.join(BASE_DIR, name) for name in (OPENING_BOOK_FILE, TABLEBASE_FILE)]
+        openings, tablebase = [BookFile(name) if os.path.exists(name) else None for name in files]
+        _books.append(Book(openings, tablebase) if openings or tablebase else None)
+    return _books[0]
+
+
+def snapshot(locations, racks, player, rolls):
+    # to_array layout for a position at the start of a turn; pieces without a location are saved
+    data = array('b', [-1]) * SNAPSHOT_SIZE
+    for slot in range(2 * NUM_PIECES):
+        data[2 * slot] = slot
+        data[2 * slot + 1] = locations.get(slot, SAVED)
+    for p, rack in enumerate(racks):
+        for i, slot in enumerate(rack):
+            data[SNAPSHOT_RACKS + p * NUM_PIECES + i] = slot
+    data[SNAPSHOT_DICE:SNAPSHOT_DICE + 4] = array('b', [*rolls, 0, 0])
+    data[SNAPSHOT_TURN] = PLAYER_INDEX[player]
+    data[-2:] = array('b', [0, 0])
+    return data
+
+
+def turn_board(board, data, player, rolls):
+    board.from_array(data)
+    board.start_turn(player, rolls)
+    return board
+
+
+def best_pair(agent, board, player, moves):
+    # The pair the searches pick, found by scoring every leaf. Ties go to the smallest encoding rather than
+    # to set iteration order, which changes with string hashing, so a rebuild reproduces the file byte for byte.
+    scores = {move_pair: agent.score(board, player) for move_pair in agent.iter_move_pairs(moves, board)}
+    best = max(scores.values())
+    return min((move_pair for move_pair, score in scores.items() if score == best),
+               key=lambda move_pair: encode_pair(board, move_pair))
+
+
+def build_openings():
+    # Every first turn of the game: white's next two pieces to enter, in every order, under every roll. Later
+    # opening positions rarely repeat (none did twice in 100 self-play games), so they're left to the search.
+    agent = Agent()
+    board = BitBoard()
+    black = list(range(NUM_PIECES, 2 * NUM_PIECES))
+    entries = {}
+    for first, second in itertools.permutations(range(NUM_PIECES), 2):
+        rack = [first, second] + [slot for slot in range(NUM_PIECES) if slot not in (first, second)]
+        for rolls in ROLLS:
+            turn_board(board, snapshot(dict.fromkeys(range(2 * NUM_PIECES), UNENTERED), [rack, black],
+                                       'white', rolls), 'white', rolls)
+            move_pair = best_pair(agent, board, 'white', board.get_valid_moves(mask_offgoals=True))
+            entries[opening_key(board, 'white', rolls)] = (encode_pair(board, move_pair),
+                                                           agent.evaluate_move_pair(board, move_pair, 'white')[0])
+    return entries
+
+
+def bear_off_states():
+    # every tablebase state: pieces numbered 1-6 only sit on their own goal, the rest anywhere
+    kinds = [(number, high) for number in range(1, 7) for high in (False, True)]
+    for n in range(1, TABLEBASE_PIECES + 1):
+        for state in itertools.combinations_with_replacement(kinds, n):
+            lows = [number for number, high in state if not high]
+            if len(lows) == len(set(lows)):
+                yield state
+
+
+def bear_off_position(topology, state, rolls):
+    # white holds the state's pieces and has saved the rest; black hasn't entered, so nothing blocks
+    goals = {topology.numbers[i]: i for i in range(topology.size) if topology.types[i] == 'save'}
+    highs = iter(range(6, NUM_PIECES))
+    locations = {(next(highs) if high else number - 1): goals[number] for number, high in state}
+    locations.update(dict.fromkeys(range(NUM_PIECES, 2 * NUM_PIECES), UNENTERED))
+    return snapshot(locations, [[], list(range(NUM_PIECES, 2 * NUM_PIECES))], 'white', rolls)
+
+
+def build_tablebase():
+    # Solves bear-offs exactly for the fewest expected turns to save every piece. The value of a state is
+    # the mean over rolls of 1 + the best successor's value; moving between goals can return to an earlier
+    # state, so the values are iterated to a fixed point. Pairs that leave the endgame aren't considered. Of the
+    # pairs reaching a state, and of equally good states, the smallest encoding is kept, so rebuilds agree.
+    agent = Agent()
+    board = BitBoard()
+    states = list(bear_off_states())
+    options = {}
+    for state in states:
+        for rolls in ROLLS:
+            turn_board(board, bear_off_position(board.topology, state, rolls), 'white', rolls)
+            reached = {}
+            for move_pair in agent.iter_move_pairs(board.get_valid_moves(mask_offgoals=True), board):
+                if board.check_game_over()[0]:
+                    reached.setdefault((), []).append(move_pair)
+                elif board.get_game_stage('white') == 'endgame':
+                    reached.setdefault(bear_off_state(board, 'white'), []).append(move_pair)
+            options[state, rolls] = {successor: min(encode_pair(board, move_pair, any_high=True) for move_pair in pairs)
+                                     for successor, pairs in reached.items()}
+
+    values = dict.fromkeys(states, 0.0)
+    values[()] = 0.0
+    change = 1
+    while change > 1e-9:
+        change = 0
+        for state in states:
+            value = sum((1 + min(values[s] for s in options[state, rolls])) * (1 if rolls[0] == rolls[1] else 2)
+                        for rolls in ROLLS) / 36
+            change = max(change, abs(value - values[state]))
+            values[state] = value
+
+    entries = {}
+    for (state, rolls), successors in options.items():
+        best = min(successors, key=lambda s: (values[s], successors[s]))
+        entries[tablebase_key(state, rolls)] = successors[best], 1 + values[best]
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the opening book and the bear-off tablebase.')
+    parser.add_argument('--openings', action='store_true', help=f'write {OPENING_BOOK_FILE}')
+    parser.add_argument('--tablebase', action='store_true', help=f'write {TABLEBASE_FILE}')
+    args = parser.parse_args()
+
+    jobs = []
+    if args.openings or not args.tablebase:
+        jobs.append((OPENING_BOOK_FILE, build_openings))
+    if args.tablebase or not args.openings:
+        jobs.append((TABLEBASE_FILE, build_tablebase))
+    for filename, build in jobs:
+        start = time.perf_counter()
+        entries = build()
+        write_book(os.path.join(BASE_DIR, filename), entries)
+        print(f'{filename}: {len(entries)} positions in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
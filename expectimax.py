@@ -0,0 +1,160 @@
+import time
+from agent import GAME_OVER_SCORE, PASS, PLAYERS
+from game import NUM_PIECES
+
+SCORE_BOUND = NUM_PIECES * GAME_OVER_SCORE  # no position evaluates outside +-SCORE_BOUND
+DICE_ROLLS = [((low, high), (1 if low == high else 2) / 36) for low in range(1, 7) for high in range(low, 7)]
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class ExpectimaxSearch:
+    """Expectimax over whole turns, with a chance node for every roll of the next player.
+
+    Depth counts turns: depth 1 is the player's own move pair (the exhaustive search), depth 2 adds
+    the opponent's reply to each of the 21 distinct rolls, and so on. Depths are searched one after
+    another until the time budget runs out, each ordered by the last one's scores; the budget is
+    checked in the depth 1 sweep too, which then answers with the best pair scored so far. Chance nodes
+    probe every roll with single-move replies first, which bounds the node (Star2) and narrows the
+    windows the full replies are searched with (Star1).
+    """
+
+    def __init__(self, agent, board, player, max_depth, time_budget):
+        self.agent = agent
+        self.board = board
+        self.player = player
+        self.max_depth = max_depth
+        self.deadline = time.monotonic() + time_budget
+        self.nodes = 0
+
+    def run(self, moves):
+        agent, board, player = self.agent, self.board, self.player
+
+        # the pass pair is scored first, so there is an answer however short the budget
+        mark = len(board.moves)
+        scores, completed, partial = {}, 1, None
+        for move_pair in agent.iter_move_pairs(moves, board):
+            scores[move_pair] = agent.score(board, player)
+            if time.monotonic() > self.deadline:
+                self.unwind(mark)  # the generator is left where it stopped, with the pair still played
+                completed, partial = 0, 1
+                break
+        order = sorted(scores, key=lambda move_pair: -scores[move_pair])
+        best_move_pair, best_score = order[0], scores[order[0]]
+
+        opponent = PLAYERS[1 - PLAYERS.index(player)]
+        max_depth = self.max_depth if partial is None else 1
+        for depth in range(2, max_depth + 1):
+            mark, turn = len(board.moves), board.save_turn()
+            values = {}
+            searched = {}  # pairs played in either order reach the same position
+            alpha = -float('inf')
+            try:
+                for move_pair in order:
+                    self.play(move_pair)
+                    key = board.get_hash()
+                    if key not in searched:
+                        searched[key] = self.chance(opponent, depth - 1, alpha, float('inf'))
+                    values[move_pair] = searched[key]
+                    self.unwind(mark)
+                    if values[move_pair] > alpha:
+                        alpha = values[move_pair]
+                        iteration_best = move_pair
+            except SearchTimeout:
+                self.unwind(mark)
+                board.restore_turn(turn)
+                # the previous best is searched first, so anything that beat it here is a better choice
+                if values:
+                    best_move_pair, best_score, partial = iteration_best, alpha, depth
+                break
+            order = sorted(order, key=lambda move_pair: -values[move_pair])
+            best_move_pair, best_score, completed = iteration_best, alpha, depth
+
+        _, components = agent.evaluate_move_pair(board, best_move_pair, player)
+        # depth is the last one searched in full; partial the one the timeout cut short, if its best pair was kept
+        search = {'depth': completed, 'value': best_score, 'nodes': self.nodes}
+        if partial is not None:
+            search['partial'] = partial
+        components = dict(components, search=search)
+        return best_move_pair, (best_score, components)
+
+    def play(self, move_pair):
+        for move in move_pair:
+            if move != PASS:
+                self.board.apply_move(move, switch_turn = False)
+
+    def unwind(self, mark):
+        while len(self.board.moves) > mark:
+            self.board.undo_last_move()
+
+    def tick(self):
+        self.nodes += 1
+        if time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+    def chance(self, mover, depth, alpha, beta):
+        # expected value over mover's rolls; children are max nodes if mover is the searching player
+        board = self.board
+        if board.check_game_over()[0]:
+            return self.agent.score(board, self.player)
+
+        maximizing = mover == self.player
+        mark, turn = len(board.moves), board.save_turn()
+        try:
+            # Star2: the best single-move reply is a lower bound on a max child, an upper bound on a min child
+            lower, upper = [], []
+            for rolls, probability in DICE_ROLLS:
+                board.start_turn(mover, rolls)
+                probe = self.turn(mover, depth, -float('inf'), float('inf'), follow_ups=False)
+                lower.append(probe if maximizing else -SCORE_BOUND)
+                upper.append(SCORE_BOUND if maximizing else probe)
+            low = sum(p * value for (_, p), value in zip(DICE_ROLLS, lower))
+            high = sum(p * value for (_, p), value in zip(DICE_ROLLS, upper))
+            if low >= beta:
+                return low
+            if high <= alpha:
+                return high
+
+            # Star1: search each roll with the window that could still move the expected value past alpha or beta
+            for i, (rolls, probability) in enumerate(DICE_ROLLS):
+                low -= probability * lower[i]
+                high -= probability * upper[i]
+                board.start_turn(mover, rolls)
+                value = self.turn(mover, depth, (alpha - high) / probability, (beta - low) / probability)
+                low += probability * value
+                high += probability * value
+                if low >= beta:
+                    return low
+                if high <= alpha:
+                    return high
+            return low
+        finally:
+            self.unwind(mark)
+            board.restore_turn(turn)
+
+    def turn(self, mover, depth, alpha, beta, follow_ups=True):
+        # best move pair for mover with the dice already set; a cutoff returns a bound past the window
+        self.tick()
+        agent, board = self.agent, self.board
+        maximizing = mover == self.player
+        next_mover = PLAYERS[1 - PLAYERS.index(mover)]
+        mark = len(board.moves)
+
+        best = -float('inf') if maximizing else float('inf')
+        for _ in agent.iter_move_pairs(agent.generate_moves(board, True), board, follow_ups):
+            if depth == 1:
+                value = agent.score(board, self.player)
+            else:
+                value = self.chance(next_mover, depth - 1, alpha, beta)
+            if maximizing:
+                best = max(best, value)
+                alpha = max(alpha, value)
+            else:
+                best = min(best, value)
+                beta = min(beta, value)
+            if alpha >= beta:
+                self.unwind(mark)
+                break
+        return best
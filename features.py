@@ -0,0 +1,247 @@
+import argparse
+import numpy as np
+from agent import Agent, INITIAL_WEIGHTS, PLAYERS
+from batch_eval import ABSENT, STAGES, leaf_tables, piece_states, split_players
+from game import NUM_PIECES, PLAYER_INDEX
+
+MODEL_FILE = 'model.npz'
+HIDDEN_UNITS = 32
+TRAIN_EPOCHS = 200
+TRAIN_BATCH = 256
+LEARNING_RATE = 1e-3  # Adam step size
+
+NUMBERED = range(1, 7)  # pieces with their own goal tile; the higher ones can be saved on any of them
+FEATURE_NAMES = (
+    ['saved_pieces'] + [f'saved_{n}' for n in range(1, NUM_PIECES + 1)]
+    + ['goal_pieces'] + [f'goal_{n}' for n in NUMBERED] + [f'high_goal_{n}' for n in NUMBERED]
+    + ['captured_pieces'] + [f'captured_{n}' for n in NUMBERED]
+    + ['near_pieces', 'nearer_pieces'] + [f'near_{n}' for n in NUMBERED]
+    + ['blocked_pieces'] + [f'blocked_{n}' for n in NUMBERED]
+    + ['loose_pieces'] + [f'loose_{n}' for n in NUMBERED]
+    + ['distance'] + [f'far_{n}' for n in NUMBERED]
+    + ['unentered_pieces'] + [f'off_goal_{n}' for n in NUMBERED] + [f'far_from_goal_{n}' for n in NUMBERED]
+    + [f'stage_{stage}' for stage in STAGES]
+    + ['home_to_move']
+)
+FEATURES = len(FEATURE_NAMES)
+
+
+def side_features(pieces, opponent_pieces, stages, opponent_stages, to_move):
+    # One player's half of the evaluation as an (n, FEATURES) matrix of weight-free counts. What
+    # score_values does beyond adding up weighted terms is folded into the values: the capped
+    # distance, the loose pieces scaled by how many opponent pieces are around, and the stage.
+    numbered = pieces['numbered']
+    rows = len(stages)
+
+    def count(mask):
+        return mask.sum(axis=1, keepdims=True)
+
+    def by_number(mask, numbers=NUMBERED):
+        # pieces in mask, per piece number
+        return mask[:, [n - 1 for n in numbers]].astype(float)
+
+    high_goal = pieces['high_goal']
+    tile_numbers = pieces['tile_numbers']
+    far = pieces['far']
+    unreachable = pieces['unreachable']
+    far_distance = np.where(far & ~unreachable, pieces['distances'], 0).sum(axis=1)
+    distance = np.where((far & unreachable).any(axis=1), 100, np.minimum(far_distance, 100))
+
+    opponent_board_pieces = count(opponent_pieces['in_play']) + np.minimum(1, count(opponent_pieces['unentered']))
+    exposure = np.where(opponent_stages[:, None] == STAGES.index('endgame'), -1, 1) * opponent_board_pieces / 14
+    home = count(pieces['home']) > 0
+
+    columns = [
+        count(pieces['saved']), by_number(pieces['saved'], range(1, NUM_PIECES + 1)),
+        count(pieces['saveable']), by_number(pieces['saveable'] & numbered),
+        np.stack([(high_goal & (tile_numbers == n)).sum(axis=1) for n in NUMBERED], axis=1),
+        count(opponent_pieces['home']), by_number(opponent_pieces['home'] & numbered),
+        count(pieces['near']), count(pieces['near'] & ~numbered & (pieces['distances'] <= 4)),
+        by_number(pieces['near'] & numbered),
+        count(pieces['blocked']), by_number(pieces['blocked'] & numbered),
+        count(pieces['loose']), by_number(pieces['loose'] & numbered) * exposure,
+        distance[:, None], by_number(far & numbered),
+        count(pieces['unentered']), by_number(pieces['off_goal']), by_number(pieces['far_from_goal']),
+        np.eye(len(STAGES))[stages],
+        home & to_move,
+    ]
+    return np.hstack([np.asarray(column, dtype=float).reshape(rows, -1) for column in columns])
+
+
+def extract_features(topology, locations, stages, current_player, player):
+    # (n, FEATURES) feature vectors for an (n, 24) location matrix with (n, 2) stage codes, as player's
+    # side minus the opponent's; a LinearModel of the weights scores them like Agent.evaluate
+    tables = leaf_tables(topology, INITIAL_WEIGHTS)  # only the topology's arrays are read
+    sides, all_counts = split_players(tables, locations)
+    pieces = []
+    for own, blocked in sides:
+        states = piece_states(tables, own, all_counts, blocked)
+        states['tile_numbers'] = tables.tile_number[states['columns']]
+        pieces.append(states)
+
+    p = PLAYER_INDEX[player]
+    o = 1 - p
+    own = side_features(pieces[p], pieces[o], stages[:, p], stages[:, o], current_player == PLAYERS[p])
+    other = side_features(pieces[o], pieces[p], stages[:, o], stages[:, p], current_player == PLAYERS[o])
+    return own - other
+
+
+def board_features(board, player):
+    # the feature vector of one position, as a row
+    locations = [ABSENT if location is None else location for location in board.get_locations()]
+    stages = [STAGES.index(board.game_stages[p]) for p in PLAYERS]
+    return extract_features(board.topology, np.array([locations], dtype=np.int16), np.array([stages]),
+                            board.current_player, player)
+
+
+def weight_vector(weights=INITIAL_WEIGHTS):
+    # the coefficients that turn feature vectors into the hand-written evaluation
+    coefficients = {
+        'saved_pieces': weights['saved_piece'],
+        'goal_pieces': weights['goal_piece'],
+        'captured_pieces': weights['captured_opponent_piece'],
+        'near_pieces': weights['near_goal_piece'],
+        'nearer_pieces': weights['nearer_goal_piece'],
+        'blocked_pieces': weights['blocked_piece'],
+        'loose_pieces': weights['loose_piece'],
+        'distance': weights['distance_penalty'],
+        'unentered_pieces': weights['unentered_piece'],
+        'home_to_move': -10000,
+    }
+    for n in range(1, NUM_PIECES + 1):
+        coefficients[f'saved_{n}'] = weights['saved_bonuses'].get(n, 0)
+    for n in NUMBERED:
+        goal = weights['goal_bonuses'].get(n, 0)
+        coefficients.update({
+            f'goal_{n}': goal,
+            f'high_goal_{n}': goal * weights['high_goal_penalty'],
+            f'captured_{n}': weights['captured_bonuses'].get(n, 0),
+            f'near_{n}': weights['near_goal_bonuses'].get(n, 0),
+            f'blocked_{n}': weights['blocked_piece_penalties'].get(n, 0),
+            f'loose_{n}': weights['loose_piece_penalties'].get(n, 0),
+            f'far_{n}': goal / 10 * weights['distance_penalty'],
+            f'off_goal_{n}': -goal,
+            f'far_from_goal_{n}': -goal,
+        })
+    for stage in STAGES:
+        coefficients[f'stage_{stage}'] = weights['game_stage_bonuses'].get(stage, 0)
+    return np.array([coefficients[name] for name in FEATURE_NAMES], dtype=float)
+
+
+class LinearModel:
+    """The evaluation as a dot product with the feature vector; a batch of leaves is one matrix-vector product."""
+
+    def __init__(self, weights=INITIAL_WEIGHTS):
+        self.coefficients = weight_vector(weights)
+
+    def score(self, features):
+        return features @ self.coefficients
+
+
+class MLPModel:
+    """A small fully connected network over standardized features, with ReLU hidden layers and one output.
+
+    layers is a list of (weight matrix, bias) pairs. Scores are on whatever scale the network was
+    trained on; the search only compares them with each other and with won or lost positions.
+    """
+
+    def __init__(self, layers, mean, scale):
+        self.layers = layers
+        self.mean = mean
+        self.scale = scale
+
+    def forward(self, features):
+        # every layer's output, the input included
+        outputs = [(features - self.mean) / self.scale]
+        for i, (weights, bias) in enumerate(self.layers):
+            x = outputs[-1] @ weights + bias
+            outputs.append(np.maximum(x, 0) if i < len(self.layers) - 1 else x)
+        return outputs
+
+    def score(self, features):
+        return self.forward(features)[-1][:, 0]
+
+    @classmethod
+    def fit(cls, features, targets, hidden=(HIDDEN_UNITS,), epochs=TRAIN_EPOCHS, batch=TRAIN_BATCH,
+            learning_rate=LEARNING_RATE, seed=0):
+        # mean squared error, minimized with Adam over shuffled minibatches
+        rng = np.random.default_rng(seed)
+        scale = features.std(axis=0)
+        model = cls([], features.mean(axis=0), np.where(scale > 0, scale, 1))
+        sizes = [features.shape[1], *hidden, 1]
+        model.layers = [(rng.normal(0, np.sqrt(2 / m), (m, n)), np.zeros(n)) for m, n in zip(sizes, sizes[1:])]
+        params = [array for layer in model.layers for array in layer]
+        moments = [(np.zeros_like(param), np.zeros_like(param)) for param in params]
+        targets = targets.reshape(-1, 1)
+        step = 0
+        for _ in range(epochs):
+            order = rng.permutation(len(features))
+            for start in range(0, len(order), batch):
+                rows = order[start:start + batch]
+                outputs = model.forward(features[rows])
+                error = 2 * (outputs[-1] - targets[rows]) / len(rows)
+                grads = []
+                for i in reversed(range(len(model.layers))):
+                    weights, _ = model.layers[i]
+                    grads[:0] = [outputs[i].T @ error, error.sum(axis=0)]
+                    error = (error @ weights.T) * (outputs[i] > 0)
+                step += 1
+                for param, grad, (m, v) in zip(params, grads, moments):
+                    m += 0.1 * (grad - m)
+                    v += 0.001 * (grad * grad - v)
+                    param -= learning_rate * (m / (1 - 0.9 ** step)) / (np.sqrt(v / (1 - 0.999 ** step)) + 1e-8)
+        return model
+
+    def save(self, filename=MODEL_FILE):
+        arrays = {'mean': self.mean, 'scale': self.scale}
+        for i, (weights, bias) in enumerate(self.layers):
+            arrays[f'weights_{i}'], arrays[f'bias_{i}'] = weights, bias
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename=MODEL_FILE):
+        with np.load(filename) as arrays:
+            layers = []
+            while f'weights_{len(layers)}' in arrays:
+                layers.append((arrays[f'weights_{len(layers)}'], arrays[f'bias_{len(layers)}']))
+            return cls(layers, arrays['mean'], arrays['scale'])
+
+
+def collect(games, seed=0, search='pruned'):
+    # Feature vectors of every position the agent moves from in games against itself, from the mover's
+    # side, with the final margin from that side as the target; games that don't finish are left out
+    from selfplay import play_game
+    agent = Agent(search=search)
+    features, targets = [], []
+    for game in range(games):
+        positions = []
+
+        def record(board, turn):
+            positions.append((board.current_player, board_features(board, board.current_player)[0]))
+
+        winner, margin = play_game({'white': agent, 'black': agent}, 'board', seed + game, on_turn=record)
+        if winner:
+            features += [row for _, row in positions]
+            targets += [margin if player == winner else -margin for player, _ in positions]
+    return np.array(features), np.array(targets, dtype=float)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train a small evaluation network on self-play positions.')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--search', choices=['exhaustive', 'pruned'], default='pruned')
+    parser.add_argument('--hidden', type=int, nargs='*', default=[HIDDEN_UNITS], help='units per hidden layer')
+    parser.add_argument('--epochs', type=int, default=TRAIN_EPOCHS)
+    parser.add_argument('--out', default=MODEL_FILE)
+    args = parser.parse_args()
+
+    features, targets = collect(args.games, args.seed, args.search)
+    model = MLPModel.fit(features, targets, tuple(args.hidden), args.epochs, seed=args.seed)
+    error = np.mean((model.score(features) - targets) ** 2)
+    print(f'{len(features)} positions, training mean squared error {error:.3f}')
+    model.save(args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,7 @@ const CONFIG = {
 }; 
 
 SERVER_URL = LOCAL_AI ? 'http://localhost:8000' : CONFIG.AI_SERVER_URL;
+const GAME_ID = Math.random().toString(36).slice(2); // the server keeps a board and agent per game id
 
 
 const scoreTracker = {
@@ -2142,15 +2143,71 @@ function calculateAverageScore() {
 
 // Ensure these functions are defined outside of any class or method
 
-function evaluateBoard(gameState) {
-    console.log('Sending game state to agent:', gameState);
-    return fetch(`${SERVER_URL}/evaluate_board`, {
+// Last position the server acknowledged for this game; later requests send only what changed since then
+let lastSync = null;
+
+function pieceLocations(gameState) {
+    const locations = {};
+    const racks = {whiteUnentered: 'unentered', blackUnentered: 'unentered', whiteSaved: 'saved', blackSaved: 'saved'};
+    for (const [key, rack] of Object.entries(racks)) {
+        gameState.racks[key].forEach(piece => {
+            locations[`${piece.color}:${piece.number}`] = {rack: rack};
+        });
+    }
+    gameState.boardPieces.forEach(piece => {
+        locations[`${piece.color}:${piece.number}`] = {tile: piece.tile};
+    });
+    return locations;
+}
+
+function syncPayload(gameState) {
+    // the full state until the server has acknowledged one, then a delta against that version
+    if (!lastSync) {
+        return gameState;
+    }
+    const before = pieceLocations(lastSync.state);
+    const pieces = [];
+    for (const [key, location] of Object.entries(pieceLocations(gameState))) {
+        if (JSON.stringify(location) !== JSON.stringify(before[key])) {
+            const [color, number] = key.split(':');
+            pieces.push({color: color, number: Number(number), ...location});
+        }
+    }
+    const delta = {
+        baseVersion: lastSync.version,
+        currentTurn: gameState.currentTurn,
+        dice: gameState.dice,
+        pieces: pieces
+    };
+    const firstMove = gameState.boardPieces.find(piece => piece.reachableBySum);
+    if (firstMove) {
+        delta.firstMove = {color: firstMove.color, number: firstMove.number};
+    }
+    return delta;
+}
+
+function postState(path, gameState) {
+    const send = body => fetch(`${SERVER_URL}${path}`, {
         method: 'POST',
         headers: {
-            'Content-Type': 'application/json'
+            'Content-Type': 'application/json',
+            'X-Game-Id': GAME_ID
         },
-        body: JSON.stringify(gameState)
-    })
+        body: JSON.stringify(body)
+    });
+    return send(syncPayload(gameState)).then(response => {
+        if (response.status === 409) {
+            // the server no longer holds our last position (restarted, evicted or another worker): resync
+            lastSync = null;
+            return send(gameState);
+        }
+        return response;
+    });
+}
+
+function evaluateBoard(gameState) {
+    console.log('Sending game state to agent:', gameState);
+    return postState('/evaluate_board', gameState)
     .then(response => {
         console.log('Response status:', response.status);
         return response.json();
@@ -2165,18 +2222,15 @@ function evaluateBoard(gameState) {
 
 function getAgentMoves(gameState) {
     console.log('Sending game state to agent:', gameState);
-    return fetch(`${SERVER_URL}/select_moves`, {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify(gameState)
-    })
+    return postState('/select_moves', gameState)
     .then(response => {
         console.log('Response status:', response.status);
         return response.json();
     })
     .then(data => {
+        if (data.version) {
+            lastSync = {version: data.version, state: gameState};
+        }
         if (data.move) {
             console.log('Agent moves:', data.move);
             applyMovePair(data.move);
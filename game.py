@@ -1,11 +1,83 @@
 import random
-from collections import deque
-import json
 import itertools
+import logging
+from array import array
+from topology import load_topology, iter_bits, TILE_TYPES, FIELD, SAVE, HOME
+
+logger = logging.getLogger(__name__)
 
 NUM_PIECES = 12
 
+# player codes; the colour names are what moves, game_stages and the JSON API use
+PLAYERS = ['white', 'black']
+WHITE, BLACK = range(len(PLAYERS))
+PLAYER_INDEX = {player: side for side, player in enumerate(PLAYERS)}
+
+# piece locations in the compact representation: a tile index, or one of the racks
+UNENTERED = -1
+SAVED = -2
+
+# Board.to_array layout, one signed byte each: a (slot, location) pair per piece in piece-list order,
+# both unentered racks in order (slots, -1 padded), dice numbers then used flags, the player to move,
+# the pending first move (slot and origin tile, -1 for none) and both players' game stages
+GAME_STAGES = ['opening', 'midgame', 'endgame']
+SNAPSHOT_RACKS = 4 * NUM_PIECES
+SNAPSHOT_DICE = SNAPSHOT_RACKS + 2 * NUM_PIECES
+SNAPSHOT_TURN = SNAPSHOT_DICE + 4
+SNAPSHOT_FIRST_MOVE = SNAPSHOT_TURN + 1
+SNAPSHOT_STAGES = SNAPSHOT_FIRST_MOVE + 2
+SNAPSHOT_SIZE = SNAPSHOT_STAGES + 2
+
+# Board.moves undo records, one signed byte per field: the piece's slot, where it came from (a tile
+# index or UNENTERED), where it went (a tile index, SAVED, or SAVED_BY_OPPONENT), the captured piece's
+# slot (-1 for none), both dice's used flags as bits, whether the move set firstMove, and the mover's stage
+(UNDO_SLOT, UNDO_ORIGIN, UNDO_DESTINATION, UNDO_CAPTURED, UNDO_DICE, UNDO_FIRST_MOVE, UNDO_STAGE) = range(7)
+UNDO_RECORD = 7
+UNDO_CAPACITY = 16  # records preallocated; a longer line of play doubles the array
+SAVED_BY_OPPONENT = -3
+
+def piece_slot(player, number):
+    # fixed position of a piece in compact state arrays: white 1-12, then black 1-12
+    return PLAYER_INDEX[player] * NUM_PIECES + number - 1
+
+class UndoStack:
+    """Applied moves as fixed-size records in one preallocated array, so applying and undoing a move
+    allocates nothing. pop() returns the offset of the record it removed, to be read from data."""
+
+    __slots__ = ('data', 'top')
+
+    def __init__(self, capacity=UNDO_CAPACITY):
+        self.data = array('b', [0]) * (capacity * UNDO_RECORD)
+        self.top = 0
+
+    def __len__(self):
+        return self.top // UNDO_RECORD
+
+    def clear(self):
+        self.top = 0
+
+    def push(self, slot, origin, destination, captured, dice, first_move, stage):
+        data = self.data
+        top = self.top
+        if top == len(data):
+            data.extend(data)
+        data[top + UNDO_SLOT] = slot
+        data[top + UNDO_ORIGIN] = origin
+        data[top + UNDO_DESTINATION] = destination
+        data[top + UNDO_CAPTURED] = captured
+        data[top + UNDO_DICE] = dice
+        data[top + UNDO_FIRST_MOVE] = first_move
+        data[top + UNDO_STAGE] = stage
+        self.top = top + UNDO_RECORD
+
+    def pop(self):
+        self.top -= UNDO_RECORD
+        return self.top
+
+
 class Die:
+    __slots__ = ('board', 'number', 'used')
+
     def __init__(self, board):
         self.board = board
         self.roll()
@@ -15,9 +87,13 @@ class Die:
         self.used = False
 
 class Piece:
+    __slots__ = ('player', 'side', 'number', 'slot', 'board', 'tile', 'rack', 'reachable_tiles', 'reachable_by_sum', 'index')
+
     def __init__(self, player, number, board):
         self.player = player
+        self.side = PLAYER_INDEX[player]
         self.number = number
+        self.slot = piece_slot(player, number)
         self.board = board
         self.tile = None
         self.rack = None
@@ -33,14 +109,20 @@ class Piece:
             return True if already_saved_counts_as_saveable else False
         
         tile = self.tile
-        if tile and tile.type == 'save':
+        if tile and tile.is_save:
             if self.number > 6 or (self.number == tile.number):
                 return True
         return False
 
 class Tile:
+    __slots__ = ('type', 'kind', 'is_field', 'is_save', 'passable', 'ring', 'pos', 'pieces', 'neighbors', 'board', 'number', 'index')
+
     def __init__(self, tile_type, ring, pos, board, number=None):
         self.type = tile_type
+        self.kind = TILE_TYPES.index(tile_type)
+        self.is_field = self.kind == FIELD
+        self.is_save = self.kind == SAVE
+        self.passable = self.kind != HOME
         self.ring = ring
         self.pos = pos
         self.pieces = []
@@ -56,11 +138,16 @@ class Tile:
     def is_blocked(self, player = None):
         if not player:
             player = self.board.current_player
-        return self.type == 'field' and len(self.pieces) > 1 and self.pieces[0].player != player
+        return self.is_field and len(self.pieces) > 1 and self.pieces[0].player != player
 
 class Board:
+    __slots__ = ('players', 'dice', 'pieces', 'tiles', 'tile_map', 'field_tiles', 'topology', 'home_tile', 'current_player',
+                 'white_unentered', 'black_unentered', 'white_saved', 'black_saved', 'game_stages', 'piece_hash',
+                 'slot_pieces', 'piece_counts', 'goal_counts', 'save_occupied', 'firstMove', 'moves',
+                 'endgame_reward_applied', 'offgoals')
+
     def __init__(self):
-        self.players = ['white', 'black']
+        self.players = PLAYERS
         self.dice = [Die(self), Die(self)] 
         self.pieces = []
         self.tiles = []
@@ -75,8 +162,10 @@ class Board:
         self.assign_tile_indices()
         self.game_stages = {'white': 'opening', 'black': 'opening'}
         self.initialize_pieces()
+        self.reset_hash()
+        self.recount()
         self.firstMove = None
-        self.moves = []
+        self.moves = UndoStack()
 
         self.endgame_reward_applied = {'white': False, 'black': False}
         self.offgoals = {'white': 0, 'black': 0}
@@ -101,6 +190,7 @@ class Board:
         self.pieces.clear()
         for tile in self.tiles:
             tile.pieces.clear()
+        self.piece_hash = 0
 
     def add_tile(self, tile):
         self.tiles.append(tile)
@@ -127,37 +217,35 @@ class Board:
             self.pieces.extend(pieces)
 
     def load_from_json(self, filename):
-        with open(filename, 'r') as f:
-            data = json.load(f)
+        self.topology = load_topology(filename)
 
-        for key, value in data.items():
-            ring, sector = map(int, key.replace('ring', '').replace('sector', '').split('_'))
-            tile_type = value['type']
-            number = value.get('number')  # Retrieve number if it's a save tile
+        for (ring, sector), tile_type, number in zip(self.topology.keys, self.topology.types, self.topology.numbers):
             tile = Tile(tile_type, ring, sector, self, number)
             self.add_tile(tile)
 
-        for key, value in data.items():
-            ring, sector = map(int, key.replace('ring', '').replace('sector', '').split('_'))
-            tile = self.get_tile(ring, sector)
-            if tile:
-                for neighbor in value['neighbors']:
-                    neighbor_tile = self.get_tile(neighbor['ring'], neighbor['sector'])
-                    if neighbor_tile:
-                        tile.neighbors.append(neighbor_tile)
+        for tile, neighbors in zip(self.tiles, self.topology.neighbors):
+            tile.neighbors.extend(self.tiles[i] for i in neighbors)
+
+        self.field_tiles = [tile for tile in self.tiles if tile.is_field]
 
     def update_state(self, game_state_details):
         # Set the current turn
         self.current_player = game_state_details['currentTurn']
 
-        # Clear the board pieces
-        self.clear()
-        
         # Set dice values and used status
         for die, die_details in zip(self.dice, game_state_details['dice']):
             die.number = die_details['value']
             die.used = die_details['used']
 
+        # a first move only carries over if the posted state marks one
+        self.firstMove = None
+        if self.move_pieces_to_state(game_state_details):
+            self.game_stages[self.current_player] = self.get_game_stage(self.current_player)
+            return
+
+        # Clear the board pieces
+        self.clear()
+
         # Function to place pieces in their respective racks
         def place_pieces_in_rack(rack, pieces_details, player):
             rack.clear()
@@ -193,15 +281,162 @@ class Board:
                 self.firstMove = {'piece': piece, 'origin_tile': tile}
 
         self.assign_piece_indices()
+        self.reset_hash()
+        self.recount()
         self.game_stages[self.current_player] = self.get_game_stage(self.current_player)
 
+    def move_pieces_to_state(self, game_state_details):
+        # Apply a posted state as a diff: when it holds the same pieces this board already has, only the
+        # pieces whose location changed are moved, and no Piece is rebuilt. Returns False otherwise.
+        racks = game_state_details['racks']
+        rack_details = [(self.white_unentered, racks['whiteUnentered'], 'white'),
+                        (self.white_saved, racks['whiteSaved'], 'white'),
+                        (self.black_unentered, racks['blackUnentered'], 'black'),
+                        (self.black_saved, racks['blackSaved'], 'black')]
+        board_details = game_state_details['boardPieces']
+        pieces = {piece.slot: piece for piece in self.pieces}
+        posted = [piece_slot(player, p['number']) for _, details, player in rack_details for p in details]
+        posted += [piece_slot(p['color'], p['number']) for p in board_details]
+        if len(posted) != len(self.pieces) or set(posted) != pieces.keys():
+            return False
+
+        for rack, details, player in rack_details:
+            rack[:] = [pieces[piece_slot(player, p['number'])] for p in details]
+            for piece in rack:
+                if piece.tile:
+                    piece.tile.pieces.remove(piece)
+                    piece.tile = None
+                piece.rack = rack
+
+        # tiles that gain or lose a piece are relisted in posted order, as a rebuild would list them
+        tile_pieces = {}
+        for piece_details in board_details:
+            piece = pieces[piece_slot(piece_details['color'], piece_details['number'])]
+            tile = self.get_tile(piece_details['tile']['ring'], piece_details['tile']['sector'])
+            tile_pieces.setdefault(tile, []).append(piece)
+            if piece.tile is not tile:
+                if piece.tile:
+                    piece.tile.pieces.remove(piece)
+                piece.tile = tile
+                piece.rack = None
+            if 'reachableBySum' in piece_details:
+                piece.reachable_by_sum = [self.get_tile(t['ring'], t['sector']) for t in piece_details['reachableBySum']]
+                self.firstMove = {'piece': piece, 'origin_tile': tile}
+        for tile, on_tile in tile_pieces.items():
+            tile.pieces[:] = on_tile
+        for piece in self.pieces:
+            piece.reachable_tiles = None
+            if self.firstMove is None or piece is not self.firstMove['piece']:
+                piece.reachable_by_sum = None
+
+        self.assign_piece_indices()
+        self.reset_hash()
+        self.recount()
+        return True
+
+    def apply_delta(self, delta):
+        # Sync from a delta instead of a full state: the dice and turn, plus only the pieces that moved since
+        # the last sync, each with its new tile or rack ('unentered' or 'saved')
+        self.current_player = delta['currentTurn']
+        for die, die_details in zip(self.dice, delta['dice']):
+            die.number = die_details['value']
+            die.used = die_details['used']
+
+        pieces = {piece.slot: piece for piece in self.pieces}
+        for piece_details in delta['pieces']:
+            piece = pieces[piece_slot(piece_details['color'], piece_details['number'])]
+            moved_from = self.get_location(piece)
+            if piece.tile:
+                piece.tile.pieces.remove(piece)
+                piece.tile = None
+            if piece.rack is not None:
+                piece.rack.remove(piece)
+                piece.rack = None
+            if 'tile' in piece_details:
+                piece.tile = self.get_tile(piece_details['tile']['ring'], piece_details['tile']['sector'])
+                piece.tile.pieces.append(piece)
+            elif piece_details['rack'] == 'saved':
+                piece.rack = self.get_save_rack(piece.player)
+                piece.rack.append(piece)
+            else:
+                piece.rack = self.get_unentered_rack(piece.player)
+                piece.rack.append(piece)
+            piece_keys = self.topology.piece_keys[piece.slot]
+            self.piece_hash ^= piece_keys[moved_from] ^ piece_keys[self.get_location(piece)]
+
+        self.firstMove = None
+        if delta.get('firstMove'):
+            piece = pieces[piece_slot(delta['firstMove']['color'], delta['firstMove']['number'])]
+            self.firstMove = {'piece': piece, 'origin_tile': piece.tile}
+        self.recount()
+        self.game_stages[self.current_player] = self.get_game_stage(self.current_player)
+
+    def to_array(self):
+        # fixed-size snapshot of the position (layout above); the tile graph isn't part of it
+        data = array('b', [-1]) * SNAPSHOT_SIZE
+        for i, piece in enumerate(self.pieces):
+            data[2 * i] = piece.slot
+            data[2 * i + 1] = self.get_location(piece)
+        for p, rack in enumerate([self.white_unentered, self.black_unentered]):
+            for i, piece in enumerate(rack):
+                data[SNAPSHOT_RACKS + p * NUM_PIECES + i] = piece.slot
+        for i, die in enumerate(self.dice):
+            data[SNAPSHOT_DICE + i] = die.number
+            data[SNAPSHOT_DICE + 2 + i] = die.used
+        data[SNAPSHOT_TURN] = PLAYER_INDEX[self.current_player]
+        if self.firstMove:
+            origin_tile = self.firstMove['origin_tile']
+            data[SNAPSHOT_FIRST_MOVE] = self.firstMove['piece'].slot
+            data[SNAPSHOT_FIRST_MOVE + 1] = origin_tile.index if origin_tile else -1
+        for i, player in enumerate(self.players):
+            data[SNAPSHOT_STAGES + i] = GAME_STAGES.index(self.game_stages[player])
+        return data
+
+    def from_array(self, data):
+        # restore a to_array snapshot, replacing the position and dropping the move history
+        self.clear()
+        pieces = {}
+        for i in range(0, SNAPSHOT_RACKS, 2):
+            slot, location = data[i], data[i + 1]
+            if slot < 0:
+                continue
+            player = self.players[slot // NUM_PIECES]
+            piece = pieces[slot] = Piece(player, slot % NUM_PIECES + 1, self)
+            piece.index = slot + 1
+            self.pieces.append(piece)
+            if location >= 0:
+                piece.tile = self.tiles[location]
+                piece.tile.pieces.append(piece)
+            elif location == SAVED:
+                piece.rack = self.get_save_rack(player)
+                piece.rack.append(piece)
+        for p, rack in enumerate([self.white_unentered, self.black_unentered]):
+            for slot in data[SNAPSHOT_RACKS + p * NUM_PIECES:SNAPSHOT_RACKS + (p + 1) * NUM_PIECES]:
+                if slot >= 0:
+                    rack.append(pieces[slot])
+                    pieces[slot].rack = rack
+
+        for i, die in enumerate(self.dice):
+            die.number = data[SNAPSHOT_DICE + i]
+            die.used = bool(data[SNAPSHOT_DICE + 2 + i])
+        self.current_player = self.players[data[SNAPSHOT_TURN]]
+        self.firstMove = None
+        slot, origin = data[SNAPSHOT_FIRST_MOVE], data[SNAPSHOT_FIRST_MOVE + 1]
+        if slot >= 0:
+            self.firstMove = {'piece': pieces[slot], 'origin_tile': self.tiles[origin] if origin >= 0 else None}
+        for i, player in enumerate(self.players):
+            self.game_stages[player] = GAME_STAGES[data[SNAPSHOT_STAGES + i]]
+        self.moves.clear()
+        self.reset_hash()
+        self.recount()
+
     def assign_tile_indices(self):
         for i in range(len(self.tiles)):
             self.tiles[i].index = i
 
     def assign_piece_indices(self):
         # Sort the pieces list by color (white then black) and then by their number
-        self.pieces.sort(key=lambda piece: (piece.player != 'white', piece.number))
+        self.pieces.sort(key=lambda piece: (piece.side, piece.number))
         # Assign the indices
         for i in range(len(self.pieces)):
             self.pieces[i].index = i+1
@@ -210,9 +445,9 @@ class Board:
         unentered_rack = self.white_unentered if player == 'white' else self.black_unentered
         if len(unentered_rack) > 0:
             return 'opening'
-        
-        player_pieces = [p for p in self.pieces if p.player == player]
-        if all(p.can_be_saved() for p in player_pieces):
+
+        p = PLAYER_INDEX[player]
+        if self.goal_counts[p] == self.piece_counts[p]:
             return 'endgame'
         return 'midgame'
     
@@ -223,6 +458,25 @@ class Board:
             die.roll()
         self.current_player = 'white' if self.current_player == 'black' else 'black'
 
+    def start_turn(self, player, rolls):
+        # switch_turn with given dice instead of a random roll, for searches that play out the next turn
+        self.firstMove = None
+        for die, number in zip(self.dice, rolls):
+            die.number = number
+            die.used = False
+        self.current_player = player
+        self.game_stages[player] = self.get_game_stage(player)
+
+    def save_turn(self):
+        return (self.current_player, [(die.number, die.used) for die in self.dice], self.firstMove, dict(self.game_stages))
+
+    def restore_turn(self, turn):
+        self.current_player, dice, self.firstMove, game_stages = turn
+        for die, (number, used) in zip(self.dice, dice):
+            die.number = number
+            die.used = used
+        self.game_stages.update(game_stages)
+
     def check_game_over(self):
         TOTAL_PIECES = len(self.pieces) // 2 
         white_saved_count = len(self.white_saved)
@@ -259,10 +513,11 @@ class Board:
             return False  # can't save pieces in the opening
 
         current_tile = piece.tile
-        if current_tile and current_tile.type == 'save' and (piece.number > 6 or piece.number == current_tile.number):
+        if current_tile and current_tile.is_save and (piece.number > 6 or piece.number == current_tile.number):
             if self.game_stages[piece.player] == 'endgame':
                 if piece.number > 6:
-                    highest_occupied_goal_number = max((tile.number for tile in self.tiles if tile.type == 'save' and len(tile.pieces) > 0 and any(p.player == piece.player for p in tile.pieces)), default=0)
+                    occupied = self.save_occupied[piece.side]
+                    highest_occupied_goal_number = max((self.tiles[i].number for i in iter_bits(occupied)), default=0)
                     valid_dice = [die for die in self.dice if (not die.used) and die.number == current_tile.number or (die.number > current_tile.number and current_tile.number >= highest_occupied_goal_number)]
                 else:
                     valid_dice = [die for die in self.dice if (not die.used) and die.number == current_tile.number]
@@ -279,105 +534,141 @@ class Board:
             else:
                 return False  # The piece cannot be saved with the current dice rolls
 
-    def get_reachable_tiles(self, start_tile, steps):
-        queue = deque([(start_tile, 0)])  # Start with the current tile and 0 steps taken
-        visited = set([start_tile])
-        reachable_tiles = []
-        
-        while queue:
-            current_tile, current_steps = queue.popleft()
-            
-            if current_steps < steps:   
-                print(current_tile)
-                for neighbor in current_tile.neighbors:
-
-                    if neighbor not in visited and neighbor.type not in ['nogo', 'home'] and not neighbor.is_blocked():
-                        queue.append((neighbor, current_steps + 1))
-                        visited.add(neighbor)
-                        if current_steps + 1 == steps:
-                            reachable_tiles.append(neighbor)
-            elif current_steps == steps:
-                reachable_tiles.append(current_tile)
-
-        return list(set(reachable_tiles))
-
-    def get_reachable_tiles_by_dice(self, piece):   
-        reachable_tiles = {self.dice[0].number: [], self.dice[1].number: []}
-        
+    def get_location(self, piece):
+        if piece.tile:
+            return piece.tile.index
+        if piece.rack is self.white_saved or piece.rack is self.black_saved:
+            return SAVED
+        return UNENTERED
+
+    def get_locations(self):
+        # compact view of the position: one location per piece slot, None for pieces not in play
+        locations = [None] * (2 * NUM_PIECES)
+        for piece in self.pieces:
+            locations[piece.slot] = self.get_location(piece)
+        return locations
+
+    def recount(self):
+        # Per-player counters that apply_move and undo_last_move keep up to date: pieces, pieces that
+        # can be saved (saved ones included), and a bitmask of the save tiles holding the player's pieces.
+        # Also the pieces by slot, which only change when the position is reloaded.
+        self.slot_pieces = [None] * (2 * NUM_PIECES)
+        self.piece_counts = [0, 0]
+        self.goal_counts = [0, 0]
+        self.save_occupied = [0, 0]
+        for piece in self.pieces:
+            p = piece.side
+            self.slot_pieces[piece.slot] = piece
+            self.piece_counts[p] += 1
+            if piece.can_be_saved():
+                self.goal_counts[p] += 1
+            if piece.tile and piece.tile.is_save:
+                self.save_occupied[p] |= 1 << piece.tile.index
+
+    def enter_tile(self, piece, tile):
+        # counters for piece having just been put on tile
+        if tile.is_save:
+            p = piece.side
+            if piece.number > 6 or piece.number == tile.number:
+                self.goal_counts[p] += 1
+            self.save_occupied[p] |= 1 << tile.index
+
+    def leave_tile(self, piece, tile):
+        # counters for piece having just been taken off tile
+        if tile.is_save:
+            p = piece.side
+            if piece.number > 6 or piece.number == tile.number:
+                self.goal_counts[p] -= 1
+            if not any(other.player == piece.player for other in tile.pieces):
+                self.save_occupied[p] &= ~(1 << tile.index)
+
+    def reset_hash(self):
+        # Zobrist hash of the piece locations; apply_move/undo_last_move keep it up to date
+        self.piece_hash = self.topology.position_hash(self.get_locations(), False)
+
+    def get_hash(self):
+        return self.piece_hash ^ (self.topology.side_key if self.current_player == 'black' else 0)
+
+    def get_blocked_mask(self, player=None):
+        # bitset of the field tiles this player can't pass through or land on
+        if not player:
+            player = self.current_player
+        mask = 0
+        for tile in self.field_tiles:
+            if len(tile.pieces) > 1 and tile.pieces[0].player != player:
+                mask |= 1 << tile.index
+        return mask
+
+    def get_reachable_tiles(self, start_tile, steps, blocked=None):
+        if blocked is None:
+            blocked = self.get_blocked_mask()
+        reachable = self.topology.reachable_mask(start_tile.index, steps, blocked)
+        return [self.tiles[i] for i in iter_bits(reachable)]
+
+    def iter_piece_moves(self, piece, mask_offgoals = False):
+        # this piece's moves, one roll at a time, so a caller that stops early skips the rest of the search
         if piece.rack and piece.rack in [self.white_unentered, self.black_unentered]:   # if an unentered piece, start from the home tile
             start_tile = self.home_tile
         else:
             start_tile = piece.tile
 
-        if not self.dice[0].used:
-            reachable_tiles[self.dice[0].number] = self.get_reachable_tiles(start_tile, self.dice[0].number)
-
-            if self.firstMove and self.firstMove['piece'] == piece: 
-                origin_tile = self.firstMove['origin_tile'] or self.home_tile
-                reachable_by_sum = self.get_reachable_tiles(origin_tile, self.dice[0].number + self.dice[1].number)
-                reachable_tiles[self.dice[0].number] = [tile for tile in reachable_tiles[self.dice[0].number] if tile in reachable_by_sum]
-
-        if not self.dice[1].used:
-            reachable_tiles[self.dice[1].number] = self.get_reachable_tiles(start_tile, self.dice[1].number)
-
-            if self.firstMove and self.firstMove['piece'] == piece:
-                origin_tile = self.firstMove['origin_tile'] or self.home_tile
-                reachable_by_sum = self.get_reachable_tiles(origin_tile, self.dice[0].number + self.dice[1].number)     
-                reachable_tiles[self.dice[1].number] = [tile for tile in reachable_tiles[self.dice[1].number] if tile in reachable_by_sum]
+        blocked = self.get_blocked_mask()
+        reachable_by_sum = None
+        if self.firstMove and self.firstMove['piece'] == piece:
+            origin_tile = self.firstMove['origin_tile'] or self.home_tile
+            reachable_by_sum = self.topology.reachable_mask(origin_tile.index, self.dice[0].number + self.dice[1].number, blocked)
 
-
-        if piece.tile and piece.tile.type == 'save' and self.game_stages[piece.player] != 'opening':
+        save_roll = None
+        if piece.tile and piece.tile.is_save and self.game_stages[piece.player] != 'opening':
             save_roll = self.get_saving_die(piece)
-            if save_roll:             
-                reachable_tiles[save_roll].append('save') 
-
-        piece.reachable_tiles = reachable_tiles
-
-    def get_valid_moves(self, mask_offgoals = False):
-
-        if self.dice[0].used and self.dice[1].used:
-            return []
 
+        piece_id = (piece.player, piece.number)
+        offgoal_masked = mask_offgoals and piece.can_be_saved()
+        rolls = [self.dice[0].number] if self.dice[0].number == self.dice[1].number else [die.number for die in self.dice]
+        for roll in rolls:
+            if any(not die.used and die.number == roll for die in self.dice):
+                reachable = self.topology.reachable_mask(start_tile.index, roll, blocked)
+                if reachable_by_sum is not None:
+                    reachable &= reachable_by_sum
+                for i in iter_bits(reachable):
+                    destination = self.tiles[i]
+                    if offgoal_masked and (piece.number <= 6 or roll != 4 or not destination.is_save):
+                        continue   # don't include offgoal moves
+                    yield (piece_id, (destination.ring, destination.pos), roll)
+            if save_roll == roll:
+                yield (piece_id, 'save', roll)
+
+    def get_movable_pieces(self):
         # if must move captured piece(s), do so
         captured_pieces = [piece for piece in self.home_tile.pieces if piece.player == self.current_player]
         if captured_pieces:
-            for piece in captured_pieces:
-                self.get_reachable_tiles_by_dice(piece)
-            self.destinations_by_piece = {piece: piece.reachable_tiles for piece in captured_pieces}
+            return captured_pieces
 
         # if must move unentered piece, do so
-        elif self.must_move_unentered():
-            piece = self.get_unentered_piece()
-            self.get_reachable_tiles_by_dice(piece)
-            self.destinations_by_piece = {piece: piece.reachable_tiles}
-            
-        else:
-            player_pieces = [p for p in self.pieces if p.player == self.current_player and p.tile and p.tile.type in ['field', 'save']]
+        if self.must_move_unentered():
+            return [self.get_unentered_piece()]
 
-            # check if there's an unentered piece which can enter, and if so add it to the list of pieces
-            unentered_piece = self.get_unentered_piece()
-            if unentered_piece:
-                player_pieces.append(unentered_piece)
+        player_pieces = [p for p in self.pieces if p.player == self.current_player and p.tile and p.tile.passable]
 
-            for piece in player_pieces:
-                self.get_reachable_tiles_by_dice(piece)
-        
-            self.destinations_by_piece = {piece: piece.reachable_tiles for piece in player_pieces}
-
-        # transform the dictionary so that items are tuples of (piece, tile, roll)
-        tuples_list = []
-        for piece, moves in self.destinations_by_piece.items():
-            for roll, destinations in moves.items():
-                if destinations:  # Ignore empty destinations
-                    for destination in destinations:
-                        
-                        if destination == 'save':
-                            tuples_list.append(((piece.player, piece.number), destination, roll))
-                        elif mask_offgoals and piece.can_be_saved() and (piece.number <=6 or roll != 4 or destination.type != 'save'):
-                            continue   # don't include offgoal moves
-                        else:
-                            tuples_list.append(((piece.player, piece.number), (destination.ring, destination.pos), roll))
+        # check if there's an unentered piece which can enter, and if so add it to the list of pieces
+        unentered_piece = self.get_unentered_piece()
+        if unentered_piece:
+            player_pieces.append(unentered_piece)
+        return player_pieces
+
+    def iter_valid_moves(self, mask_offgoals = False):
+        # Legal moves as (piece, destination, roll) tuples, generated on demand and without the pass move.
+        # Each piece's moves are only searched for once the ones before it have been taken, and the
+        # board mustn't change until the caller is done with the generator.
+        if self.dice[0].used and self.dice[1].used:
+            return
+        for piece in self.get_movable_pieces():
+            yield from self.iter_piece_moves(piece, mask_offgoals)
 
+    def get_valid_moves(self, mask_offgoals = False):
+        if self.dice[0].used and self.dice[1].used:
+            return []
+        tuples_list = list(self.iter_valid_moves(mask_offgoals))
         tuples_list.append((0, 0, 0))  # add a pass move
 
       #   add tuples of form (piece, 0, 0) for saving opponent's piece 
@@ -389,84 +680,88 @@ class Board:
         #    for piece in opponent_pieces:
          #       tuples_list.append(((piece.player, piece.number), 0, 0))
 
-  
         return tuples_list
-    
-    def save_move(self, move, origin_tile = None, origin_rack = None, captured_piece = None):
-        piece_id, destination, roll = move
 
-        move_to_save = dict()
-        move_to_save['piece'] = next((p for p in self.pieces if (p.player, p.number) == piece_id), None)
-        move_to_save['origin_tile'] = origin_tile
-        move_to_save['origin_rack'] = origin_rack
-        move_to_save['destination'] = destination
-        move_to_save['captured_piece'] = captured_piece
-        move_to_save['roll'] = roll
+    def has_valid_move(self, mask_offgoals = False):
+        # False when the only move is to pass; stops at the first legal move
+        return next(self.iter_valid_moves(mask_offgoals), None) is not None
 
-        self.moves.append(move_to_save)
+    def can_save(self):
+        # whether any piece can be saved with the dice left, without generating the other moves
+        if self.dice[0].used and self.dice[1].used:
+            return False
+        return any(piece.tile and piece.tile.is_save and self.get_saving_die(piece)
+                   for piece in self.get_movable_pieces())
 
     def undo_last_move(self):
         if not self.moves:
             return
 
-        last_move = self.moves.pop()
-        piece = last_move['piece']
-        origin_tile = last_move['origin_tile']
-        origin_rack = last_move['origin_rack']
-        destination = last_move['destination']
-        captured_piece = last_move['captured_piece']
-        roll = last_move['roll']
+        record = self.moves.pop()
+        data = self.moves.data
+        piece = self.slot_pieces[data[record + UNDO_SLOT]]
+        origin = data[record + UNDO_ORIGIN]
+        destination = data[record + UNDO_DESTINATION]
+        captured = data[record + UNDO_CAPTURED]
+        origin_tile = self.tiles[origin] if origin >= 0 else None
+        moved_from = self.get_location(piece)
 
         # Undo the move
-        if destination == 'save':
-            saved_rack = self.white_saved if piece.player == 'white' else self.black_saved
+        if destination == SAVED:
+            saved_rack = self.white_saved if piece.side == WHITE else self.black_saved
             saved_rack.remove(piece)
             piece.rack = None
             piece.tile = origin_tile
             origin_tile.pieces.append(piece)
-        elif destination == 0:    # undo saving opponent's block
-            saved_rack = self.white_saved if piece.player == 'black' else self.black_saved
+            self.goal_counts[piece.side] -= 1  # back on its goal, counted again by enter_tile
+            self.enter_tile(piece, origin_tile)
+        elif destination == SAVED_BY_OPPONENT:    # undo saving opponent's block
+            saved_rack = self.white_saved if piece.side == BLACK else self.black_saved
             saved_rack.remove(piece)
             piece.rack = None
             piece.tile = origin_tile
             origin_tile.pieces.append(piece)
+            self.recount()
         else:
-            new_tile = self.get_tile(*destination)
+            new_tile = self.tiles[destination]
             new_tile.pieces.remove(piece)
             piece.tile = None
+            self.leave_tile(piece, new_tile)
             if origin_tile:
                 origin_tile.pieces.append(piece)
                 piece.tile = origin_tile
-            elif origin_rack:
+                self.enter_tile(piece, origin_tile)
+            else:
+                origin_rack = self.get_unentered_rack(piece.player)
                 origin_rack.insert(0, piece)
                 piece.rack = origin_rack
 
-            if captured_piece:      # undo the capture
+            if captured >= 0:      # undo the capture
+                captured_piece = self.slot_pieces[captured]
+                self.home_tile.pieces.remove(captured_piece)
                 new_tile.pieces.append(captured_piece)
                 captured_piece.tile = new_tile
+                captured_keys = self.topology.piece_keys[captured]
+                self.piece_hash ^= captured_keys[self.home_tile.index] ^ captured_keys[new_tile.index]
 
-        # Mark the die as unused
-        if roll == self.dice[0].number and self.dice[0].used:
-            self.dice[0].used = False
-        elif roll == self.dice[1].number and self.dice[1].used:
-            self.dice[1].used = False
+        piece_keys = self.topology.piece_keys[piece.slot]
+        self.piece_hash ^= piece_keys[moved_from] ^ piece_keys[self.get_location(piece)]
 
-        # if exactly one die is now unused, this was the first move, so clear self.firstMove
-        # changed 1 to 2 to see if this fixes the bug where agent moving out the first piece ignored the rule -- evaluate
-        if sum(not die.used for die in self.dice) == 2:
+        # the dice, the first move and the mover's stage go back to what they were
+        dice = data[record + UNDO_DICE]
+        self.dice[0].used = bool(dice & 1)
+        self.dice[1].used = bool(dice & 2)
+        if data[record + UNDO_FIRST_MOVE]:
             self.firstMove = None
-        
-
         self.current_player = piece.player
-        self.game_stages[self.current_player] = self.get_game_stage(self.current_player)
-        self.check_game_over()
+        self.game_stages[self.current_player] = GAME_STAGES[data[record + UNDO_STAGE]]
     
     def apply_move(self, move, switch_turn = True):
         piece_id, destination, roll = move
 
-        captured_piece = None
-        origin_tile = None
-        origin_rack = None
+        captured = -1
+        origin = UNENTERED
+        set_first_move = False
 
         # Handle the pass move (0, 0, 0)
         if move == (0, 0, 0):
@@ -475,61 +770,77 @@ class Board:
             return
 
         # Find the piece object
-        piece = next((p for p in self.pieces if (p.player, p.number) == piece_id), None)
+        piece = self.slot_pieces[piece_slot(*piece_id)]
         if not piece:
-            print(f"No piece found for {piece_id}")
+            logger.warning('No piece found for %s', piece_id)
             return
+        moved_from = self.get_location(piece)
+        dice = self.dice[0].used | self.dice[1].used << 1
+        stage = GAME_STAGES.index(self.game_stages[piece.player])
 
         # Handle saving opponent's piece
 
         if destination == 0 and roll == 0:
-            saved_rack = self.white_saved if piece.player == 'black' else self.black_saved
+            saved_rack = self.white_saved if piece.side == BLACK else self.black_saved
             saved_rack.append(piece)
             if piece.tile:
                 piece.tile.pieces.remove(piece)
-                origin_tile = piece.tile
+                origin = piece.tile.index
             piece.tile = None
             piece.rack = saved_rack
             for die in self.dice:
                 die.used = True
+            self.recount()
+            target = SAVED_BY_OPPONENT
 
         # Handle saving a piece
         elif destination == 'save':
-            saved_rack = self.white_saved if piece.player == 'white' else self.black_saved
+            saved_rack = self.white_saved if piece.side == WHITE else self.black_saved
             saved_rack.append(piece)
             if piece.tile:
                 piece.tile.pieces.remove(piece)
-                origin_tile = piece.tile
+                origin = piece.tile.index
+                self.leave_tile(piece, piece.tile)
+                self.goal_counts[piece.side] += 1  # saved pieces still count as on goal
             piece.tile = None
             piece.rack = saved_rack
+            target = SAVED
 
         else:
             # Handle moving to a new tile
-            ring, pos = destination
-            new_tile = self.get_tile(ring, pos)
+            new_tile = self.tile_map[destination]
+            target = new_tile.index
 
             # Remove the piece from its current location (rack or tile)
             if piece.rack:
-                origin_rack = piece.rack
                 piece.rack.remove(piece)
                 piece.rack = None
             if piece.tile:
                 piece.tile.pieces.remove(piece)
-                origin_tile = piece.tile
+                origin = piece.tile.index
+                self.leave_tile(piece, piece.tile)
             
             # Set the first move if not set already
             if not self.firstMove:
                 self.firstMove = {'piece': piece, 'origin_tile': piece.tile}
+                set_first_move = True
 
             # Check if we are capturing an opponent piece (only on field tiles)
-            if new_tile.type == 'field' and new_tile.pieces and new_tile.pieces[0].player != piece.player:
+            if new_tile.is_field and new_tile.pieces and new_tile.pieces[0].player != piece.player:
                 captured_piece = new_tile.pieces.pop()
                 captured_piece.tile = self.home_tile
                 self.home_tile.pieces.append(captured_piece)
+                captured = captured_piece.slot
+                captured_keys = self.topology.piece_keys[captured]
+                self.piece_hash ^= captured_keys[new_tile.index] ^ captured_keys[self.home_tile.index]
 
             # Move the piece to the new tile
             new_tile.pieces.append(piece)
             piece.tile = new_tile
+            self.enter_tile(piece, new_tile)
+
+        piece_keys = self.topology.piece_keys[piece.slot]
+        self.piece_hash ^= piece_keys[moved_from] ^ piece_keys[self.get_location(piece)]
 
         # Mark the die as used
         if roll == self.dice[0].number and not self.dice[0].used:
@@ -539,11 +850,10 @@ class Board:
 
         self.game_stages[self.current_player] = self.get_game_stage(self.current_player)
 
-        self.save_move(move, origin_tile, origin_rack, captured_piece)
+        self.moves.push(piece.slot, origin, target, captured, dice, set_first_move, stage)
 
         # Switch to the next player if both dice are used
         if switch_turn and all(die.used for die in self.dice):
-            print('switching turn')
             self.switch_turn()
 
     def get_save_rack(self, player):
@@ -552,49 +862,37 @@ class Board:
     def get_unentered_rack(self, player):
         return self.white_unentered if player == 'white' else self.black_unentered
 
+    def get_unentered_slots(self, player):
+        # slots of the player's unentered pieces, next to enter first
+        return [piece.slot for piece in self.get_unentered_rack(player)]
+
     def shortest_route_to_goal(self, piece):
         start_tile = piece.tile if piece.tile else self.home_tile  # Use home tile if the piece has no tile
 
         if piece.can_be_saved():
             return 0
 
-        queue = deque([(start_tile, 0)])  # (current tile, distance)
-        visited = set([start_tile])
-
-        while queue:
-            current_tile, distance = queue.popleft()
-            for neighbor in current_tile.neighbors:
-                if neighbor not in visited:
-                    visited.add(neighbor)
-                    if neighbor.type == 'save' and (piece.number > 6 or piece.number == neighbor.number):
-                        return distance + 1  # Found a goal tile from which the piece can be saved
-                    if neighbor.type not in ['nogo', 'home'] and not neighbor.is_blocked(piece.player):
-                        queue.append((neighbor, distance + 1))
-
-        return float('inf')  # No path found to a goal tile
+        goal_class = piece.number if piece.number <= 6 else 0  # unnumbered pieces can use any goal
+        return self.topology.goal_distance(start_tile.index, goal_class, self.get_blocked_mask(piece.player))
     
     def count_pieces_reaching_goals(self):
         # Initialize counters for each possible die roll (1-6)
         reachable_counts = [0] * 6
+        blocked = self.get_blocked_mask()
         
         # Iterate over all pieces on the board
         for piece in self.pieces:
             # Skip pieces on racks, on the home tile, or unnumbered pieces already on a goal
             if not piece.tile or piece.tile == self.home_tile or piece.can_be_saved():
                 continue
+
+            # Numbered pieces must reach their specific goal, unnumbered pieces can reach any goal
+            goals = self.topology.goal_masks[piece.number if piece.number < 7 else 0]
             
-            # Calculate reachable tiles for each roll from 1 to 6
+            # Check which rolls from 1 to 6 land the piece on a goal
             for roll in range(1, 7):
-                reachable_tiles = self.get_reachable_tiles(piece.tile, roll)
-                
-                # Check if the piece can reach its goal with this roll
-                if piece.number < 7:  # Numbered piece must reach its specific goal
-                    matching_goal = next((tile for tile in reachable_tiles if tile.type == 'save' and tile.number == piece.number), None)
-                    if matching_goal:
-                        reachable_counts[roll - 1] += 1
-                else:  # Unnumbered piece can reach any goal
-                    if any(tile.type == 'save' for tile in reachable_tiles):
-                        reachable_counts[roll - 1] += 1
+                if self.topology.reachable_mask(piece.tile.index, roll, blocked) & goals:
+                    reachable_counts[roll - 1] += 1
 
         return reachable_counts
 
@@ -613,7 +911,7 @@ class Board:
 
 
     def get_all_possible_moves(self):
-        destination_tiles = [tile.index for tile in self.tiles if tile.type in ['field','save']]
+        destination_tiles = [tile.index for tile in self.tiles if tile.passable]
         pieces = range(len(self.pieces))
         all_possible_moves = list(itertools.product(pieces, destination_tiles))
         all_possible_moves.insert(0, (0, 0))  # Add the tuple (0,0,0) for passing
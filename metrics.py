@@ -0,0 +1,149 @@
+import bisect
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+PROFILE_LINES = 40  # functions listed in a ?profile=1 breakdown, by cumulative time
+HOT_PATHS = {  # module: class: methods timed when METRICS_HOT_PATHS=1
+    'game': {'Board': ['get_valid_moves', 'apply_move', 'undo_last_move']},
+    'bitboard': {'BitBoard': ['get_valid_moves', 'apply_move', 'undo_last_move']},
+    'agent': {'Agent': ['score_position', 'evaluate_player']},
+    'topology': {'Topology': ['reachable_mask', 'goal_distance']},
+}
+
+_metrics = []
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    """Request latency histograms per endpoint and game stage, and call counts and time per hot-path function.
+
+    Hot-path timing wraps the engine's methods, so it costs a timer pair per call and is only
+    switched on by instrument(). The topology's cache and BFS counters are always kept and are
+    reported either way.
+    """
+
+    def __init__(self):
+        self.requests = {}  # (endpoint, stage) -> Histogram
+        self.calls = {}  # 'Class.method' -> [calls, seconds]
+        self.lock = threading.Lock()
+
+    def observe(self, endpoint, stage, seconds):
+        with self.lock:
+            histogram = self.requests.get((endpoint, stage or 'unknown'))
+            if histogram is None:
+                histogram = self.requests[endpoint, stage or 'unknown'] = Histogram()
+            histogram.observe(seconds)
+
+    def timed(self, name, function):
+        totals = self.calls.setdefault(name, [0, 0.0])
+        lock = self.lock  # Flask serves requests on threads, and += on a shared list entry isn't atomic
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with lock:
+                    totals[0] += 1
+                    totals[1] += elapsed
+        return wrapper
+
+    def instrument(self):
+        # replaces the HOT_PATHS methods with timed wrappers, for every instance in this process
+        import importlib
+        for module_name, classes in HOT_PATHS.items():
+            module = importlib.import_module(module_name)
+            for class_name, methods in classes.items():
+                cls = getattr(module, class_name)
+                for method in methods:
+                    name = f'{class_name}.{method}'
+                    if name not in self.calls:
+                        setattr(cls, method, self.timed(name, getattr(cls, method)))
+
+    def hot_paths(self):
+        # plain totals, so worker processes can send theirs to be added up
+        from topology import _topologies
+        with self.lock:
+            totals = {name: list(entry) for name, entry in self.calls.items()}
+        counters = {'route_hits': 0, 'route_misses': 0, 'bfs_calls': 0}
+        for topology in _topologies.values():
+            for counter in counters:
+                counters[counter] += getattr(topology, counter)
+        return {'calls': totals, 'counters': counters}
+
+    def render(self, hot_paths=None):
+        # Prometheus text exposition format
+        hot_paths = hot_paths or self.hot_paths()
+        lines = ['# HELP boardgame_request_seconds Request latency by endpoint and game stage of the mover.',
+                 '# TYPE boardgame_request_seconds histogram']
+        with self.lock:
+            requests = sorted((key, list(histogram.counts), histogram.sum) for key, histogram in self.requests.items())
+        for (endpoint, stage), counts, total in requests:
+            labels = f'endpoint="{endpoint}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'boardgame_request_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'boardgame_request_seconds_sum{{{labels}}} {total}')
+            lines.append(f'boardgame_request_seconds_count{{{labels}}} {cumulative}')
+
+        lines += ['# HELP boardgame_hot_path_calls_total Calls to instrumented engine functions.',
+                  '# TYPE boardgame_hot_path_calls_total counter']
+        lines += [f'boardgame_hot_path_calls_total{{function="{name}"}} {calls}'
+                  for name, (calls, _) in sorted(hot_paths['calls'].items())]
+        lines += ['# HELP boardgame_hot_path_seconds_total Time inside instrumented engine functions, nested calls included.',
+                  '# TYPE boardgame_hot_path_seconds_total counter']
+        lines += [f'boardgame_hot_path_seconds_total{{function="{name}"}} {seconds}'
+                  for name, (_, seconds) in sorted(hot_paths['calls'].items())]
+        for counter, value in sorted(hot_paths['counters'].items()):
+            lines += [f'# TYPE boardgame_{counter}_total counter', f'boardgame_{counter}_total {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def merge_hot_paths(parts):
+    merged = {'calls': {}, 'counters': {}}
+    for part in parts:
+        for name, (calls, seconds) in part['calls'].items():
+            entry = merged['calls'].setdefault(name, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+        for counter, value in part['counters'].items():
+            merged['counters'][counter] = merged['counters'].get(counter, 0) + value
+    return merged
+
+
+def get_metrics():
+    # the process-wide metrics; METRICS_HOT_PATHS=1 times the engine's hot paths as well
+    if not _metrics:
+        metrics = Metrics()
+        if os.environ.get('METRICS_HOT_PATHS') == '1':
+            metrics.instrument()
+        _metrics.append(metrics)
+    return _metrics[0]
+
+
+def profiled(function, *args):
+    # function's result and a cProfile breakdown of the call as text
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return result, out.getvalue()
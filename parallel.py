@@ -0,0 +1,98 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from agent import Agent, PASS
+from bitboard import BitBoard
+from game import Board
+
+ENGINES = {'Board': Board, 'BitBoard': BitBoard}
+
+PARALLEL_MIN_MOVES = 12  # fewer first moves than this are searched serially, in this process
+CHUNKS_PER_WORKER = 4  # smaller chunks even out subtrees of very different sizes
+
+_worker = {}
+
+
+def start_worker(weights, model=None):
+    # runs once per pool process: the board graph is loaded and the agent's caches stay warm between requests
+    _worker['agent'] = Agent(weights=weights, model=model)
+    _worker['boards'] = {'Board': Board()}
+
+
+def search_first_moves(position, kind, first_moves, player):
+    # best score under each first move, with every pair that reaches it, and the positions searched for them
+    agent = _worker['agent']
+    nodes = agent.nodes
+    board = _worker['boards'].get(kind)
+    if board is None:
+        board = _worker['boards'][kind] = ENGINES[kind]()
+    board.from_array(position)
+
+    results = []
+    for move in first_moves:
+        best_score, best_pairs = None, []
+        for move_pair in agent.iter_follow_ups(move, board):
+            score = agent.score(board, player)
+            if best_score is None or score > best_score:
+                best_score, best_pairs = score, [move_pair]
+            elif score == best_score:
+                best_pairs.append(move_pair)
+        results.append((best_score, best_pairs))
+    return results, agent.nodes - nodes
+
+
+class ParallelSearch:
+    """Root-split search over a pool of worker processes.
+
+    The subtree under each first move is independent, so first moves are dealt out in chunks and
+    each worker returns the best pair of every subtree it searched. Merging those in the original
+    move order keeps search_exhaustive's choice, ties included. Small move sets aren't worth the
+    round trip and are searched serially.
+    """
+
+    def __init__(self, agent, workers=None):
+        self.agent = agent
+        self.workers = workers or os.cpu_count()
+        self.pool = None
+
+    def run(self, moves, board, player):
+        # same order as Agent.iter_move_pairs, so the merge breaks ties the same way
+        first_moves = set(moves)
+        first_moves.discard(PASS)
+        first_moves = list(first_moves)
+        if len(first_moves) < PARALLEL_MIN_MOVES or self.workers < 2:
+            return self.agent.search_exhaustive(moves, board, player)
+
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers, initializer=start_worker, initargs=(self.agent.weights, self.agent.model))
+
+        # workers get a SNAPSHOT_SIZE-byte snapshot and replay it on the caller's engine
+        position = board.to_array()
+        size = -(-len(first_moves) // (self.workers * CHUNKS_PER_WORKER))
+        chunks = [first_moves[i:i + size] for i in range(0, len(first_moves), size)]
+        jobs = [self.pool.submit(search_first_moves, position, type(board).__name__, chunk, player) for chunk in chunks]
+
+        self.agent.nodes += 1  # the root, scored as the pass pair
+        best_score, best_pairs = self.agent.score(board, player), [(PASS, PASS)]
+        for chunk, job in zip(chunks, jobs):
+            results, nodes = job.result()
+            self.agent.nodes += nodes  # the workers' positions count towards this search
+            for move, (score, move_pairs) in zip(chunk, results):
+                if score > best_score:
+                    best_score, best_pairs, best_move = score, move_pairs, move
+        best_move_pair = best_pairs[0] if len(best_pairs) == 1 else self.first_in_order(best_move, best_pairs, board)
+        return best_move_pair, self.agent.evaluate_move_pair(board, best_move_pair, player)
+
+    def first_in_order(self, move, move_pairs, board):
+        # A worker's Board can list pieces in another order and so enumerate follow-ups differently;
+        # settle ties in the order this process would have searched them
+        board.apply_move(move, switch_turn = False)
+        next_moves = set(board.get_valid_moves())
+        next_moves.discard(PASS)
+        board.undo_last_move()
+        order = [(move, PASS)] + [(move, next_move) for next_move in next_moves]
+        return min(move_pairs, key=order.index)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import random
+import time
+from array import array
+from agent import Agent, PASS, SEARCH_MODES
+from bitboard import BitBoard
+from game import Board
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ENGINES = {'board': Board, 'bitboard': BitBoard}
+MAX_TURNS = 400  # games still running after this many turns are stopped and counted as unfinished
+PERCENTILES = [50, 90, 99]
+CORPUS_FILE = 'benchmarks.json'  # next to this module, wherever the script is run from
+CORPUS_KINDS = ['opening', 'midgame', 'endgame', 'capture']
+CORPUS_PER_KIND = 3
+CORPUS_SAMPLE_RATE = 0.2  # chance a turn is considered for the corpus, so samples aren't all the first turn of their kind
+BENCH_REPEATS = 5  # timings in the benchmark are the median of this many runs
+
+
+class RandomPlayer:
+    """Opponent that plays a uniformly random move, then a uniformly random follow-up."""
+
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+
+    def select_move_pair(self, moves, board, player):
+        # sorted first, so the seed alone decides the choice and not set iteration order
+        move = self.random.choice(sorted(moves, key=repr))
+        if move == PASS:
+            return PASS, PASS
+        board.apply_move(move, switch_turn = False)
+        next_move = self.random.choice(sorted(board.get_valid_moves(), key=repr))
+        board.undo_last_move()
+        return move, next_move
+
+
+class SelfPlayStats:
+    def __init__(self):
+        self.games = 0
+        self.finished = 0
+        self.wins = {'white': 0, 'black': 0}
+        self.turns = 0
+        self.moves = 0
+        self.evaluations = 0
+        self.latencies = []  # seconds per select_move_pair call
+        self.elapsed = 0
+
+    def report(self):
+        elapsed = self.elapsed or float('inf')
+        lines = [
+            f'games: {self.games} ({self.finished} finished, white {self.wins["white"]}, black {self.wins["black"]})',
+            f'games/sec: {self.games / elapsed:.3f}',
+            f'moves/sec: {self.moves / elapsed:.1f} ({self.turns} turns, {self.moves} moves)',
+            f'evaluations/sec: {self.evaluations / elapsed:.1f} ({self.evaluations} evaluations)',
+        ]
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            points = [f'p{p} {percentile(latencies, p) * 1000:.1f}' for p in PERCENTILES]
+            lines.append(f'decision latency ms: {", ".join(points)}, max {latencies[-1] * 1000:.1f}')
+        return '\n'.join(lines)
+
+
+def percentile(ordered, p):
+    # nearest rank
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+
+def evaluations_of(player):
+    # leaf evaluations so far, cache hits included; the random player doesn't evaluate
+    return getattr(player, 'transposition_hits', 0) + getattr(player, 'transposition_misses', 0)
+
+
+def start_next_turn(board):
+    # what the browser does between turns: roll for the other player, who then posts the state
+    board.moves.clear()
+    board.switch_turn()
+    board.game_stages[board.current_player] = board.get_game_stage(board.current_player)
+
+
+def play_game(players, engine='board', seed=None, stats=None, on_turn=None):
+    # Plays one game to the end or MAX_TURNS; players maps each colour to anything with select_move_pair.
+    # The global random module is seeded because the engines roll their dice and shuffle their racks with it.
+    # The agent breaks ties in set order, so replaying a game move for move also needs a fixed PYTHONHASHSEED.
+    random.seed(seed)
+    board = ENGINES[engine]()
+    stats = stats or SelfPlayStats()
+    stats.games += 1
+
+    for turn in range(MAX_TURNS):
+        winner, margin = board.check_game_over()
+        if winner:
+            stats.finished += 1
+            stats.wins[winner] += 1
+            return winner, margin
+        if on_turn:
+            on_turn(board, turn)
+
+        player = board.current_player
+        moves = board.get_valid_moves(mask_offgoals=True)
+        if moves:
+            evaluations = evaluations_of(players[player])
+            start = time.perf_counter()
+            move_pair = players[player].select_move_pair(moves, board, player)
+            stats.latencies.append(time.perf_counter() - start)
+            stats.evaluations += evaluations_of(players[player]) - evaluations
+
+            for move in move_pair:
+                if move == PASS:
+                    break
+                board.apply_move(move, switch_turn = False)
+                stats.moves += 1
+        stats.turns += 1
+        start_next_turn(board)
+    return None, None
+
+
+def run_selfplay(games, engine='board', seed=0, search='exhaustive', opponent='agent'):
+    agent = Agent(search=search)
+    players = {'white': agent, 'black': agent if opponent == 'agent' else RandomPlayer(seed)}
+    stats = SelfPlayStats()
+    start = time.perf_counter()
+    try:
+        for game in range(games):
+            play_game(players, engine, seed + game, stats)
+    finally:
+        if agent.parallel is not None:
+            agent.parallel.close()
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+def corpus_kind(board):
+    # which benchmark bucket a position belongs in, if any
+    if any(board.get_location(piece) == board.home_tile.index for piece in board.pieces):
+        return 'capture'
+    stage = board.game_stages[board.current_player]
+    return stage if stage in CORPUS_KINDS else None
+
+
+def build_corpus(seed=0, games=60):
+    # Positions sampled from seeded agent-vs-random games, CORPUS_PER_KIND of each kind, spread over the games
+    positions = []
+    counts = dict.fromkeys(CORPUS_KINDS, 0)
+    agent = Agent()
+    for game in range(games):
+        sampled = set()
+        chooser = random.Random(seed + game)
+
+        def sample(board, turn):
+            kind = corpus_kind(board)
+            if not kind or kind in sampled or counts[kind] == CORPUS_PER_KIND or chooser.random() >= CORPUS_SAMPLE_RATE:
+                return
+            if board.has_valid_move():
+                sampled.add(kind)
+                counts[kind] += 1
+                positions.append({'name': f'{kind}-{counts[kind]}', 'kind': kind, 'seed': seed + game,
+                                  'turn': turn, 'snapshot': list(board.to_array())})
+
+        play_game({'white': agent, 'black': RandomPlayer(seed + game)}, 'board', seed + game, on_turn=sample)
+        if all(count == CORPUS_PER_KIND for count in counts.values()):
+            break
+    return sorted(positions, key=lambda position: (CORPUS_KINDS.index(position['kind']), position['name']))
+
+
+def load_corpus(filename=CORPUS_FILE):
+    with open(os.path.join(BASE_DIR, filename)) as file:
+        return json.load(file)
+
+
+def median_time(run, repeats=BENCH_REPEATS):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def run_benchmarks(engines=ENGINES, search='exhaustive', repeats=BENCH_REPEATS):
+    # Times the hot paths on every corpus position: move generation, a cold full evaluation and a whole
+    # decision with an empty transposition table. Returns one row per position and engine.
+    agent = Agent(search=search)
+    rows = []
+    for position in load_corpus():
+        for engine in engines:
+            board = ENGINES[engine]()
+            board.from_array(array('b', position['snapshot']))
+            player = board.current_player
+            moves = board.get_valid_moves(mask_offgoals=True)
+
+            def evaluate():
+                agent.evaluator.reset(board.topology)
+                agent.score_position(board, player)
+
+            def decide():
+                agent.transpositions.clear()
+                agent.select_move_pair(moves, board, player)
+
+            evaluations = evaluations_of(agent)
+            rows.append({
+                'name': position['name'],
+                'engine': engine,
+                'moves': len(moves),
+                'generate_us': median_time(lambda: board.get_valid_moves(mask_offgoals=True), repeats) * 1e6,
+                'evaluate_us': median_time(evaluate, repeats) * 1e6,
+                'select_ms': median_time(decide, repeats) * 1e3,
+                'evaluations': (evaluations_of(agent) - evaluations) // repeats,
+            })
+    if agent.parallel is not None:
+        agent.parallel.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless self-play and hot-path benchmarks.')
+    parser.add_argument('--games', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=list(ENGINES), default='board')
+    parser.add_argument('--search', choices=SEARCH_MODES, default='exhaustive')
+    parser.add_argument('--opponent', choices=['agent', 'random'], default='agent')
+    parser.add_argument('--bench', action='store_true', help=f'time the positions in {CORPUS_FILE} instead of playing')
+    parser.add_argument('--build-corpus', action='store_true', help=f'regenerate {CORPUS_FILE} from seeded games')
+    args = parser.parse_args()
+
+    if args.build_corpus:
+        with open(os.path.join(BASE_DIR, CORPUS_FILE), 'w') as file:
+            # one position per line
+            file.write('[\n' + ',\n'.join(json.dumps(position) for position in build_corpus(args.seed)) + '\n]\n')
+    elif args.bench:
+        print(f'{"position":<12} {"engine":<9} {"moves":>5} {"generate us":>12} {"evaluate us":>12} {"select ms":>10} {"evals":>6}')
+        for row in run_benchmarks(search=args.search):
+            print(f'{row["name"]:<12} {row["engine"]:<9} {row["moves"]:>5} {row["generate_us"]:>12.1f} '
+                  f'{row["evaluate_us"]:>12.1f} {row["select_ms"]:>10.2f} {row["evaluations"]:>6}')
+    else:
+        print(run_selfplay(args.games, args.engine, args.seed, args.search, args.opponent).report())
+
+
+if __name__ == '__main__':
+    main()
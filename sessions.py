@@ -0,0 +1,154 @@
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from agent import Agent, SEARCH_DEPTH, SEARCH_TIME_BUDGET
+from bitboard import BitBoard
+from book import BOOK_SEARCHES, load_book
+from game import Board
+from tracing import get_tracer
+
+SESSION_POOL_SIZE = 32  # games kept in memory per server process; each holds an agent and its transposition table
+DEFAULT_GAME = 'default'  # requests without a game id all share this game
+
+
+class StaleVersion(Exception):
+    # a delta named a position this session doesn't hold; the client has to resend the full state
+    pass
+
+
+class Session:
+    """One game's board and agent, plus the version of the position the client last synced.
+
+    A request body is either a full state (it has 'racks'), which always resyncs, or a delta holding
+    the dice, the turn and only the pieces that moved, applied on top of the version it names in
+    'baseVersion'. Versions carry a random token per session, so a delta can't match a session that
+    was evicted and recreated, or one in another server process.
+    """
+
+    def __init__(self, board, scratch_board, agent):
+        self.board = board
+        self.scratch_board = scratch_board  # positions for /evaluate_board are restored into this one
+        self.agent = agent
+        self.lock = threading.Lock()
+        self.users = 0  # requests holding or waiting for the lock; changed under the pool's lock, and evict skips these
+        self.token = uuid.uuid4().hex[:8]
+        self.syncs = 0
+        self.version = None  # no position until the first full state
+        self.stage = None  # game stage of the player to move in the last synced position
+
+    def sync(self, board, state):
+        # brings board to the posted state and returns the game stage of the player to move
+        if 'racks' in state:
+            board.update_state(state)
+        elif self.version is not None and state.get('baseVersion') == self.version:
+            board.apply_delta(state)
+        else:
+            raise StaleVersion(f"delta against version {state.get('baseVersion')}, server has {self.version}")
+        return board.game_stages[board.current_player]
+
+    def select_moves(self, state):
+        # the /select_moves response body for a posted state; the position it leaves becomes the new version
+        board = self.board
+        self.stage = self.sync(board, state)
+        self.syncs += 1
+        self.version = f'{self.token}.{self.syncs}'
+        moves = board.get_valid_moves(mask_offgoals=True)
+        if moves:
+            body = {"move": self.agent.select_move_pair(moves, board, board.current_player), "version": self.version}
+            search = self.agent.log[-1]['components'].get('search')
+            if search:
+                body["depth"] = search['depth']  # the expectimax depth searched in full
+            return body
+        return {"message": "No valid moves", "version": self.version}
+
+    def evaluate_board(self, state):
+        # the /evaluate_board response body; the session's own board, version and stage are left as they were
+        newb = self.scratch_board
+        newb.from_array(self.board.to_array())
+        self.sync(newb, state)
+        _, val = self.agent.evaluate(newb, newb.current_player)
+        return {"eval": val}
+
+    def close(self):
+        if self.agent.parallel is not None:
+            self.agent.parallel.close()
+
+
+class SessionPool:
+    """Per-game boards and agents, keyed by game id, with the least recently used idle game evicted.
+
+    A session is locked for the whole request, so two requests for the same game run one after the
+    other and requests for different games don't wait on each other. A session is pinned from the
+    moment a request looks it up until that request is done, so it can't be evicted in between. A game evicted here, or served
+    by another worker process, is only slower, not wrong: its next delta is refused with
+    StaleVersion and the client resyncs with the full state, starting over with cold caches.
+    """
+
+    def __init__(self, make_session, capacity=SESSION_POOL_SIZE):
+        self.make_session = make_session
+        self.capacity = capacity
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def session(self, game_id):
+        with self.lock:
+            session = self.sessions.get(game_id)
+            if session is None:
+                session = self.sessions[game_id] = self.make_session()
+            session.users += 1
+            self.sessions.move_to_end(game_id)
+            evicted = self.evict()
+        self.close(evicted)
+        try:
+            with session.lock:
+                yield session
+        finally:
+            with self.lock:
+                session.users -= 1
+                evicted = self.evict()
+            self.close(evicted)
+
+    def evict(self):
+        # Takes the least recently used sessions out of the pool until it's back to capacity, and returns
+        # them. Pinned sessions are skipped, so the pool can run over capacity while they're busy.
+        evicted = []
+        for game_id in list(self.sessions):
+            if len(self.sessions) <= self.capacity:
+                break
+            if not self.sessions[game_id].users:
+                evicted.append(self.sessions.pop(game_id))
+        return evicted
+
+    def close(self, evicted):
+        # outside the pool's lock, since shutting down a process pool would hold up every other game
+        for session in evicted:
+            session.close()
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+def make_session():
+    # BOARD_ENGINE=bitboard swaps in the compact engine backend; both take the same JSON state and moves.
+    # AGENT_BOOK=0 turns off the opening book and tablebase, which are otherwise used when generated. They hold
+    # the built-in evaluation's leaf-search choices, so an expectimax search or a model plays without them.
+    # AGENT_MODEL names a network saved by features.py to score positions instead of the built-in evaluation.
+    # AGENT_SEARCH_DEPTH and AGENT_SEARCH_BUDGET (seconds) set how far and how long expectimax searches.
+    engine = BitBoard if os.environ.get('BOARD_ENGINE') == 'bitboard' else Board
+    search = os.environ.get('AGENT_SEARCH', 'exhaustive')
+    model = None
+    if os.environ.get('AGENT_MODEL'):
+        from features import MLPModel  # needs numpy, which the default evaluation doesn't
+        model = MLPModel.load(os.environ['AGENT_MODEL'])
+    use_book = os.environ.get('AGENT_BOOK', '1') != '0' and model is None and search in BOOK_SEARCHES
+    agent = Agent(search=search, book=load_book() if use_book else None, tracer=get_tracer(), model=model,
+                  search_depth=int(os.environ.get('AGENT_SEARCH_DEPTH', SEARCH_DEPTH)),
+                  time_budget=float(os.environ.get('AGENT_SEARCH_BUDGET', SEARCH_TIME_BUDGET)))
+    return Session(engine(), engine(), agent)
+
+
+def make_pool():
+    return SessionPool(make_session, int(os.environ.get('SESSION_POOL_SIZE', SESSION_POOL_SIZE)))
@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)  # the modules are imported flat, as the servers and scripts import them
+
+
+@pytest.fixture(autouse=True)
+def in_repo_dir(monkeypatch):
+    # the engines load tile_neighbors.json relative to the working directory
+    monkeypatch.chdir(REPO_DIR)
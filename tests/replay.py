@@ -0,0 +1,51 @@
+import random
+from array import array
+from game import Board
+from selfplay import load_corpus
+
+CORPUS = load_corpus()
+
+
+def play_random_turn(board, rng):
+    # one seeded random turn for the player to move, then the next player's roll
+    while any(not die.used for die in board.dice):
+        moves = sorted(board.get_valid_moves(mask_offgoals=True), key=repr)
+        if not moves or board.check_game_over()[0]:
+            break
+        board.apply_move(rng.choice(moves), switch_turn = False)
+    board.moves.clear()
+    board.start_turn('white' if board.current_player == 'black' else 'black', (rng.randint(1, 6), rng.randint(1, 6)))
+
+
+def turn_starts(turns):
+    # (name, snapshot) for each corpus position and the next turns of a seeded random game from it
+    positions = []
+    for position in CORPUS:
+        rng = random.Random(position['seed'])
+        board = Board()
+        board.from_array(array('b', position['snapshot']))
+        for turn in range(turns):
+            if board.check_game_over()[0]:
+                break
+            positions.append((f'{position["name"]}+{turn}', list(board.to_array())))
+            play_random_turn(board, rng)
+    return positions
+
+
+def full_state(board):
+    # the JSON the client posts to resync, built from a game.Board
+    def tile_of(piece):
+        return {'ring': piece.tile.ring, 'sector': piece.tile.pos}
+
+    racks = {key: [{'number': piece.number} for piece in rack] for key, rack in
+             [('whiteUnentered', board.white_unentered), ('whiteSaved', board.white_saved),
+              ('blackUnentered', board.black_unentered), ('blackSaved', board.black_saved)]}
+    board_pieces = []
+    for piece in board.pieces:
+        if piece.tile:
+            details = {'color': piece.player, 'number': piece.number, 'tile': tile_of(piece)}
+            if board.firstMove and board.firstMove['piece'] is piece:
+                details['reachableBySum'] = []
+            board_pieces.append(details)
+    return {'currentTurn': board.current_player, 'dice': [{'value': die.number, 'used': die.used} for die in board.dice],
+            'racks': racks, 'boardPieces': board_pieces}
@@ -0,0 +1,26 @@
+import pytest
+from agent import Agent
+from game import Board
+from golden import load_golden, load_position
+
+pytest.importorskip('numpy')
+
+GOLDEN = load_golden()
+
+
+def select(search, position):
+    board = load_position(Board(), position)
+    snapshot = list(board.to_array())
+    agent = Agent(search=search)
+    move_pair = agent.select_move_pair(board.get_valid_moves(mask_offgoals=True), board, board.current_player)
+    assert list(board.to_array()) == snapshot  # the search leaves the position as it found it
+    return move_pair, agent.log[-1]['score']
+
+
+@pytest.mark.parametrize('position', GOLDEN, ids=[position['name'] for position in GOLDEN])
+def test_batch_matches_exhaustive(position):
+    move_pair, score = select('batch', position)
+    expected_pair, expected_score = select('exhaustive', position)
+    assert move_pair == expected_pair
+    assert score == pytest.approx(expected_score)
+    assert score == pytest.approx(position['best'])  # and the baseline's best pair score
@@ -0,0 +1,73 @@
+import random
+from array import array
+import pytest
+from bitboard import BitBoard
+from game import Board
+from golden import as_move, load_golden, load_position
+from replay import CORPUS
+
+GOLDEN = load_golden()
+
+PLIES = 300  # moves replayed from each corpus position
+
+
+def assert_same_position(board, bitboard):
+    assert bitboard.get_locations() == board.get_locations()
+    assert bitboard.get_hash() == board.get_hash()
+    assert bitboard.current_player == board.current_player
+    assert bitboard.game_stages == board.game_stages
+    assert bitboard.check_game_over() == board.check_game_over()
+    for mask_offgoals in (False, True):
+        assert set(bitboard.get_valid_moves(mask_offgoals)) == set(board.get_valid_moves(mask_offgoals))
+
+
+@pytest.mark.parametrize('position', CORPUS, ids=[position['name'] for position in CORPUS])
+def test_bitboard_replays_board(position):
+    # the same seeded game from a corpus position, move by move and turn by turn, on both engines
+    rng = random.Random(position['seed'])
+    board, bitboard = Board(), BitBoard()
+    board.from_array(array('b', position['snapshot']))
+    bitboard.load_board(board)
+    assert_same_position(board, bitboard)
+
+    for _ in range(PLIES):
+        moves = sorted(board.get_valid_moves(mask_offgoals=True), key=repr)
+        if board.check_game_over()[0]:
+            break
+        if moves and any(not die.used for die in board.dice):
+            move = rng.choice(moves)
+            board.apply_move(move, switch_turn = False)
+            bitboard.apply_move(move, switch_turn=False)
+        else:
+            player = 'white' if board.current_player == 'black' else 'black'
+            rolls = (rng.randint(1, 6), rng.randint(1, 6))
+            board.moves.clear()
+            bitboard.moves.clear()
+            board.start_turn(player, rolls)
+            bitboard.start_turn(player, rolls)
+        assert_same_position(board, bitboard)
+
+
+@pytest.mark.parametrize('position', CORPUS, ids=[position['name'] for position in CORPUS])
+def test_bitboard_undo_matches_board(position):
+    board, bitboard = Board(), BitBoard()
+    board.from_array(array('b', position['snapshot']))
+    bitboard.load_board(board)
+    for move in sorted(board.get_valid_moves(mask_offgoals=True), key=repr):
+        if move == (0, 0, 0):
+            continue
+        board.apply_move(move, switch_turn = False)
+        bitboard.apply_move(move, switch_turn=False)
+        assert_same_position(board, bitboard)
+        board.undo_last_move()
+        bitboard.undo_last_move()
+        assert_same_position(board, bitboard)
+
+
+@pytest.mark.parametrize('engine', [Board, BitBoard], ids=['board', 'bitboard'])
+@pytest.mark.parametrize('position', GOLDEN, ids=[position['name'] for position in GOLDEN])
+def test_valid_moves_match_baseline(position, engine):
+    # the move lists the baseline Board produced for the same state
+    board = load_position(engine(), position)
+    assert set(board.get_valid_moves(mask_offgoals=True)) == {as_move(move) for move in position['moves']}
+    assert set(board.get_valid_moves(mask_offgoals=False)) == {as_move(move) for move in position['all_moves']}
@@ -0,0 +1,41 @@
+import pytest
+from agent import Agent, PASS
+from bitboard import BitBoard
+from game import Board
+from golden import load_golden, load_position
+
+GOLDEN = load_golden()
+ENGINES = {'board': Board, 'bitboard': BitBoard}
+
+
+@pytest.mark.parametrize('engine', list(ENGINES))
+@pytest.mark.parametrize('position', GOLDEN, ids=[position['name'] for position in GOLDEN])
+def test_evaluation_matches_baseline(position, engine):
+    board = load_position(ENGINES[engine](), position)
+    agent = Agent()
+    assert agent.evaluate(board, board.current_player)[0] == pytest.approx(position['eval'])
+    assert agent.score(board, board.current_player) == pytest.approx(position['eval'])
+
+
+@pytest.mark.parametrize('engine', list(ENGINES))
+@pytest.mark.parametrize('position', GOLDEN, ids=[position['name'] for position in GOLDEN])
+def test_running_totals_survive_undo(position, engine):
+    # every move applied and undone on one board; the running totals must land back on the baseline score
+    board = load_position(ENGINES[engine](), position)
+    agent = Agent()
+    for move in sorted(board.get_valid_moves(mask_offgoals=True), key=repr):
+        if move == PASS:
+            continue
+        board.apply_move(move, switch_turn = False)
+        agent.evaluate(board, board.current_player)
+        board.undo_last_move()
+    assert agent.evaluate(board, board.current_player)[0] == pytest.approx(position['eval'])
+
+
+@pytest.mark.parametrize('position', GOLDEN, ids=[position['name'] for position in GOLDEN])
+def test_exhaustive_best_matches_baseline(position):
+    # the best pair's score, as the baseline scored every pair on a fresh board
+    board = load_position(Board(), position)
+    agent = Agent(search='exhaustive')
+    agent.select_move_pair(board.get_valid_moves(mask_offgoals=True), board, board.current_player)
+    assert agent.log[-1]['score'] == pytest.approx(position['best'])
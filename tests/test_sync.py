@@ -0,0 +1,98 @@
+import random
+from array import array
+import pytest
+from bitboard import BitBoard
+from game import Board, SAVED, SNAPSHOT_RACKS
+from golden import as_move, load_golden, load_position
+from replay import CORPUS, full_state
+
+ENGINES = {'board': Board, 'bitboard': BitBoard}
+PLIES = 200  # syncs replayed from each corpus position
+GOLDEN = load_golden()
+
+
+def delta_state(board, synced):
+    # the JSON the client posts instead, naming only the pieces that moved since the locations in synced
+    pieces = []
+    for piece in board.pieces:
+        location = board.get_location(piece)
+        if location == synced[piece.slot]:
+            continue
+        details = {'color': piece.player, 'number': piece.number}
+        if piece.tile:
+            details['tile'] = {'ring': piece.tile.ring, 'sector': piece.tile.pos}
+        else:
+            details['rack'] = 'saved' if location == SAVED else 'unentered'
+        pieces.append(details)
+    delta = {'currentTurn': board.current_player, 'dice': [{'value': die.number, 'used': die.used} for die in board.dice],
+             'pieces': pieces}
+    if board.firstMove:
+        delta['firstMove'] = {'color': board.firstMove['piece'].player, 'number': board.firstMove['piece'].number}
+    return delta
+
+
+def synced_position(board):
+    # to_array with the (slot, location) pairs in slot order, as Board keeps its piece list in sync order
+    data = list(board.to_array())
+    pairs = sorted(zip(data[0:SNAPSHOT_RACKS:2], data[1:SNAPSHOT_RACKS:2]))
+    return pairs, data[SNAPSHOT_RACKS:], board.get_hash(), set(board.get_valid_moves(mask_offgoals=True))
+
+
+@pytest.mark.parametrize('engine', list(ENGINES))
+@pytest.mark.parametrize('position', CORPUS, ids=[position['name'] for position in CORPUS])
+def test_delta_sync_matches_full_resync(position, engine):
+    # a seeded game played on a client board, synced after every move both ways into two server boards
+    rng = random.Random(position['seed'])
+    client = Board()
+    client.from_array(array('b', position['snapshot']))
+    resynced, patched = ENGINES[engine](), ENGINES[engine]()
+    resynced.update_state(full_state(client))
+    patched.update_state(full_state(client))
+    synced = client.get_locations()
+
+    for _ in range(PLIES):
+        if client.check_game_over()[0]:
+            break
+        moves = sorted(client.get_valid_moves(mask_offgoals=True), key=repr)
+        if moves and any(not die.used for die in client.dice):
+            client.apply_move(rng.choice(moves), switch_turn = False)
+        else:
+            client.moves.clear()
+            client.start_turn('white' if client.current_player == 'black' else 'black',
+                              (rng.randint(1, 6), rng.randint(1, 6)))
+        resynced.update_state(full_state(client))
+        patched.apply_delta(delta_state(client, synced))
+        synced = client.get_locations()
+        assert synced_position(patched) == synced_position(resynced)
+
+
+def state_locations(state):
+    # (color, number) -> tile or rack, read off a full-state JSON
+    locations = {(piece['color'], piece['number']): {'tile': piece['tile']} for piece in state['boardPieces']}
+    for key, rack in state['racks'].items():
+        color, rack_name = key[:5], key[5:].lower()  # 'whiteUnentered' -> 'white', 'unentered'
+        for piece in rack:
+            locations[color, piece['number']] = {'rack': rack_name}
+    return locations
+
+
+def golden_turns():
+    # consecutive recorded turns of the same replayed game
+    turns = []
+    for before, after in zip(GOLDEN, GOLDEN[1:]):
+        if before['name'].split('+')[0] == after['name'].split('+')[0]:
+            turns.append((before, after))
+    return turns
+
+
+@pytest.mark.parametrize('engine', list(ENGINES))
+@pytest.mark.parametrize('before, after', golden_turns(), ids=[after['name'] for _, after in golden_turns()])
+def test_delta_sync_reaches_baseline_moves(before, after, engine):
+    # a board synced to one recorded turn, then patched by the delta to the next, has the baseline's moves there
+    board = load_position(ENGINES[engine](), before)
+    old, new = state_locations(before['state']), state_locations(after['state'])
+    pieces = [dict(zip(('color', 'number'), piece), **location) for piece, location in new.items()
+              if old[piece] != location]
+    board.apply_delta({'currentTurn': after['state']['currentTurn'], 'dice': after['state']['dice'], 'pieces': pieces})
+    assert set(board.get_valid_moves(mask_offgoals=True)) == {as_move(move) for move in after['moves']}
+    assert board.game_stages[board.current_player] == after['stages'][board.current_player]
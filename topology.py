@@ -0,0 +1,231 @@
+import json
+import random
+import threading
+from collections import OrderedDict, deque
+
+MAX_STEPS = 12  # largest single move: the sum of both dice
+PIECE_SLOTS = 24  # two players with twelve pieces each
+ZOBRIST_SEED = 20240521  # fixed, so position hashes agree across processes and precomputed files
+ROUTE_CACHE_SIZE = 8192  # blocked goal distances kept per topology, least recently used dropped first
+
+# tile type codes; the type strings are only kept for tile_neighbors.json, reprs and the JSON API
+TILE_TYPES = ['home', 'field', 'save']
+HOME, FIELD, SAVE = range(len(TILE_TYPES))
+
+_topologies = {}
+
+
+def load_topology(filename):
+    # the tile graph never changes, so every Board built from the same file shares one index
+    topology = _topologies.get(filename)
+    if topology is None:
+        topology = _topologies[filename] = Topology(filename)
+    return topology
+
+
+def iter_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class RouteCounters:
+    """Route cache hits and misses and BFS fallbacks, for one traced search."""
+
+    __slots__ = ['route_hits', 'route_misses', 'bfs_calls']
+
+    def __init__(self):
+        self.route_hits = 0
+        self.route_misses = 0
+        self.bfs_calls = 0
+
+
+class Topology:
+    """Static index over the board graph, with tile sets stored as bitsets keyed by tile index.
+
+    Everything here is computed once for the empty board. Queries take a mask of blocked tiles and
+    only fall back to a bitset BFS when a blocker lies close enough to change the answer.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'r') as f:
+            data = json.load(f)
+
+        self.keys = []
+        self.types = []
+        self.numbers = []
+        self.index_of = {}
+        for key, value in data.items():
+            ring, sector = map(int, key.replace('ring', '').replace('sector', '').split('_'))
+            self.index_of[(ring, sector)] = len(self.keys)
+            self.keys.append((ring, sector))
+            self.types.append(value['type'])
+            self.numbers.append(value.get('number'))
+        self.size = len(self.keys)
+        self.home = self.types.index('home')
+
+        # per-tile codes and flags, so hot loops test a list entry instead of comparing type strings
+        self.kinds = [TILE_TYPES.index(t) for t in self.types]
+        self.is_field = [kind == FIELD for kind in self.kinds]
+        self.is_save = [kind == SAVE for kind in self.kinds]
+        self.passable = [kind != HOME for kind in self.kinds]  # the tiles a piece can move onto
+
+        self.neighbors = []
+        for value in data.values():
+            self.neighbors.append([self.index_of[(n['ring'], n['sector'])] for n in value['neighbors']
+                                   if (n['ring'], n['sector']) in self.index_of])
+        self.neighbor_masks = [sum(1 << j for j in set(nbrs)) for nbrs in self.neighbors]
+
+        self.field_mask = self._mask_of(lambda i: self.is_field[i])
+        self.save_mask = self._mask_of(lambda i: self.is_save[i])
+        self.passable_mask = self.field_mask | self.save_mask
+
+        # goal class 0 is any save tile (unnumbered pieces), 1-6 the matching numbered goal
+        self.goal_masks = {0: self.save_mask}
+        for number in range(1, 7):
+            self.goal_masks[number] = self._mask_of(lambda i: self.is_save[i] and self.numbers[i] == number)
+
+        self.distances = [self._bfs(i) for i in range(self.size)]
+        self.depth = max([MAX_STEPS] + [d for row in self.distances for d in row if d != float('inf')])
+
+        # exact[k][i]: tiles exactly k steps from i; within[k][i]: tiles 1..k steps from i
+        self.exact = [[0] * self.size for _ in range(self.depth + 1)]
+        self.within = [[0] * self.size for _ in range(self.depth + 1)]
+        for i, row in enumerate(self.distances):
+            for j, d in enumerate(row):
+                if d != float('inf'):
+                    self.exact[d][i] |= 1 << j
+            for k in range(1, self.depth + 1):
+                self.within[k][i] = self.within[k - 1][i] | self.exact[k][i]
+
+        # Zobrist keys per (piece slot, location); the two extra entries per slot are for the racks,
+        # addressed by the negative UNENTERED/SAVED location codes
+        rng = random.Random(ZOBRIST_SEED)
+        self.piece_keys = [[rng.getrandbits(64) for _ in range(self.size + 2)] for _ in range(PIECE_SLOTS)]
+        self.side_key = rng.getrandbits(64)
+
+        self.goal_distances = {}
+        for goal_class, goals in self.goal_masks.items():
+            goal_tiles = list(iter_bits(goals))
+            self.goal_distances[goal_class] = [min((self.distances[i][j] for j in goal_tiles if j != i), default=float('inf'))
+                                               for i in range(self.size)]
+
+        # goal_distance searches keyed by (start, goal class, blocked mask); the graph never changes, so an
+        # entry stays right for as long as it's kept and a new blockade simply misses
+        self.routes = OrderedDict()
+        self.route_hits = 0
+        self.route_misses = 0
+        self.bfs_calls = 0  # searches that couldn't be answered from the tables
+        # The counters above are process-wide, for /metrics. A traced search counts its own lookups in a
+        # RouteCounters kept per thread, so searches running on other threads don't end up in its trace.
+        self.local = threading.local()
+
+    def position_hash(self, locations, black_to_move):
+        key = self.side_key if black_to_move else 0
+        for slot, location in enumerate(locations):
+            if location is not None:
+                key ^= self.piece_keys[slot][location]
+        return key
+
+    def __deepcopy__(self, memo):
+        # Shared by every copy of a board. The tables never change, and the route cache and counters are
+        # shared on purpose: a cached distance depends only on (start, goal class, blocked), never on the
+        # board that asked, so it holds for every copy.
+        return self
+
+    def trace_routes(self):
+        # fresh RouteCounters that this thread's lookups also count into, until untrace_routes()
+        counters = self.local.counters = RouteCounters()
+        return counters
+
+    def untrace_routes(self):
+        self.local.counters = None
+
+    def __reduce__(self):
+        return load_topology, (self.filename,)  # pickles by name; the receiving process loads its own copy
+
+    def _mask_of(self, predicate):
+        return sum(1 << i for i in range(self.size) if predicate(i))
+
+    def _bfs(self, start):
+        # step counts from start over the empty board, entering only field and save tiles
+        distances = [float('inf')] * self.size
+        distances[start] = 0
+        queue = deque([start])
+        while queue:
+            i = queue.popleft()
+            for j in self.neighbors[i]:
+                if distances[j] == float('inf') and (self.passable_mask >> j) & 1:
+                    distances[j] = distances[i] + 1
+                    queue.append(j)
+        return distances
+
+    def reachable_mask(self, start, steps, blocked):
+        # tiles whose shortest unblocked route from start is exactly `steps` long
+        if steps == 0:
+            return 1 << start
+        if steps <= self.depth and not blocked & self.within[steps - 1][start]:
+            return self.exact[steps][start] & ~blocked
+
+        self.count_bfs()
+        allowed = self.passable_mask & ~blocked
+        visited = frontier = 1 << start
+        for _ in range(steps):
+            expanded = 0
+            for i in iter_bits(frontier):
+                expanded |= self.neighbor_masks[i]
+            frontier = expanded & allowed & ~visited
+            if not frontier:
+                return 0
+            visited |= frontier
+        return frontier
+
+    def count_bfs(self):
+        self.bfs_calls += 1
+        traced = getattr(self.local, 'counters', None)
+        if traced is not None:
+            traced.bfs_calls += 1
+
+    def goal_distance(self, start, goal_class, blocked):
+        # length of the shortest unblocked route from start onto a goal of the given class
+        distance = self.goal_distances[goal_class][start]
+        if distance == float('inf') or not blocked & self.within[distance - 1][start]:
+            return distance
+
+        key = (start, goal_class, blocked)
+        traced = getattr(self.local, 'counters', None)
+        cached = self.routes.get(key)
+        if cached is not None:
+            self.route_hits += 1
+            if traced is not None:
+                traced.route_hits += 1
+            self.routes.move_to_end(key)
+            return cached
+        self.route_misses += 1
+        if traced is not None:
+            traced.route_misses += 1
+        distance = self.blocked_goal_distance(start, goal_class, blocked)
+        self.routes[key] = distance
+        if len(self.routes) > ROUTE_CACHE_SIZE:
+            self.routes.popitem(last=False)
+        return distance
+
+    def blocked_goal_distance(self, start, goal_class, blocked):
+        self.count_bfs()
+        goals = self.goal_masks[goal_class]
+        allowed = self.passable_mask & ~blocked
+        visited = frontier = 1 << start
+        distance = 0
+        while frontier:
+            distance += 1
+            expanded = 0
+            for i in iter_bits(frontier):
+                expanded |= self.neighbor_masks[i]
+            expanded &= ~visited
+            if expanded & goals:
+                return distance
+            visited |= expanded
+            frontier = expanded & allowed
+        return float('inf')
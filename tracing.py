@@ -0,0 +1,93 @@
+import logging
+import os
+import random
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+TRACE_LEVELS = {'off': 0, 'searches': 1, 'phases': 2}  # phases adds time per step of the search, see SearchTrace
+PHASES = ['book', 'search', 'generate', 'evaluate']
+TRACE_BUFFER_SIZE = 256  # most recent traced searches kept in memory
+
+_tracers = []
+
+
+class SearchTrace:
+    """Counters for one select_move_pair call: the agent's as differences of its running totals, which
+    only this search adds to while it runs, and the topology's route counts as this thread's own.
+
+    nodes counts every position the search reached, the root included, and evaluations the ones the
+    scalar evaluator scored (transposition misses). The phases are the book lookup, the search, and
+    within the search the move generation and leaf evaluation, so 'search' includes the last two.
+    """
+
+    def __init__(self, tracer, agent, board, player, moves):
+        self.tracer = tracer
+        self.agent = agent
+        self.topology = board.topology
+        self.record = {'search': agent.search, 'player': player, 'stage': board.game_stages[player], 'moves': len(moves)}
+        self.phases = dict.fromkeys(PHASES, 0.0) if tracer.level >= TRACE_LEVELS['phases'] else None
+        self.counts = self.totals()
+        self.routes = self.topology.trace_routes()
+        self.start = time.perf_counter()
+
+    def totals(self):
+        return self.agent.nodes, self.agent.transposition_hits, self.agent.transposition_misses
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def finish(self, move_pair, score, book=None, search=None):
+        # search is the expectimax search's report: the depth it completed, and the one a timeout cut short
+        elapsed = time.perf_counter() - self.start
+        nodes, hits, misses = (now - then for now, then in zip(self.totals(), self.counts))
+        self.topology.untrace_routes()
+        self.record.update({
+            'move': move_pair,
+            'score': score,
+            'book': book,
+            'depth': search['depth'] if search else None,
+            'partial_depth': search.get('partial') if search else None,
+            'nodes': nodes,
+            'evaluations': misses,
+            'transposition_hits': hits,
+            'route_hits': self.routes.route_hits,
+            'route_misses': self.routes.route_misses,
+            'bfs_calls': self.routes.bfs_calls,
+            'elapsed_ms': elapsed * 1000,
+        })
+        if self.phases is not None:
+            self.record['phases_ms'] = {phase: seconds * 1000 for phase, seconds in self.phases.items()}
+        self.tracer.recent.append(self.record)
+        logger.debug('search %s', self.record)
+
+
+class Tracer:
+    """Opt-in tracing of the agent's searches into a ring buffer of the most recent ones.
+
+    With the level at 'off' a search costs one attribute check. A traced search records its move,
+    node and evaluation counts, transposition and route cache hits and BFS fallbacks; at 'phases'
+    it also times the book lookup, the search, move generation and leaf evaluation. sample_rate traces that fraction of searches, picked at random.
+    """
+
+    def __init__(self, level='off', sample_rate=1.0, size=TRACE_BUFFER_SIZE):
+        if level not in TRACE_LEVELS:
+            raise ValueError(f'Unknown trace level: {level}')
+        self.level = TRACE_LEVELS[level]
+        self.sample_rate = sample_rate
+        self.recent = deque(maxlen=size)
+        self.random = random.Random()
+
+    def start(self, agent, board, player, moves):
+        # a SearchTrace, or None when this search isn't traced
+        if not self.level or (self.sample_rate < 1 and self.random.random() >= self.sample_rate):
+            return None
+        return SearchTrace(self, agent, board, player, moves)
+
+
+def get_tracer():
+    # the process-wide tracer, set up from AGENT_TRACE (off, searches or phases) and AGENT_TRACE_SAMPLE
+    if not _tracers:
+        _tracers.append(Tracer(os.environ.get('AGENT_TRACE', 'off'), float(os.environ.get('AGENT_TRACE_SAMPLE', 1))))
+    return _tracers[0]
@@ -0,0 +1,180 @@
+import argparse
+import copy
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from agent import Agent, INITIAL_WEIGHTS, SEARCH_MODES
+from game import NUM_PIECES
+from selfplay import ENGINES, play_game
+
+UNTUNED = {'dice_roll_utilization'}  # not read by the evaluator, so games can't tell its values apart
+SPSA_STEP = 0.05  # a: learning rate on weights scaled to their starting size
+SPSA_PERTURBATION = 0.1  # c: each weight is nudged by +-10% of its starting size
+SPSA_ALPHA = 0.602  # standard SPSA decay exponents for the step and the perturbation
+SPSA_GAMMA = 0.101
+SPSA_STABILITY = 0.1  # A, as a fraction of the iteration count
+
+_worker = {}
+
+
+def weight_keys(weights):
+    # (name, number or stage) paths of the tuned weights; zero entries have no scale and are left alone
+    keys = []
+    for name, value in weights.items():
+        if name in UNTUNED:
+            continue
+        if isinstance(value, dict):
+            keys.extend((name, key) for key, entry in value.items() if entry)
+        elif value:
+            keys.append((name,))
+    return keys
+
+
+def get_weight(weights, key):
+    return weights[key[0]] if len(key) == 1 else weights[key[0]][key[1]]
+
+
+def with_values(weights, keys, values):
+    weights = copy.deepcopy(weights)
+    for key, value in zip(keys, values):
+        if len(key) == 1:
+            weights[key[0]] = value
+        else:
+            weights[key[0]][key[1]] = value
+    return weights
+
+
+def key_name(key):
+    return '.'.join(str(part) for part in key)
+
+
+def load_weights(filename):
+    # JSON turns the piece-number keys into strings; put them back
+    with open(filename) as file:
+        weights = json.load(file)
+    for name, value in weights.items():
+        if isinstance(value, dict):
+            weights[name] = {int(key) if key.isdigit() else key: entry for key, entry in value.items()}
+    return weights
+
+
+def start_worker(baseline, search, engine):
+    # The baseline agent lives as long as the process, so its transposition table stays warm across games.
+    # Nothing is shared between processes: every game gets its weights and seed in the task.
+    _worker['baseline'] = Agent(weights=baseline, search=search)
+    _worker['search'] = search
+    _worker['engine'] = engine
+
+
+def play_match(candidate, seed, colour):
+    # one game of candidate weights against the baseline; the score is the margin from the candidate's side
+    opponent = 'black' if colour == 'white' else 'white'
+    players = {colour: Agent(weights=candidate, search=_worker['search']), opponent: _worker['baseline']}
+    winner, margin = play_game(players, _worker['engine'], seed)
+    if winner is None:
+        return None, 0
+    return winner == colour, margin if winner == colour else -margin
+
+
+class SPSATuner:
+    """Simultaneous perturbation tuning of the evaluation weights against a fixed baseline.
+
+    Every iteration nudges all weights at once by +-c (a random sign per weight), plays both nudged
+    vectors against the baseline on the same seeds and colours, and moves the weights along the
+    difference in mean margin. Weights are scaled to their starting size, so a 0.2 penalty and a 60
+    point bonus move by comparable fractions. Games run in a process pool and every result is
+    written to the results file as it comes in.
+    """
+
+    def __init__(self, baseline=INITIAL_WEIGHTS, start=None, games=8, search='exhaustive', engine='board',
+                 workers=None, seed=0, results_file='tuning_results.jsonl'):
+        self.baseline = baseline
+        self.keys = weight_keys(baseline)
+        self.scales = [abs(get_weight(baseline, key)) for key in self.keys]
+        start = start or baseline
+        self.theta = [get_weight(start, key) / scale for key, scale in zip(self.keys, self.scales)]
+        self.games = games  # seeds per nudged vector, each played once with either colour
+        self.search = search
+        self.engine = engine
+        self.workers = workers or os.cpu_count()
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.results_file = results_file
+
+    def weights(self, theta=None):
+        theta = self.theta if theta is None else theta
+        return with_values(self.baseline, self.keys, [t * scale for t, scale in zip(theta, self.scales)])
+
+    def run(self, iterations):
+        stability = SPSA_STABILITY * iterations
+        with ProcessPoolExecutor(self.workers, initializer=start_worker,
+                                 initargs=(self.baseline, self.search, self.engine)) as pool, \
+                open(self.results_file, 'a') as out:
+            for k in range(iterations):
+                step = SPSA_STEP / (k + 1 + stability) ** SPSA_ALPHA
+                perturbation = SPSA_PERTURBATION / (k + 1) ** SPSA_GAMMA
+                delta = [self.random.choice((-1, 1)) for _ in self.theta]
+                sides = {
+                    '+': self.weights([t + perturbation * d for t, d in zip(self.theta, delta)]),
+                    '-': self.weights([t - perturbation * d for t, d in zip(self.theta, delta)]),
+                }
+
+                # both sides play the same seeds and colours, so the dice cancel out of the comparison
+                seeds = [self.seed + k * self.games + i for i in range(self.games)]
+                jobs = {pool.submit(play_match, weights, seed, colour): (side, seed, colour)
+                        for side, weights in sides.items() for seed in seeds for colour in ('white', 'black')}
+                results = {side: [] for side in sides}
+                for job in as_completed(jobs):
+                    side, seed, colour = jobs[job]
+                    won, margin = job.result()
+                    results[side].append((won, margin))
+                    self.write(out, {'iteration': k, 'side': side, 'seed': seed, 'colour': colour,
+                                     'won': won, 'margin': margin})
+
+                mean = {side: sum(margin for _, margin in games) / (len(games) * NUM_PIECES)
+                        for side, games in results.items()}
+                gradient = (mean['+'] - mean['-']) / (2 * perturbation)
+                self.theta = [t + step * gradient * d for t, d in zip(self.theta, delta)]
+                self.write(out, {
+                    'iteration': k,
+                    'win_rate': {side: sum(won is True for won, _ in games) / len(games) for side, games in results.items()},
+                    'mean_margin': {side: mean[side] * NUM_PIECES for side in sides},
+                    'weights': {key_name(key): value for key, value in zip(self.keys, self.values())},
+                })
+        return self.weights()
+
+    def values(self):
+        return [t * scale for t, scale in zip(self.theta, self.scales)]
+
+    def write(self, out, record):
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune the evaluation weights by SPSA over self-play games.')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--games', type=int, default=8, help='seeds per iteration; each is played 4 times')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=list(ENGINES), default='bitboard')
+    parser.add_argument('--search', choices=[mode for mode in SEARCH_MODES if mode != 'parallel'], default='pruned')
+    parser.add_argument('--start', help='weights file to continue from, such as an earlier --out')
+    parser.add_argument('--results', default='tuning_results.jsonl', help='game and iteration records, appended')
+    parser.add_argument('--out', default='tuned_weights.json')
+    args = parser.parse_args()
+
+    start = load_weights(args.start) if args.start else None
+    tuner = SPSATuner(start=start, games=args.games, search=args.search, engine=args.engine, workers=args.workers,
+                      seed=args.seed, results_file=args.results)
+    start = time.perf_counter()
+    weights = tuner.run(args.iterations)
+    with open(args.out, 'w') as file:
+        json.dump(weights, file, indent=4)
+    print(f'{args.iterations} iterations in {time.perf_counter() - start:.1f}s, weights written to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
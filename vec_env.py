@@ -0,0 +1,232 @@
+import random
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from agent import PASS, PLAYERS
+from batch_eval import ABSENT, STAGES
+from bitboard import BitBoard
+from game import Board, NUM_PIECES, PLAYER_INDEX
+from selfplay import MAX_TURNS
+from topology import load_topology
+
+ENGINES = {'board': Board, 'bitboard': BitBoard}
+OPPONENTS = ['self', 'random', 'agent']  # self: both colours are played by the caller, one turn each
+DICE = 2  # moves per turn; actions name the die by position, so a double's two moves are the same action
+OBSERVATION_SIZE = 2 * NUM_PIECES + 7  # see observe()
+
+_shard = {}
+
+
+class ActionSpace:
+    """Flat action indices for one topology, laid out like Board.get_all_possible_moves: 0 is the pass,
+    then every piece and field or save tile, then a save column, each split by the die that is used.
+
+    Pieces are numbered from the mover's side, so the same index means the same move for either colour.
+    """
+
+    def __init__(self, topology):
+        columns = list(topology.keys) + ['save']
+        self.size = 1 + NUM_PIECES * len(columns) * DICE
+        self.base = {(number, destination): 1 + ((number - 1) * len(columns) + column) * DICE
+                     for number in range(1, NUM_PIECES + 1) for column, destination in enumerate(columns)}
+
+    def legal(self, moves, dice):
+        # action index -> move, for a position's valid moves
+        first = dice[0].number
+        base = self.base
+        return {0 if move == PASS else base[move[0][1], move[1]] + (move[2] != first): move for move in moves}
+
+
+class VectorEnv:
+    """N games stepped in lockstep, one move per game per step.
+
+    A turn is up to DICE moves by the player to move, ending early on the pass action or when no move
+    is left; turns where the pass is the only legal action are skipped. Observations are from the
+    mover's side, and masks mark the legal actions from get_valid_moves. Against opponent 'self' the
+    caller plays both colours and a win rewards the player whose move finished the game with the
+    margin; against 'random' or 'agent' the caller plays white and the opponent's turns are played
+    inside step, so a loss rewards minus the margin. A finished game is reset in place, and a game
+    still going after MAX_TURNS turns ends as truncated.
+
+    Throughput is bounded by Python move generation, which is about three quarters of a step: on one
+    core, 64 bitboard games manage roughly 6-12k steps/s against 'self' and 2-4k against 'random',
+    whose turns are generated inside step. More than that takes ShardedVectorEnv over several cores.
+    """
+
+    def __init__(self, num_envs, engine='bitboard', opponent='self', seed=0):
+        if opponent not in OPPONENTS:
+            raise ValueError(f'Unknown opponent: {opponent}')
+        self.num_envs = num_envs
+        self.engine = ENGINES[engine]
+        self.opponent = opponent
+        self.boards = [None] * num_envs
+        self.rngs = [random.Random(seed + i) for i in range(num_envs)]  # each game's dice and rack orders
+        self.opponents = [self.make_opponent(seed + i) for i in range(num_envs)]
+        self.moves_made = [0] * num_envs
+        self.turns = [0] * num_envs
+        self.legal = [None] * num_envs  # action index -> move, for the position each game is in
+        self.actions = ActionSpace(load_topology('tile_neighbors.json'))  # the engines' graph, without building one
+        self.observations = np.zeros((num_envs, OBSERVATION_SIZE), dtype=np.int16)
+        self.masks = np.zeros((num_envs, self.actions.size), dtype=bool)
+
+    def make_opponent(self, seed):
+        if self.opponent == 'random':
+            from selfplay import RandomPlayer
+            return RandomPlayer(seed)
+        if self.opponent == 'agent':
+            from agent import Agent
+            return Agent(search='pruned')
+        return None
+
+    def reset(self):
+        for i in range(self.num_envs):
+            self.reset_game(i)
+        return self.observations.copy(), self.masks.copy()
+
+    def reset_game(self, i):
+        # The engines shuffle their racks with the global random, so it is seeded per game as in play_game,
+        # and only while the board is built: the caller's own use of random carries on undisturbed.
+        while True:
+            state = random.getstate()
+            random.seed(self.rngs[i].getrandbits(32))
+            try:
+                self.boards[i] = self.engine()
+            finally:
+                random.setstate(state)
+            self.turns[i] = 0
+            self.start_turn(i, 'white')
+            _, terminated, truncated = self.settle(i)
+            if not (terminated or truncated):
+                return
+
+    def start_turn(self, i, player):
+        board = self.boards[i]
+        board.moves.clear()
+        rng = self.rngs[i]
+        board.start_turn(player, (rng.randint(1, 6), rng.randint(1, 6)))
+        self.moves_made[i] = 0
+
+    def end_turn(self, i):
+        # False once the game has run out of turns
+        self.turns[i] += 1
+        if self.turns[i] >= MAX_TURNS:
+            return False
+        board = self.boards[i]
+        self.start_turn(i, 'white' if board.current_player == 'black' else 'black')
+        return True
+
+    def settle(self, i):
+        # Plays forced passes and the opponent's turns until the caller has a choice to make, then
+        # observes. Returns the reward to the caller and whether the game ended or was cut short.
+        board = self.boards[i]
+        while True:
+            if self.opponents[i] is not None and board.current_player != 'white':
+                opponent = self.opponents[i]
+                move_pair = opponent.select_move_pair(board.get_valid_moves(mask_offgoals=True), board, board.current_player)
+                for move in move_pair:
+                    if move == PASS:
+                        break
+                    board.apply_move(move, switch_turn=False)
+                winner, margin = board.check_game_over()
+                if winner:
+                    return -margin, True, False
+            else:
+                moves = board.get_valid_moves()
+                if len(moves) > 1:
+                    self.legal[i] = self.actions.legal(moves, board.dice)
+                    self.observe(i)
+                    return 0, False, False
+            if not self.end_turn(i):
+                return 0, False, True
+
+    def observe(self, i):
+        # the mover's 12 piece locations, the opponent's 12, both dice, whether each is used, both
+        # players' stage codes and the mover's colour
+        board = self.boards[i]
+        p = PLAYER_INDEX[board.current_player]
+        locations = board.get_locations()
+        own = locations[p * NUM_PIECES:(p + 1) * NUM_PIECES]
+        other = locations[(1 - p) * NUM_PIECES:(2 - p) * NUM_PIECES]
+        row = self.observations[i]
+        row[:2 * NUM_PIECES] = [ABSENT if location is None else location for location in own + other]
+        row[2 * NUM_PIECES:] = [board.dice[0].number, board.dice[1].number, board.dice[0].used, board.dice[1].used,
+                                STAGES.index(board.game_stages[PLAYERS[p]]),
+                                STAGES.index(board.game_stages[PLAYERS[1 - p]]), p]
+        mask = self.masks[i]
+        mask[:] = False
+        mask[list(self.legal[i])] = True
+
+    def step(self, actions):
+        # observations and masks after every game's move, the rewards, and which games terminated or
+        # were truncated; those have already been reset, so their observation starts the next game
+        rewards = np.zeros(self.num_envs, dtype=np.float32)
+        terminated = np.zeros(self.num_envs, dtype=bool)
+        truncated = np.zeros(self.num_envs, dtype=bool)
+        for i, action in enumerate(actions):
+            move = self.legal[i].get(int(action))
+            if move is None:
+                raise ValueError(f'Illegal action {action} in game {i}')
+            rewards[i], terminated[i], truncated[i] = self.play(i, move)
+            if terminated[i] or truncated[i]:
+                self.reset_game(i)
+        return self.observations.copy(), self.masks.copy(), rewards, terminated, truncated
+
+    def play(self, i, move):
+        board = self.boards[i]
+        if move != PASS:
+            board.apply_move(move, switch_turn=False)
+            winner, margin = board.check_game_over()
+            if winner:
+                return margin, True, False
+            self.moves_made[i] += 1
+            if self.moves_made[i] < DICE:
+                moves = board.get_valid_moves()
+                if len(moves) > 1:
+                    self.legal[i] = self.actions.legal(moves, board.dice)
+                    self.observe(i)
+                    return 0, False, False
+        if not self.end_turn(i):
+            return 0, False, True
+        return self.settle(i)
+
+
+def start_shard(num_envs, engine, opponent, seed):
+    # runs once in each worker process, which keeps its slice of the games between steps
+    _shard['env'] = VectorEnv(num_envs, engine, opponent, seed)
+
+
+def shard_reset():
+    return _shard['env'].reset()
+
+
+def shard_step(actions):
+    return _shard['env'].step(actions)
+
+
+class ShardedVectorEnv:
+    """VectorEnv split over worker processes, each stepping its own slice of the games.
+
+    Same reset() and step() as VectorEnv; every step sends each worker its slice of the actions and
+    waits for all of them, so the games still move in lockstep.
+    """
+
+    def __init__(self, num_envs, workers, engine='bitboard', opponent='self', seed=0):
+        sizes = [num_envs // workers + (w < num_envs % workers) for w in range(workers)]
+        starts = [sum(sizes[:w]) for w in range(workers)]
+        self.num_envs = num_envs
+        self.slices = [slice(start, start + size) for start, size in zip(starts, sizes) if size]
+        self.shards = [ProcessPoolExecutor(1, initializer=start_shard, initargs=(size, engine, opponent, seed + start))
+                       for start, size in zip(starts, sizes) if size]
+        self.actions = ActionSpace(load_topology('tile_neighbors.json'))
+
+    def reset(self):
+        results = [shard.submit(shard_reset) for shard in self.shards]
+        return tuple(np.concatenate(parts) for parts in zip(*(result.result() for result in results)))
+
+    def step(self, actions):
+        actions = np.asarray(actions)
+        results = [shard.submit(shard_step, actions[part]) for shard, part in zip(self.shards, self.slices)]
+        return tuple(np.concatenate(parts) for parts in zip(*(result.result() for result in results)))
+
+    def close(self):
+        for shard in self.shards:
+            shard.shutdown(wait=False, cancel_futures=True)